@@ -0,0 +1,306 @@
+"""
+GAR
+===
+
+Benchmark
+---------
+
+A submodule of the GAR package with reproducible benchmarks of the
+performance critical parts of the pipeline. Micro benchmarks also check
+that the optimized code gives exactly the same result as the reference
+implementation it replaces. The pipeline benchmark runs the whole
+script on synthetic archives of several sizes (see `GAR.synthetic`) and
+reports the time, throughput and peak memory of every stage. The
+lookup benchmark measures GUID lookups per second against the index of
+a synthetic export (see `GAR.lookup`).
+
+Usage: python -m GAR.benchmark translit [n_values]
+       python -m GAR.benchmark pipeline [work_dir] [sizes]
+       python -m GAR.benchmark compact [work_dir] [size]
+       python -m GAR.benchmark lookup [work_dir] [size]
+"""
+
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from typing import Callable, List
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from GAR.config import default_config
+from GAR.file_utils import load_all_data
+from GAR.filter_data import ROW_FILTERS
+from GAR.lookup import lookup_guids, open_guid_index
+from GAR.main import process_all_regions
+from GAR.merge_to_csv import merge_all_files
+from GAR.region import compile_region
+from GAR.synthetic import (REGION_WEIGHTS, SIZES, make_archive,
+                           region_houses)
+from GAR.translit import translit_series, translit_series_regex
+
+
+STAGES = ['load', 'cast', 'filter', 'house_list', 'parents', 'translit',
+          'save', 'inverted', 'region', 'export', 'lookup', 'read_prev',
+          'read_curr', 'compare', 'main']
+LOOKUP_BATCHES = [1, 10, 100, 10**3, 10**4, 10**5, 10**6]
+# share of unknown GUIDs among the lookups
+MISS_RATE = 0.1
+
+
+def best_time(func: Callable, repeat: int = 3) -> float:
+    """Run `func` `repeat` times and return the best wall time."""
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+
+def random_names(n: int, seed: int = 0) -> List[str]:
+    """Generate `n` address-like strings: cyrillic words of both cases,
+    numbers, punctuation, and corner cases for the transliteration
+    rules (runs of `е`/`э`, soft and hard signs, upper case
+    abbreviations).
+    """
+    rng = random.Random(seed)
+    words = ['Ленина', 'Елецкая', 'Эльбрус', 'Подъездная', 'ЖК', 'Ёлочная',
+             'Щорса', 'СНТ', 'пер', 'ул', 'Соловьёва', 'Заводская', 'Аэропорт',
+             'Ее', 'ЕЕЕ', 'мкр', 'Объездная', 'ДНП', 'Речная', 'им']
+    extra = ['', '', '1', '2а', '15к', '"Солнечный"', '-', '7/1', 'ЭЭ']
+    names = []
+    for _ in range(n):
+        k = rng.randint(1, 4)
+        parts = [rng.choice(words) for _ in range(k)] + [rng.choice(extra)]
+        names.append(' '.join(parts).strip())
+    return names
+
+
+def bench_translit(n: int = 10**6, seed: int = 0) -> pd.DataFrame:
+    """Benchmark `translit_series` against the regex based reference
+    `translit_series_regex` on `n` generated strings (with duplicates,
+    as in real region columns) and on their distinct values only.
+    Raise AssertionError if the outputs differ.
+    """
+    values = pd.Series(random_names(n, seed), dtype=object)
+    golden = translit_series_regex(values)
+    result = translit_series(values)
+    assert golden.tolist() == result.tolist(), 'translit output differs'
+    unique = pd.Series(values.unique(), dtype=object)
+    rows = []
+    for label, data in [('all', values), ('unique', unique)]:
+        t_ref = best_time(lambda: translit_series_regex(data))
+        t_new = best_time(lambda: translit_series(data))
+        rows.append({'input': label, 'values': len(data),
+                     'regex_sec': round(t_ref, 4),
+                     'engine_sec': round(t_new, 4),
+                     'speedup': round(t_ref / t_new, 2)})
+    return pd.DataFrame(rows)
+
+
+def prepare_archives(size: str, work_dir: str, seed: int = 0) -> tuple:
+    """Write the base and the updated synthetic archives of a size and
+    the export of the base one, unless they are in `work_dir` already.
+    Return the file names of the updated archive and of the export.
+    """
+    base_fn = os.path.join(work_dir, f'{size}_{seed}_0.zip')
+    update_fn = os.path.join(work_dir, f'{size}_{seed}_1.zip')
+    prev_csv = os.path.join(work_dir, f'{size}_{seed}_0.csv')
+    for update, fn in enumerate([base_fn, update_fn]):
+        if not os.path.isfile(fn):
+            make_archive(fn, SIZES[size], seed, update)
+    if not os.path.isfile(prev_csv):
+        tmp_dir = os.path.join(work_dir, f'{size}_tmp')
+        process_all_regions(base_fn, tmp_dir, default_config())
+        merge_all_files(tmp_dir, prev_csv)
+        shutil.rmtree(tmp_dir)
+    return update_fn, prev_csv
+
+
+def stage_report(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Sum stage metrics over regions and compute the throughput of
+    every stage (input rows, or output rows if a stage has no input,
+    per second of wall time).
+    """
+    df = metrics.groupby('stage').agg(
+        wall_sec=('wall_sec', 'sum'), cpu_sec=('cpu_sec', 'sum'),
+        rows_in=('rows_in', lambda x: x.sum(min_count=1)),
+        rows_out=('rows_out', lambda x: x.sum(min_count=1)),
+        max_rss_mb=('max_rss_mb', 'max'))
+    rows = df.rows_in.fillna(df.rows_out)
+    df['rows_per_sec'] = (rows / df.wall_sec.clip(lower=1e-9)).round()
+    order = [x for x in STAGES if x in df.index]
+    return df.loc[order].reset_index()
+
+
+def bench_pipeline(sizes: List[str], work_dir: str,
+                   seed: int = 0) -> pd.DataFrame:
+    """Run the main script end to end on the updated synthetic archive
+    of every size (see `prepare_archives`) in a child process with
+    stage metrics on, and report every stage and the whole run. `GAR_*`
+    settings of this process are passed on, so that runs with different
+    settings can be compared. Sizes are best given in ascending order:
+    the CPU time of a run is taken from the resource usage of finished
+    children.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    reports = []
+    for size in sizes:
+        update_fn, prev_csv = prepare_archives(size, work_dir, seed)
+        metrics_dir = os.path.join(work_dir, f'{size}_metrics')
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        dest_csv = os.path.join(work_dir, f'{size}_{seed}_1.csv')
+        args = [sys.executable, '-m', 'GAR.main', update_fn,
+                os.path.join(work_dir, f'{size}_tmp'), dest_csv, prev_csv]
+        env = dict(os.environ, GAR_METRICS_DIR=metrics_dir)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        t1 = time.perf_counter()
+        with open(os.path.join(work_dir, f'{size}.log'), 'w') as log:
+            subprocess.run(args, env=env, stdout=log,
+                           stderr=subprocess.STDOUT, check=True)
+        wall = time.perf_counter() - t1
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (after.ru_utime + after.ru_stime
+               - usage.ru_utime - usage.ru_stime)
+        metrics = pd.read_csv(os.path.join(metrics_dir, 'metrics.csv'),
+                              dtype={'region': str})
+        exported = metrics.loc[metrics.stage == 'export', 'rows_out'].sum()
+        metrics = pd.concat([metrics, pd.DataFrame([{
+            'stage': 'main', 'wall_sec': round(wall, 4),
+            'cpu_sec': round(cpu, 4), 'rows_out': exported,
+            'max_rss_mb': metrics.max_rss_mb.max()}])], ignore_index=True)
+        report = stage_report(metrics)
+        report.insert(0, 'size', size)
+        report.insert(1, 'houses', sum(region_houses(SIZES[size], x)
+                                       for x in REGION_WEIGHTS))
+        reports.append(report)
+        logger.info(f'Size {size} done in {round(wall, 2)} sec.')
+    return pd.concat(reports, ignore_index=True)
+
+
+def bench_compact(zfn: str, region: str, work_dir: str) -> pd.DataFrame:
+    """Compile a region of an archive with the default and with the
+    compact column types and report the time, frame memory and traced
+    peak memory of every stage of both runs (cProfile statistics go to
+    `work_dir`). Raise AssertionError if the ready data differs.
+    """
+    data = load_all_data(zfn, region, ROW_FILTERS)
+    stages = ('cast', 'filter', 'house_list', 'parents', 'translit')
+    results, reports = [], []
+    for compact in [False, True]:
+        config = default_config()._replace(metrics_dir=work_dir,
+                                           profile_stages=stages,
+                                           compact=compact)
+        records = []
+        results.append(compile_region(data, region, config, records=records))
+        report = pd.DataFrame(records)
+        report.insert(0, 'compact', compact)
+        reports.append(report)
+    pd.testing.assert_frame_equal(results[0], results[1], check_dtype=False)
+    columns = ['compact', 'stage', 'wall_sec', 'rows_in', 'rows_out',
+               'frame_mb_in', 'frame_mb_out', 'traced_peak_mb']
+    return pd.concat(reports, ignore_index=True)[columns]
+
+
+def bench_lookup(size: str, work_dir: str, seed: int = 0,
+                 batches: List[int] = LOOKUP_BATCHES,
+                 min_lookups: int = 10**5) -> pd.DataFrame:
+    """Export the base synthetic archive of a size with a GUID lookup
+    index (unless it is in `work_dir` already) and report lookups and
+    rows per second for every batch size. Each batch size runs for at
+    least `min_lookups` lookups; `MISS_RATE` of the GUIDs are unknown.
+    Raise AssertionError if a batch lookup gives other rows than a scan
+    of the data file.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    index_dir = os.path.join(work_dir, f'{size}_{seed}_lookup')
+    if not os.path.isdir(index_dir):
+        zfn = os.path.join(work_dir, f'{size}_{seed}_0.zip')
+        if not os.path.isfile(zfn):
+            make_archive(zfn, SIZES[size], seed)
+        tmp_dir = os.path.join(work_dir, f'{size}_tmp')
+        config = default_config()._replace(lookup_dir=index_dir)
+        process_all_regions(zfn, tmp_dir, config)
+        merge_all_files(tmp_dir, os.path.join(work_dir, f'{size}_lookup.csv'),
+                        config)
+        shutil.rmtree(tmp_dir)
+    index = open_guid_index(index_dir)
+    known = pc.unique(index.reader.read_all()['guid']).to_numpy(
+        zero_copy_only=False)
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(known, min(1000, len(known)), replace=False)
+    ids = lookup_guids(index, sample)['id']
+    data = index.reader.read_all()
+    scan = data.filter(pc.is_in(data['guid'], pa.array(sample)))['id']
+    assert sorted(ids.to_pylist()) == sorted(scan.to_pylist())
+    rows = []
+    for batch in batches:
+        n_batches = max(1, min_lookups // batch)
+        queries = known[rng.integers(0, len(known), batch * n_batches)]
+        misses = rng.random(len(queries)) < MISS_RATE
+        queries[misses] = [f'{x:032x}' for x in
+                           rng.integers(0, 2**63, misses.sum())]
+        n_rows = 0
+        t1 = time.perf_counter()
+        for start in range(0, len(queries), batch):
+            n_rows += len(lookup_guids(index, queries[start:start + batch]))
+        sec = time.perf_counter() - t1
+        rows.append({'batch': batch, 'lookups': len(queries),
+                     'rows': n_rows, 'sec': round(sec, 4),
+                     'lookups_per_sec': round(len(queries) / sec),
+                     'rows_per_sec': round(n_rows / sec)})
+    return pd.DataFrame(rows)
+
+
+def main() -> int:
+    """Run a benchmark named on the command line."""
+    if (len(sys.argv) < 2 or sys.argv[1] not in ['translit', 'pipeline',
+                                                  'compact', 'lookup']):
+        print('Usage: python -m GAR.benchmark translit [n_values]')
+        print('       python -m GAR.benchmark pipeline [work_dir] [sizes]')
+        print('       python -m GAR.benchmark compact [work_dir] [size]')
+        print('       python -m GAR.benchmark lookup [work_dir] [size]')
+        print(f'Sizes: comma separated, out of {", ".join(SIZES)}.')
+        return 1
+    if sys.argv[1] == 'lookup':
+        work_dir = sys.argv[2] if len(sys.argv) > 2 else 'gar_benchmark'
+        size = sys.argv[3] if len(sys.argv) > 3 else 'small'
+        report = bench_lookup(size, work_dir)
+        report.to_csv(os.path.join(work_dir, 'lookup.csv'), index=False)
+        logger.info(f'Lookup benchmark:\n{report.to_string(index=False)}')
+        return 0
+    if sys.argv[1] == 'compact':
+        work_dir = sys.argv[2] if len(sys.argv) > 2 else 'gar_benchmark'
+        size = sys.argv[3] if len(sys.argv) > 3 else 'small'
+        os.makedirs(work_dir, exist_ok=True)
+        zfn = os.path.join(work_dir, f'{size}_0_0.zip')
+        if not os.path.isfile(zfn):
+            make_archive(zfn, SIZES[size])
+        report = bench_compact(zfn, '77', work_dir)
+        logger.info(f'Compact types benchmark:\n'
+                    f'{report.to_string(index=False)}')
+        return 0
+    if sys.argv[1] == 'pipeline':
+        work_dir = sys.argv[2] if len(sys.argv) > 2 else 'gar_benchmark'
+        sizes = sys.argv[3].split(',') if len(sys.argv) > 3 else ['tiny',
+                                                                  'small']
+        report = bench_pipeline(sizes, work_dir)
+        report.to_csv(os.path.join(work_dir, 'pipeline.csv'), index=False)
+        logger.info(f'Pipeline benchmark:\n{report.to_string(index=False)}')
+        return 0
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10**6
+    report = bench_translit(n)
+    logger.info(f'translit_series benchmark:\n{report.to_string(index=False)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+GAR
+===
+
+Cache
+-----
+
+A submodule of the GAR package that keeps parsed region data on disk,
+so that a rerun (or a run on a new archive where the region has not
+changed) can skip XML parsing. A cache entry holds the four loaded
+DataFrames of a region in Feather format and is keyed by the types
+(names without the release date and id), CRC32 checksums and sizes of
+the region's zip members, as recorded in the zip central directory, and
+by the code of the row predicates applied while parsing. The cache is
+limited in size, least recently used entries are evicted first.
+"""
+
+from collections import namedtuple
+import hashlib
+import inspect
+import os
+import re
+import shutil
+from typing import Callable, Dict, List, Optional
+import uuid
+
+from loguru import logger
+import pandas as pd
+
+from GAR.file_utils import (ATTRS, TAGS, RowFilter, get_archive_index,
+                            load_all_data)
+
+
+CACHE_VERSION = 2
+FRAMES = ['hs', 'hp', 'mh', 'ao']
+# release date and id at the end of a member name
+RELEASE_SUFFIX = re.compile(r'_\d{8}_[^/]*$')
+
+
+def member_type(name: str) -> str:
+    """Strip the release date and id from a member name, e.g.
+    `01/AS_HOUSES_20230105_<guid>.XML` -> `01/AS_HOUSES`, so that the
+    same file of two releases has the same name.
+    """
+    return RELEASE_SUFFIX.sub('', name)
+
+
+def predicate_digest(check: Callable) -> str:
+    """Identify a row predicate by its source code and the values of the
+    module-level constants it reads (e.g. `filter_data.HOUSE_TYPES`),
+    so that editing either invalidates the entries filtered by it.
+    """
+    try:
+        source = inspect.getsource(check)
+    except (OSError, TypeError):
+        source = f'{check.__module__}.{check.__qualname__}'
+    code = getattr(check, '__code__', None)
+    names = code.co_names if code is not None else ()
+    scope = getattr(check, '__globals__', {})
+    values = [f'{x}={scope[x]!r}' for x in sorted(set(names))
+              if x in scope and isinstance(scope[x], (bool, int, float, str,
+                                                      list, tuple, set,
+                                                      frozenset, dict))]
+    text = '\n'.join([source] + values)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_key(zfn: str, region: str,
+              row_filters: Optional[Dict[str, RowFilter]] = None,
+              attrs: Optional[Dict[str, List[str]]] = None) -> str:
+    """Compute a cache key of a region from its zip members' types (see
+    `member_type`), CRC32 and sizes together with the loader settings
+    that affect the parsed result, including the code of the row
+    predicates (see `predicate_digest`).
+    """
+    members = get_archive_index(zfn)[region]
+    rf = {} if row_filters is None else row_filters
+    attrs = ATTRS if attrs is None else attrs
+    parts = [f'v{CACHE_VERSION}', region]
+    for key in FRAMES:
+        member = getattr(members, key)
+        checks = sorted(f'{attr}:{predicate_digest(f)}'
+                        for attr, f in rf.get(key, {}).items())
+        parts += [member_type(member.name), str(member.crc),
+                  str(member.size), TAGS[key], ','.join(attrs[key]),
+                  ','.join(checks)]
+    digest = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+    return f'{region}_{digest[:16]}'
+
+
+def entry_size(entry_dir: str) -> int:
+    """Compute the size of a cache entry on disk."""
+    fl = os.listdir(entry_dir)
+    return sum(os.path.getsize(os.path.join(entry_dir, x)) for x in fl)
+
+
+def list_entries(cache_dir: str) -> List[str]:
+    """List complete cache entries, least recently used first."""
+    fl = [os.path.join(cache_dir, x) for x in os.listdir(cache_dir)]
+    fl = [x for x in fl if os.path.isdir(x) and not x.endswith('.tmp')]
+    return sorted(fl, key=os.path.getmtime)
+
+
+def evict(cache_dir: str, max_bytes: int) -> None:
+    """Delete least recently used entries until the cache fits into
+    `max_bytes`.
+    """
+    entries = list_entries(cache_dir)
+    sizes = [entry_size(x) for x in entries]
+    total = sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        logger.trace(f'Cache entry {os.path.basename(entry)} evicted.')
+
+
+def load_cached_data(cache_dir: str, key: str) -> Optional[namedtuple]:
+    """Read a cache entry into a namedtuple of DataFrames or return None
+    if there is no such entry.
+    """
+    Data = namedtuple('Data', 'hs hp mh ao')
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    try:
+        frames = {x: pd.read_feather(os.path.join(entry, f'{x}.fea'))
+                  for x in FRAMES}
+    except (OSError, ValueError) as e:
+        logger.warning(f'Cache entry {key} is unreadable: {e}')
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+    os.utime(entry)
+    return Data(**frames)
+
+
+def store_cached_data(cache_dir: str, key: str, data: namedtuple) -> None:
+    """Write a namedtuple of DataFrames to a new cache entry. The entry
+    is written to a temporary directory first and then renamed, so that
+    concurrent workers never see a partial entry.
+    """
+    entry = os.path.join(cache_dir, key)
+    tmp = os.path.join(cache_dir, f'{key}_{uuid.uuid4().hex}.tmp')
+    os.makedirs(tmp)
+    for x in FRAMES:
+        getattr(data, x).to_feather(os.path.join(tmp, f'{x}.fea'))
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another worker has stored the same entry in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_all_data_cached(zfn: str, region: str, cache_dir: str,
+                         max_bytes: int,
+                         row_filters: Optional[Dict[str, RowFilter]] = None,
+                         attrs: Optional[Dict[str, List[str]]] = None,
+                         workers: int = 1, split_bytes: int = 0
+                         ) -> namedtuple:
+    """Load region data from the cache if it has an entry for the same
+    source files, otherwise parse it with `file_utils.load_all_data`
+    (in `workers` processes) and store the result.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(zfn, region, row_filters, attrs)
+    data = load_cached_data(cache_dir, key)
+    if data is not None:
+        logger.trace(f'Region {region} loaded from cache ({key}).')
+        return data
+    data = load_all_data(zfn, region, row_filters, attrs, workers,
+                         split_bytes)
+    store_cached_data(cache_dir, key, data)
+    evict(cache_dir, max_bytes)
+    return data
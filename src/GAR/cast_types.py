@@ -7,10 +7,15 @@ Cast types
 
 A submodule of the GAR package that contains functions that convert
 source data fields to proper types.
+
+The compact variants (`cast_types_compact`) give the same values in
+smaller types: 32-bit IDs, 8-bit types and levels and boolean flags.
+They do not copy the source frames either.
 """
 
 from collections import namedtuple
 
+import numpy as np
 import pandas as pd
 
 
@@ -48,8 +53,8 @@ def cast_types_ao(data: pd.DataFrame) -> pd.DataFrame:
     df = data.copy()
     assert df.loc[df.OBJECTID.isna()].empty
     df.OBJECTID = df.OBJECTID.astype(int)
-    df.NAME = df.NAME.fillna('').astype(str)
-    df.TYPENAME = df.TYPENAME.fillna('').astype(str)
+    df.NAME = df.NAME.fillna('').astype(str).astype('category')
+    df.TYPENAME = df.TYPENAME.fillna('').astype(str).astype('category')
     df.LEVEL = df.LEVEL.astype(int)
     df.ISACTIVE = df.ISACTIVE.astype(int)
     # next 3 are for debug
@@ -82,3 +87,85 @@ def cast_types(data: namedtuple) -> namedtuple:
         ao=cast_types_ao(data.ao)
     )
     return cast
+
+
+def compact_id(values: pd.Series) -> pd.Series:
+    """Cast an ID column to int32, or to int64 if some of its values do
+    not fit.
+    """
+    ids = values.astype(np.int64)
+    limits = np.iinfo(np.int32)
+    if len(ids) and (ids.min() < limits.min or ids.max() > limits.max):
+        return ids
+    return ids.astype(np.int32)
+
+
+def compact_flag(values: pd.Series) -> pd.Series:
+    """Cast a flag column to bool (a missing flag is False)."""
+    return values.fillna(0).astype(np.int8) == 1
+
+
+def cast_types_hs_compact(data: pd.DataFrame) -> pd.DataFrame:
+    """Cast houses DataFrame columns to compact types."""
+    assert data.loc[data.OBJECTID.isna()].empty
+    assert data.loc[data.OBJECTGUID.isna()].empty
+    guid_len = data.OBJECTGUID.str.len()
+    assert guid_len.min() == guid_len.max() == 36
+    addtype = data.ADDTYPE1.fillna(0).astype(np.int8)
+    return data.assign(
+        OBJECTID=compact_id(data.OBJECTID),
+        OBJECTGUID=data.OBJECTGUID.astype(str),
+        HOUSENUM=data.HOUSENUM.fillna('').astype(str),
+        ADDNUM1=data.ADDNUM1.fillna('').astype(str),
+        ADDNUM2=data.ADDNUM2.fillna('').astype(str),
+        HOUSETYPE=data.HOUSETYPE.fillna(0).astype(np.int8),
+        ADDTYPE1=addtype, ADDTYPE2=addtype,
+        ISACTIVE=compact_flag(data.ISACTIVE))
+
+
+def cast_types_hp_compact(data: pd.DataFrame) -> pd.DataFrame:
+    """Cast house_params DataFrame columns to compact types."""
+    assert data.loc[data.OBJECTID.isna()].empty
+    return data.assign(
+        OBJECTID=compact_id(data.OBJECTID),
+        CHANGEIDEND=compact_id(data.CHANGEIDEND),
+        TYPEID=data.TYPEID.astype(np.int8),
+        VALUE=data.VALUE.fillna('').astype(str))
+
+
+def cast_types_ao_compact(data: pd.DataFrame) -> pd.DataFrame:
+    """Cast addr_obj DataFrame columns to compact types."""
+    assert data.loc[data.OBJECTID.isna()].empty
+    return data.assign(
+        OBJECTID=compact_id(data.OBJECTID),
+        NAME=data.NAME.fillna('').astype(str).astype('category'),
+        TYPENAME=data.TYPENAME.fillna('').astype(str).astype('category'),
+        LEVEL=data.LEVEL.astype(np.int8),
+        ISACTIVE=compact_flag(data.ISACTIVE),
+        ISACTUAL=compact_flag(data.ISACTUAL),
+        NEXTID=compact_id(data.NEXTID.fillna(0)),
+        ENDDATE=data.ENDDATE.fillna('').astype(str))
+
+
+def cast_types_mh_compact(data: pd.DataFrame) -> pd.DataFrame:
+    """Cast muni_hierarchy DataFrame columns to compact types."""
+    assert data.loc[data.OBJECTID.isna()].empty
+    return data.assign(
+        OBJECTID=compact_id(data.OBJECTID),
+        PARENTOBJID=compact_id(data.PARENTOBJID.fillna(0)),
+        OKTMO=data.OKTMO.fillna('').astype(str),
+        ISACTIVE=compact_flag(data.ISACTIVE),
+        NEXTID=compact_id(data.NEXTID.fillna(0)),
+        ENDDATE=data.ENDDATE.fillna('').astype(str))
+
+
+def cast_types_compact(data: namedtuple) -> namedtuple:
+    """Cast columns to compact types in all four source DataFrames."""
+    Data = namedtuple('Data', 'hs hp mh ao')
+    cast = Data(
+        hs=cast_types_hs_compact(data.hs),
+        hp=cast_types_hp_compact(data.hp),
+        mh=cast_types_mh_compact(data.mh),
+        ao=cast_types_ao_compact(data.ao)
+    )
+    return cast
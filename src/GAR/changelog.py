@@ -6,63 +6,372 @@ Changelog
 ---------
 
 Compute a change log between two GAR files.
+
+Both files are read with the pyarrow CSV reader and split into buckets
+by GUID prefix (16 one-character or 256 two-character prefixes) in a
+single pass each. Bucket pairs are compared independently, optionally
+in a pool of worker processes, and every finished bucket is appended to
+the change log file as soon as the buckets before it are written, so
+that the file is the same for any number of workers.
+
+In hashed mode buckets hold 64/128-bit hashes of the lines and their
+row numbers, and the byte offset of every row is saved next to them
+(`offsets.bin`, little-endian uint64, the file size last), so that the
+text of the changed lines is read by seeking in the CSV files.
+
+The hashed buckets of the current file are kept next to it as a
+snapshot (`<file>.snapshot` directory), so that the next run can
+compare against them without parsing the file again. A snapshot holds
+no text: the text of changed lines is read from the previous CSV file,
+which the snapshot is only valid for as long as it is unchanged.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import io
+from itertools import product
+import json
 import os
+import shutil
+import time
+from typing import (BinaryIO, Iterable, Iterator, List, Optional, TextIO,
+                    Tuple, Union)
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 
+from GAR.config import Config, get_config
+from GAR.metrics import measure, save_metrics
 
-def disassemble_file(fias_fn: str, parts_dir: str) -> None:
-    """Split a FIAS CSV file into parts."""
-    print(f'Disassembling {fias_fn}:')
-    cols = [
-        'guid', 'current', 'postalcode', 'housenum', 'buildnum', 'strucnum',
-        'street_s', 'street_f', 'terr_s', 'terr_f', 'place_s', 'place_f',
-        'city_s', 'city_f', 'muni_s', 'muni_f', 'munr_s', 'munr_f',
-        'region_s', 'region_f'
-    ]
-    addr_cols = [x for x in cols if x not in ['guid', 'current', 'postalcode']]
+
+HEX = '0123456789abcdef'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_META = 'meta.json'
+OFFSETS_FILE = 'offsets.bin'
+BUCKET_COLUMNS = ['guid', 'current', 'postalcode', 'addr']
+KEY_COLUMNS = ['guid', 'current', 'postalcode']
+HASH_COLUMNS = ['key_hi', 'key_lo', 'addr', 'row']
+HASH_KEYS = ('0123456789abcdef', 'fedcba9876543210')
+FIAS_COLUMNS = [
+    'guid', 'current', 'postalcode', 'housenum', 'buildnum', 'strucnum',
+    'street_s', 'street_f', 'terr_s', 'terr_f', 'place_s', 'place_f',
+    'city_s', 'city_f', 'muni_s', 'muni_f', 'munr_s', 'munr_f',
+    'region_s', 'region_f'
+]
+ADDR_COLUMNS = FIAS_COLUMNS[3:]
+SEPARATOR = '¬'.encode('utf-8')
+FAST_SEPARATOR = b'\x1f'
+READ_BLOCK = 2**24
+# missing value markers of pandas.read_csv
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+             '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN',
+             'None', 'n/a', 'nan', 'null']
+
+
+def bucket_prefixes(prefix_len: int = 1) -> List[str]:
+    """List GUID prefixes of change log buckets: all hex strings of
+    `prefix_len` characters.
+    """
+    return [''.join(x) for x in product(HEX, repeat=prefix_len)]
+
+
+def bucket_codes(guid: np.ndarray, prefix_len: int = 1) -> np.ndarray:
+    """Compute the bucket number of every GUID from its first
+    `prefix_len` characters (the position of the prefix in
+    `bucket_prefixes`), -1 if they are not lower case hex digits.
+    """
+    chars = np.asarray(guid, dtype=str).astype(f'U{prefix_len}')
+    cp = chars.view(np.uint32).reshape(len(chars), prefix_len)
+    digits = np.full(128, -1, dtype=np.int64)
+    digits[[ord(x) for x in HEX]] = np.arange(len(HEX))
+    values = digits[np.minimum(cp, 127)]
+    codes = np.zeros(len(chars), dtype=np.int64)
+    for i in range(prefix_len):
+        codes = codes * len(HEX) + values[:, i]
+    return np.where((values < 0).any(axis=1), -1, codes)
+
+
+class SeparatorStream(io.RawIOBase):
+    """A binary stream over an open FIAS CSV file that replaces the
+    two-byte UTF-8 separator `¬` with the single byte `FAST_SEPARATOR`,
+    so that a C CSV parser can read it. Raises ValueError if the file
+    already contains `FAST_SEPARATOR`.
+    """
+
+    def __init__(self, fh: BinaryIO) -> None:
+        super().__init__()
+        self.fh = fh
+        self.tail = b''
+        self.data = b''
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def fill(self) -> bool:
+        """Read and convert the next block, return False at the end."""
+        data = self.fh.read(READ_BLOCK)
+        if data:
+            data = self.tail + data
+            # keep a split separator for the next block
+            cut = len(data) - 1 if data.endswith(SEPARATOR[:1]) else len(data)
+            data, self.tail = data[:cut], data[cut:]
+        else:
+            data, self.tail = self.tail, b''
+        if FAST_SEPARATOR in data:
+            raise ValueError('Fast separator character found in the file.')
+        self.data = data.replace(SEPARATOR, FAST_SEPARATOR)
+        self.pos = 0
+        return bool(data) or bool(self.tail)
+
+    def readinto(self, buf) -> int:
+        while self.pos == len(self.data):
+            if not self.fill():
+                return 0
+        n = min(len(buf), len(self.data) - self.pos)
+        buf[:n] = memoryview(self.data)[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def read_fias_fast(fias_fn: Union[str, BinaryIO]) -> Iterator[pa.Table]:
+    """Read the FIAS CSV columns used by the change log (from a file
+    name or a binary stream) in batches with the pyarrow CSV reader,
+    with the same result as `read_fias_python`: all columns are
+    strings, pandas' default missing value markers become empty
+    strings.
+    """
+    read_options = pacsv.ReadOptions(block_size=READ_BLOCK)
+    parse_options = pacsv.ParseOptions(delimiter=FAST_SEPARATOR.decode(),
+                                       newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(
+        include_columns=FIAS_COLUMNS,
+        column_types={x: pa.string() for x in FIAS_COLUMNS},
+        null_values=NA_VALUES, strings_can_be_null=True)
+    fh = open(fias_fn, 'rb') if isinstance(fias_fn, str) else fias_fn
+    with fh:
+        stream = io.BufferedReader(SeparatorStream(fh), READ_BLOCK)
+        reader = pacsv.open_csv(stream, read_options=read_options,
+                                parse_options=parse_options,
+                                convert_options=convert_options)
+        for batch in reader:
+            columns = []
+            for x in FIAS_COLUMNS:
+                col = pc.fill_null(batch.column(x), '')
+                # separators inside quoted values
+                col = pc.replace_substring(col, FAST_SEPARATOR.decode(), '¬')
+                columns.append(col)
+            yield pa.Table.from_arrays(columns, names=FIAS_COLUMNS)
+
+
+def read_fias_python(fias_fn: Union[str, BinaryIO]
+                     ) -> Iterator[pa.Table]:
+    """Read the FIAS CSV columns used by the change log (from a file
+    name or a binary stream) in batches with the python engine of
+    pandas.
+    """
     attrs = {
         'filepath_or_buffer': fias_fn,
         'sep': '¬',
         'engine': 'python',
-        'usecols': cols,
+        'usecols': FIAS_COLUMNS,
         'chunksize': 10**6,
         'dtype': 'str'
     }
-    os.makedirs(parts_dir, exist_ok=True)
-    pr = pd.read_csv(**attrs)
-    all_hex = '0123456789abcdef'
-    for bidx, batch in enumerate(pr):
-        print(bidx, end=' ', flush=True)
-        b = batch.fillna('')
-        b['addr'] = ''
-        b.addr = b.fillna('').addr.str.cat(b[addr_cols], sep='-').str[1:]
-        b.drop(addr_cols, axis=1, inplace=True)
-        for hex_prefix in all_hex:
-            p = b.loc[b.guid.str.startswith(hex_prefix)]
-            fn = f'{hex_prefix}_{str(bidx).zfill(2)}.fea'
-            p.reset_index(drop=True).to_feather(os.path.join(parts_dir, fn))
-    print('Done.')
-
-
-def assemble_by_prefix(parts_dir: str, save_dir: str) -> None:
-    """Assemble FIAS parts by prefix."""
-    print(f'Re-assembling from {parts_dir} to {save_dir}:')
+    schema = pa.schema([(x, pa.string()) for x in FIAS_COLUMNS])
+    for batch in pd.read_csv(**attrs):
+        b = batch.fillna('')[FIAS_COLUMNS]
+        yield pa.Table.from_pandas(b, schema=schema, preserve_index=False)
+
+
+def text_bucket_table(batch: pa.Table, first_row: int) -> pa.Table:
+    """Compile bucket rows of a FIAS batch: the merge key columns and
+    the address joined into a single `addr` string.
+    """
+    addr = pc.binary_join_element_wise(*[batch[x] for x in ADDR_COLUMNS],
+                                       '-')
+    return pa.Table.from_arrays(
+        [batch['guid'], batch['current'], batch['postalcode'], addr],
+        names=BUCKET_COLUMNS)
+
+
+def hash_strings(values: np.ndarray, hash_key: str) -> np.ndarray:
+    """Hash an array of strings to uint64."""
+    return pd.util.hash_array(values, hash_key=hash_key)
+
+
+def hash_bucket_table(batch: pa.Table, first_row: int) -> pa.Table:
+    """Compile hashed bucket rows of a FIAS batch: a 128-bit hash of the
+    merge key (`key_hi`, `key_lo`), a 64-bit hash of the joined address
+    (`addr`) and the row number in the file (`row`).
+    """
+    key = batch.select(KEY_COLUMNS).to_pandas()
+    addr = text_bucket_table(batch, first_row)['addr'].to_numpy()
+    columns = {
+        'key_hi': pd.util.hash_pandas_object(key, index=False,
+                                             hash_key=HASH_KEYS[0]).to_numpy(),
+        'key_lo': pd.util.hash_pandas_object(key, index=False,
+                                             hash_key=HASH_KEYS[1]).to_numpy(),
+        'addr': hash_strings(addr, HASH_KEYS[0]),
+        'row': np.arange(first_row, first_row + batch.num_rows,
+                         dtype=np.uint64)
+    }
+    return pa.Table.from_pydict(columns)
+
+
+def partition_tables(tables: Iterable[pa.Table], save_dir: str,
+                     prefixes: List[str], hashed: bool = False) -> int:
+    """Partition batches of a FIAS file into buckets by GUID prefix in a
+    single pass per batch and append them to per-bucket streaming Arrow
+    IPC (Feather) writers. Buckets hold text rows (see
+    `text_bucket_table`) or, if `hashed`, hashed rows (see
+    `hash_bucket_table`). Return the number of rows.
+    """
+    prefix_len = len(prefixes[0])
+    if hashed:
+        make_table = hash_bucket_table
+        schema = pa.schema([(x, pa.uint64()) for x in HASH_COLUMNS])
+    else:
+        make_table = text_bucket_table
+        schema = pa.schema([(x, pa.string()) for x in BUCKET_COLUMNS])
+    writers = [pa.ipc.new_file(os.path.join(save_dir, f'{x}.fea'), schema)
+               for x in prefixes]
+    n_rows = 0
+    try:
+        for bidx, batch in enumerate(tables):
+            print(bidx, end=' ', flush=True)
+            table = make_table(batch, n_rows)
+            codes = bucket_codes(batch['guid'].to_numpy(), prefix_len)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order],
+                                     np.arange(len(prefixes) + 1))
+            table = table.take(order)
+            for i, writer in enumerate(writers):
+                part = table.slice(bounds[i], bounds[i + 1] - bounds[i])
+                if part.num_rows:
+                    writer.write_table(part)
+            n_rows += table.num_rows
+    finally:
+        for writer in writers:
+            writer.close()
+    return n_rows
+
+
+def save_row_offsets(fias_fn: str, offsets_fn: str) -> int:
+    """Find the byte offset of every row of a FIAS CSV file and save
+    them (with the file size at the end) to `offsets_fn`, see
+    `OFFSETS_FILE`. Rows start after line breaks outside quoted values;
+    the header and empty lines are skipped, as the CSV readers do.
+    Return the number of rows.
+    """
+    quoted = False
+    pos = 0
+    pending = np.zeros(0, dtype='<u8')
+    n_rows = 0
+    with open(fias_fn, 'rb') as fh, open(offsets_fn, 'wb') as out:
+        while True:
+            block = fh.read(READ_BLOCK)
+            if not block:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            inside = np.logical_xor.accumulate(data == ord('"')) ^ quoted
+            starts = np.flatnonzero((data == ord('\n')) & ~inside) + 1 + pos
+            starts = np.concatenate([pending, starts.astype('<u8')])
+            # a start followed by a line break is an empty line
+            rows = starts[:-1][np.diff(starts) != 1]
+            out.write(rows.tobytes())
+            n_rows += len(rows)
+            pending = starts[-1:]
+            quoted = bool(inside[-1])
+            pos += len(block)
+        rows = pending[pending < pos]
+        out.write(rows.tobytes())
+        out.write(np.array([pos], dtype='<u8').tobytes())
+    return n_rows + len(rows)
+
+
+def disassemble_file(fias_fn: str, save_dir: str,
+                     prefixes: Optional[List[str]] = None,
+                     hashed: bool = False) -> int:
+    """Split a FIAS CSV file into buckets by GUID prefix (see
+    `partition_tables`) and return the number of rows. The file is read
+    with the pyarrow CSV reader, or with the python engine of pandas if
+    the fast reader cannot parse it. Hashed buckets get the row offsets
+    of the file (see `save_row_offsets`), unless they do not match the
+    rows read.
+    """
+    print(f'Disassembling {fias_fn}:')
     os.makedirs(save_dir, exist_ok=True)
-    fl = os.listdir(parts_dir)
-    fl = sorted([x for x in fl if x.endswith('.fea')])
-    all_hex = '0123456789abcdef'
-    for hex_prefix in all_hex:
-        fl_hex = [x for x in fl if x.startswith(hex_prefix)]
-        fl_full = [os.path.join(parts_dir, x) for x in fl_hex]
-        data = [pd.read_feather(x) for x in fl_full]
-        cdata = pd.concat(data, ignore_index=True)
-        filename = os.path.join(save_dir, f'{hex_prefix}.fea')
-        cdata.to_feather(filename)
-        print(hex_prefix, end=' ', flush=True)
-    print('Done.')
+    prefixes = bucket_prefixes() if prefixes is None else prefixes
+    t1 = time.perf_counter()
+    try:
+        n_rows = partition_tables(read_fias_fast(fias_fn), save_dir,
+                                  prefixes, hashed)
+    except ValueError as e:
+        print(f'Fast reader failed ({e}), using the python engine:')
+        t1 = time.perf_counter()
+        n_rows = partition_tables(read_fias_python(fias_fn), save_dir,
+                                  prefixes, hashed)
+    if hashed:
+        offsets_fn = os.path.join(save_dir, OFFSETS_FILE)
+        if save_row_offsets(fias_fn, offsets_fn) != n_rows:
+            print('Row offsets do not match the rows read, not saved.')
+            os.remove(offsets_fn)
+    t = time.perf_counter() - t1
+    mb = os.path.getsize(fias_fn) / 2**20
+    print(f'Done: {n_rows} rows in {round(t, 2)} sec., '
+          f'{round(n_rows / max(t, 1e-9))} rows/sec., '
+          f'{round(mb / max(t, 1e-9), 1)} MB/sec.')
+    return n_rows
+
+
+def snapshot_dir(fias_fn: str) -> str:
+    """Compute the directory name of the snapshot of a FIAS CSV file."""
+    return f'{os.path.splitext(fias_fn)[0]}.snapshot'
+
+
+def snapshot_meta(fias_fn: str, prefixes: List[str]) -> dict:
+    """Describe a snapshot: its format and the CSV file it was made
+    from.
+    """
+    stat = os.stat(fias_fn)
+    return {'version': SNAPSHOT_VERSION, 'prefix_len': len(prefixes[0]),
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def find_snapshot(fias_fn: str, prefixes: List[str]) -> Optional[str]:
+    """Return the snapshot directory of a FIAS CSV file, or None if
+    there is no snapshot with the required format or it was made from a
+    different file (the snapshot points into the file, see
+    `OFFSETS_FILE`).
+    """
+    meta_fn = os.path.join(snapshot_dir(fias_fn), SNAPSHOT_META)
+    if not os.path.isfile(meta_fn):
+        return None
+    with open(meta_fn, encoding='utf-8') as fh:
+        meta = json.load(fh)
+    if meta != snapshot_meta(fias_fn, prefixes):
+        return None
+    return snapshot_dir(fias_fn)
+
+
+def make_snapshot(fias_fn: str, prefixes: List[str]) -> int:
+    """Disassemble a FIAS CSV file into a snapshot next to it (see
+    `snapshot_dir`): hashed bucket files and the row offsets of the
+    file. An older snapshot is replaced. Return the number of rows.
+    """
+    save_dir = snapshot_dir(fias_fn)
+    tmp_dir = f'{save_dir}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    n_rows = disassemble_file(fias_fn, tmp_dir, prefixes, hashed=True)
+    with open(os.path.join(tmp_dir, SNAPSHOT_META), 'w',
+              encoding='utf-8') as fh:
+        json.dump(snapshot_meta(fias_fn, prefixes), fh)
+    shutil.rmtree(save_dir, ignore_errors=True)
+    os.rename(tmp_dir, save_dir)
+    return n_rows
 
 
 def compare_two_prefixes(fn1: str, fn2: str) -> pd.DataFrame:
@@ -71,6 +380,11 @@ def compare_two_prefixes(fn1: str, fn2: str) -> pd.DataFrame:
     been changed."""
     df1 = pd.read_feather(fn1)
     df2 = pd.read_feather(fn2)
+    return compare_frames(df1, df2)
+
+
+def compare_frames(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
+    """Compare two sets of text bucket rows (see `compare_two_prefixes`)."""
     dfm = pd.merge(df1, df2, how='outer', on=['guid', 'current', 'postalcode'])
     dfm['status'] = ''
     dfm.loc[dfm.addr_x.isna(), 'status'] = 'new address'
@@ -85,29 +399,220 @@ def compare_two_prefixes(fn1: str, fn2: str) -> pd.DataFrame:
     return chlog
 
 
-def compute_all_changes(pref1_dir: str, pref2_dir: str, save_dir: str) -> None:
-    """Compute change logs for every prefixed file pair."""
-    os.makedirs(save_dir, exist_ok=True)
-    all_hex = '0123456789abcdef'
-    for hex_prefix in all_hex:
-        fn1 = os.path.join(pref1_dir, f'{hex_prefix}.fea')
-        fn2 = os.path.join(pref2_dir, f'{hex_prefix}.fea')
-        chlog = compare_two_prefixes(fn1, fn2)
-        chlog_fn = os.path.join(save_dir, f'chlog_{hex_prefix}.fea')
-        chlog.reset_index(drop=True).to_feather(chlog_fn)
-        print(hex_prefix, end=' ', flush=True)
-    print('Done.')
-
-
-def merge_a_changelog(chlog_parts_dir: str, save_fn: str) -> None:
-    """Merge all change log parts into a single deliverable file."""
-    fl = os.listdir(chlog_parts_dir)
-    fl = [x for x in fl if x.endswith('.fea')]
-    full_fl = [os.path.join(chlog_parts_dir, x) for x in fl]
-    data = [pd.read_feather(x) for x in full_fl]
-    full_chlog = pd.concat(data, ignore_index=True)
-    full_chlog.to_csv(save_fn, sep='¬', index=False)
-    print(f'Saved to {save_fn}.')
+def compare_hashed_prefixes(fn1: str, fn2: str) -> pd.DataFrame:
+    """Merge two hashed datasets together by key hash and add status to
+    each changed line (see `compare_two_prefixes`). Lines are returned
+    as row numbers in the previous (`row_prev`) and current
+    (`row_curr`) file, missing on the side where the line is absent.
+    """
+    df1 = pd.read_feather(fn1).astype({'addr': 'UInt64', 'row': 'Int64'})
+    df2 = pd.read_feather(fn2).astype({'addr': 'UInt64', 'row': 'Int64'})
+    dfm = pd.merge(df1, df2, how='outer', on=['key_hi', 'key_lo'])
+    dfm['status'] = ''
+    dfm.loc[dfm.addr_x.isna(), 'status'] = 'new address'
+    dfm.loc[dfm.addr_y.isna(), 'status'] = 'deleted'
+    changed = dfm.addr_x.notna() & dfm.addr_y.notna()
+    dfm.loc[changed & (dfm.addr_x == dfm.addr_y), 'status'] = 'no change'
+    dfm.loc[changed & (dfm.addr_x != dfm.addr_y),
+            'status'] = 'address names changed'
+    dfm.rename(columns={'row_x': 'row_prev', 'row_y': 'row_curr'},
+               inplace=True)
+    chlog = dfm.loc[dfm.status != 'no change',
+                    ['row_prev', 'row_curr', 'status']]
+    return chlog.reset_index(drop=True)
+
+
+def compare_bucket(pref1_dir: str, pref2_dir: str, hex_prefix: str,
+                   hashed: bool = False) -> pd.DataFrame:
+    """Compute the change log of a single bucket pair."""
+    fn1 = os.path.join(pref1_dir, f'{hex_prefix}.fea')
+    fn2 = os.path.join(pref2_dir, f'{hex_prefix}.fea')
+    if hashed:
+        return compare_hashed_prefixes(fn1, fn2)
+    return compare_two_prefixes(fn1, fn2)
+
+
+def compare_all_buckets(pref1_dir: str, pref2_dir: str,
+                        prefixes: List[str], workers: int = 1,
+                        hashed: bool = False) -> Iterator[pd.DataFrame]:
+    """Compare every prefixed file pair (in a pool of `workers`
+    processes if it is more than 1) and yield bucket change logs in
+    prefix order, so that the change log does not depend on the number
+    of workers. A bucket is yielded as soon as it and all buckets before
+    it are finished.
+    """
+    if workers == 1:
+        for x in prefixes:
+            yield compare_bucket(pref1_dir, pref2_dir, x, hashed)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(compare_bucket, pref1_dir, pref2_dir, x,
+                               hashed) for x in prefixes]
+        for future in futures:
+            yield future.result()
+
+
+def write_changelog(fh: TextIO, chlogs: Iterable[pd.DataFrame]) -> int:
+    """Write change log parts to an open file as they arrive, with a
+    header before the first one. Return the number of lines written.
+    """
+    header = True
+    n_rows = 0
+    for chlog in chlogs:
+        chlog.to_csv(fh, sep='¬', index=False, header=header)
+        header = False
+        n_rows += len(chlog)
+        print('.', end='', flush=True)
+    return n_rows
+
+
+def compute_all_changes(pref1_dir: str, pref2_dir: str, save_fn: str,
+                        prefixes: Optional[List[str]] = None,
+                        workers: int = 1) -> int:
+    """Compute change logs for every prefixed file pair (in a pool of
+    `workers` processes if it is more than 1) and write them to a
+    single deliverable file in prefix order. Return the number of
+    changes.
+    """
+    prefixes = bucket_prefixes() if prefixes is None else prefixes
+    with open(save_fn, 'w', encoding='utf-8', newline='') as fh:
+        n_rows = write_changelog(fh, compare_all_buckets(
+            pref1_dir, pref2_dir, prefixes, workers))
+    print(f' Saved to {save_fn}.')
+    return n_rows
+
+
+def select_rows(tables: Iterable[pa.Table], rows: np.ndarray) -> pa.Table:
+    """Select rows with the given sorted row numbers from batches of
+    text bucket rows, adding a `row` column.
+    """
+    parts = []
+    first_row = 0
+    for batch in tables:
+        lo, hi = np.searchsorted(rows, [first_row, first_row + batch.num_rows])
+        if hi > lo:
+            part = batch.take(rows[lo:hi] - first_row)
+            parts.append(part.append_column('row', pa.array(rows[lo:hi])))
+        first_row += batch.num_rows
+    schema = pa.schema([(x, pa.string()) for x in BUCKET_COLUMNS] +
+                       [('row', pa.int64())])
+    return pa.concat_tables([x.cast(schema) for x in parts] or
+                            [schema.empty_table()])
+
+
+def read_fias_tables(fias_fn: Union[str, BinaryIO]) -> List[pa.Table]:
+    """Read a whole FIAS CSV file (or a binary stream) into text bucket
+    rows, with the python engine of pandas if the fast reader cannot
+    parse it.
+    """
+    data = fias_fn.getvalue() if isinstance(fias_fn, io.BytesIO) else None
+    try:
+        return [text_bucket_table(x, 0) for x in read_fias_fast(fias_fn)]
+    except ValueError:
+        source = fias_fn if data is None else io.BytesIO(data)
+        return [text_bucket_table(x, 0) for x in read_fias_python(source)]
+
+
+def read_rows_at(fias_fn: str, rows: np.ndarray,
+                 offsets_fn: str) -> Optional[pa.Table]:
+    """Read the lines of a FIAS CSV file with the given sorted row
+    numbers by seeking to their byte offsets (see `save_row_offsets`):
+    runs of consecutive rows are read in one piece and parsed together
+    with the header. Return text bucket rows with a `row` column, or
+    None if the pieces do not parse into the requested rows.
+    """
+    offsets = np.memmap(offsets_fn, dtype='<u8', mode='r')
+    runs = np.flatnonzero(np.diff(rows, prepend=-2) != 1)
+    ends = np.append(runs[1:], len(rows))
+    buf = io.BytesIO()
+    with open(fias_fn, 'rb') as fh:
+        buf.write(fh.read(int(offsets[0])))
+        for lo, hi in zip(runs, ends):
+            start = int(offsets[rows[lo]])
+            fh.seek(start)
+            piece = fh.read(int(offsets[rows[hi - 1] + 1]) - start)
+            if not piece.endswith(b'\n'):
+                piece += b'\n'
+            buf.write(piece)
+    buf.seek(0)
+    tables = read_fias_tables(buf)
+    if sum(x.num_rows for x in tables) != len(rows):
+        return None
+    table = select_rows(tables, np.arange(len(rows)))
+    return table.set_column(table.schema.get_field_index('row'), 'row',
+                            pa.array(rows))
+
+
+def fetch_rows(fias_fn: str, rows: np.ndarray,
+               offsets_fn: Optional[str] = None) -> pd.DataFrame:
+    """Read text bucket rows with the given row numbers, indexed by row
+    number, from a FIAS CSV file: by their byte offsets if `offsets_fn`
+    exists, otherwise by reading the whole file.
+    """
+    rows = np.unique(rows).astype(np.int64)
+    table = select_rows([], rows) if not len(rows) else None
+    if table is None and offsets_fn is not None and \
+            os.path.isfile(offsets_fn):
+        table = read_rows_at(fias_fn, rows, offsets_fn)
+        if table is None:
+            print('Row offsets do not match the file, reading all of it.')
+    if table is None:
+        table = select_rows(read_fias_tables(fias_fn), rows)
+    return table.to_pandas().set_index('row')
+
+
+def compute_hashed_changes(pref1_dir: str, pref2_dir: str, fias_fn1: str,
+                           fias_fn2: str, save_fn: str,
+                           prefixes: Optional[List[str]] = None,
+                           workers: int = 1,
+                           offsets_fns: Tuple[Optional[str], ...] = (None,
+                                                                     None)
+                           ) -> int:
+    """Compute change logs for every hashed prefixed file pair, read the
+    text of the changed lines only from the FIAS files (see
+    `changelog_text`) and write them to a single deliverable file, the
+    same as `compute_all_changes` writes. Buckets are read and written
+    one at a time if both files have row offsets (`offsets_fns`),
+    otherwise the text of all buckets is read in one pass over each
+    file. Return the number of changes.
+    """
+    prefixes = bucket_prefixes() if prefixes is None else prefixes
+    chlogs = compare_all_buckets(pref1_dir, pref2_dir, prefixes, workers,
+                                 hashed=True)
+    if not all(x is not None and os.path.isfile(x) for x in offsets_fns):
+        print(' No row offsets, reading the text of all buckets at once:')
+        chlogs = [pd.concat(list(chlogs), ignore_index=True)]
+    with open(save_fn, 'w', encoding='utf-8', newline='') as fh:
+        n_rows = write_changelog(fh, (
+            changelog_text(x, fias_fn1, fias_fn2, offsets_fns)
+            for x in chlogs))
+    print(f' Saved to {save_fn}.')
+    return n_rows
+
+
+def changelog_text(chlog: pd.DataFrame, fias_fn1: str, fias_fn2: str,
+                   offsets_fns: Tuple[Optional[str], ...]) -> pd.DataFrame:
+    """Read the text of the lines of a hashed change log (see
+    `compare_hashed_prefixes`) from the FIAS files (see `fetch_rows`)
+    and order them by key, as `compare_frames` does.
+    """
+    prev = fetch_rows(fias_fn1, chlog.row_prev.dropna().to_numpy(),
+                      offsets_fns[0])
+    curr = fetch_rows(fias_fn2, chlog.row_curr.dropna().to_numpy(),
+                      offsets_fns[1])
+    is_prev = chlog.row_curr.isna().to_numpy()
+    row_prev = chlog.row_prev.fillna(-1).to_numpy(dtype=np.int64)
+    row_curr = chlog.row_curr.fillna(-1).to_numpy(dtype=np.int64)
+    prev = prev.reindex(row_prev)
+    curr = curr.reindex(row_curr)
+    res = pd.DataFrame({
+        x: np.where(is_prev, prev[x].to_numpy(dtype=object),
+                    curr[x].to_numpy(dtype=object))
+        for x in KEY_COLUMNS})
+    res['addr_prev'] = prev.addr.to_numpy(dtype=object)
+    res['addr_curr'] = curr.addr.to_numpy(dtype=object)
+    res['status'] = chlog.status.to_numpy(dtype=object)
+    return res.sort_values(KEY_COLUMNS, kind='stable', ignore_index=True)
 
 
 def compute_changelog_fn(pcsv: str, dcsv: str) -> str:
@@ -128,24 +633,54 @@ def delete_dir(dir_name: str) -> None:
     return None
 
 
-def make_changelog(fias_fn1: str, fias_fn2: str, temp_dir: str) -> None:
-    """Create a change log CSV file given two source FIAS CSV files."""
+def make_changelog(fias_fn1: str, fias_fn2: str, temp_dir: str,
+                   config: Optional[Config] = None) -> None:
+    """Create a change log CSV file given two source FIAS CSV files. The
+    previous file is read from its snapshot if there is a valid one. A
+    snapshot of the current file is saved for the next run if
+    `config.snapshot` is set. Snapshots are hashed, so lines are
+    compared by hashes if either `config.snapshot` or
+    `config.chlog_hash` is set. Stage metrics are saved to
+    `config.metrics_dir` if it is set.
+    """
+    config = get_config() if config is None else config
+    prefixes = bucket_prefixes(config.chlog_prefix)
+    hashed = config.chlog_hash or config.snapshot
     os.makedirs(temp_dir, exist_ok=True)
-    p1dir = os.path.join(temp_dir, 'parts_1')
-    p2dir = os.path.join(temp_dir, 'parts_2')
-    h1dir = os.path.join(temp_dir, 'hex_1')
-    h2dir = os.path.join(temp_dir, 'hex_2')
-    chdir = os.path.join(temp_dir, 'chlogparts')
     save_fn = compute_changelog_fn(fias_fn1, fias_fn2)
-    disassemble_file(fias_fn1, p1dir)
-    disassemble_file(fias_fn2, p2dir)
-    assemble_by_prefix(p1dir, h1dir)
-    assemble_by_prefix(p2dir, h2dir)
-    delete_dir(p1dir)
-    delete_dir(p2dir)
-    compute_all_changes(h1dir, h2dir, chdir)
-    delete_dir(h1dir)
-    delete_dir(h2dir)
-    merge_a_changelog(chdir, save_fn)
-    delete_dir(chdir)
+    temp_dirs = []
+    records = []
+    with measure(records, 'read_prev', config=config) as m:
+        h1dir = find_snapshot(fias_fn1, prefixes) if hashed else None
+        if h1dir is None:
+            h1dir = os.path.join(temp_dir, 'hex_1')
+            temp_dirs.append(h1dir)
+            m['rows_out'] = disassemble_file(fias_fn1, h1dir, prefixes,
+                                             hashed)
+        else:
+            print(f'Using snapshot {h1dir}.')
+    with measure(records, 'read_curr', config=config) as m:
+        if config.snapshot:
+            h2dir = snapshot_dir(fias_fn2)
+            m['rows_out'] = make_snapshot(fias_fn2, prefixes)
+        else:
+            h2dir = os.path.join(temp_dir, 'hex_2')
+            temp_dirs.append(h2dir)
+            m['rows_out'] = disassemble_file(fias_fn2, h2dir, prefixes,
+                                             hashed)
+    with measure(records, 'compare', config=config) as m:
+        if hashed:
+            offsets_fns = tuple(os.path.join(x, OFFSETS_FILE)
+                                for x in [h1dir, h2dir])
+            m['rows_out'] = compute_hashed_changes(
+                h1dir, h2dir, fias_fn1, fias_fn2, save_fn, prefixes,
+                config.chlog_workers, offsets_fns)
+        else:
+            m['rows_out'] = compute_all_changes(h1dir, h2dir, save_fn,
+                                                prefixes,
+                                                config.chlog_workers)
+    for x in temp_dirs:
+        delete_dir(x)
+    if config.metrics_dir:
+        save_metrics(records, config.metrics_dir, 'changelog')
     return None
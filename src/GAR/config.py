@@ -0,0 +1,81 @@
+"""
+GAR
+===
+
+Config
+------
+
+A submodule of the GAR package that collects run-time settings of the
+pipeline. Settings are read from `GAR_*` environment variables so that
+the command line syntax of the main script stays the same.
+"""
+
+from collections import namedtuple
+import os
+from typing import Mapping, Optional
+
+
+Config = namedtuple('Config', [
+    'workers', 'max_rss', 'rss_factor', 'big_regions', 'max_big',
+    'cache_dir', 'cache_size', 'translit_memo', 'pipeline', 'max_pending',
+    'chlog_workers', 'chlog_prefix', 'chlog_hash',
+    'snapshot', 'state_dir', 'metrics_dir', 'profile_stages', 'load_workers',
+    'split_bytes', 'compact', 'partition_bytes', 'lookup_dir',
+    'inverted_dir'
+])
+
+
+def env_int(env: Mapping[str, str], name: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    return int(env.get(name, default))
+
+
+def env_float(env: Mapping[str, str], name: str, default: float) -> float:
+    """Read a float setting from the environment."""
+    return float(env.get(name, default))
+
+
+def env_list(env: Mapping[str, str], name: str, default: str) -> tuple:
+    """Read a comma separated list setting from the environment."""
+    value = env.get(name, default)
+    return tuple(x.strip() for x in value.split(',') if x.strip())
+
+
+def get_config(env: Optional[Mapping[str, str]] = None) -> Config:
+    """Compile pipeline settings from the environment (`os.environ` by
+    default). Unset variables fall back to the serial single-process
+    behaviour of the script, which writes nothing but the export and
+    its change log.
+    """
+    env = os.environ if env is None else env
+    config = Config(
+        workers=max(1, env_int(env, 'GAR_WORKERS', 1)),
+        max_rss=int(env_float(env, 'GAR_MAX_RSS_GB', 0) * 2**30),
+        rss_factor=env_float(env, 'GAR_RSS_FACTOR', 3.0),
+        big_regions=env_list(env, 'GAR_BIG_REGIONS', '50,77,23'),
+        max_big=max(1, env_int(env, 'GAR_MAX_BIG', 1)),
+        cache_dir=env.get('GAR_CACHE_DIR', ''),
+        cache_size=int(env_float(env, 'GAR_CACHE_SIZE_GB', 50) * 2**30),
+        translit_memo=env.get('GAR_TRANSLIT_MEMO', ''),
+        pipeline=bool(env_int(env, 'GAR_PIPELINE', 0)),
+        max_pending=max(1, env_int(env, 'GAR_MAX_PENDING', 4)),
+        chlog_workers=max(1, env_int(env, 'GAR_CHANGELOG_WORKERS', 1)),
+        chlog_prefix=min(2, max(1, env_int(env, 'GAR_CHANGELOG_PREFIX', 1))),
+        chlog_hash=bool(env_int(env, 'GAR_CHANGELOG_HASH', 0)),
+        snapshot=bool(env_int(env, 'GAR_SNAPSHOT', 0)),
+        state_dir=env.get('GAR_STATE_DIR', ''),
+        metrics_dir=env.get('GAR_METRICS_DIR', ''),
+        profile_stages=env_list(env, 'GAR_PROFILE_STAGES', ''),
+        load_workers=max(1, env_int(env, 'GAR_LOAD_WORKERS', 1)),
+        split_bytes=int(env_float(env, 'GAR_SPLIT_MB', 256) * 2**20),
+        compact=bool(env_int(env, 'GAR_COMPACT', 0)),
+        partition_bytes=int(env_float(env, 'GAR_PARTITION_MB', 0) * 2**20),
+        lookup_dir=env.get('GAR_LOOKUP_DIR', ''),
+        inverted_dir=env.get('GAR_INVERTED_DIR', '')
+    )
+    return config
+
+
+def default_config() -> Config:
+    """Return settings as if no `GAR_*` variables were set."""
+    return get_config({})
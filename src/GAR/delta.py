@@ -0,0 +1,278 @@
+"""
+GAR
+===
+
+Delta
+-----
+
+A module that applies a GAR delta archive (the same region layout as a
+full archive, with changed records only) to the state of the last full
+run (see `GAR.state`, saved when `GAR_STATE_DIR` is set) and emits the
+updated export together with its change log.
+
+Delta records replace state records with the same record `ID`, then the
+row filters are applied to them. Only the houses whose own records or
+any ancestor's records changed are compiled again, out of their own
+records and those of their ancestors; all other rows of the region are
+kept as they are.
+
+Usage: python -m GAR.delta [delta_gar_xml.zip] [state_dir]
+       [ready_fias.csv] [previous_fias.csv]
+"""
+
+from collections import namedtuple
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+import zipfile
+
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+from GAR.changelog import (ADDR_COLUMNS, FIAS_COLUMNS, NA_VALUES,
+                           compare_frames, compute_changelog_fn,
+                           write_changelog)
+from GAR.config import Config, get_config
+from GAR.file_utils import TAGS, Files, RowFilter, parse_xml
+from GAR.filter_data import ROW_FILTERS
+from GAR.merge_to_csv import merge_all_files
+from GAR.region import compile_region
+from GAR.state import (FRAMES, STATE_ATTRS, drop_ids, empty_state_data,
+                       has_state, load_state_data, load_state_region,
+                       regions_dir, save_state_data, save_state_region)
+
+
+def select_delta_members(regfl: List[str], ok2: str) -> Files:
+    """Pick the names of the four source files out of the member names
+    of region `ok2` of a delta archive. Files that are not in the delta
+    are None.
+    """
+    def first(names: List[str]) -> Optional[str]:
+        return sorted(names)[0] if names else None
+
+    hsfn = [x for x in regfl if x.startswith(f'{ok2}/AS_HOUSES_')]
+    hpfn = [x for x in hsfn if x.startswith(f'{ok2}/AS_HOUSES_PARAMS')]
+    hsfn = [x for x in hsfn if x not in hpfn]
+    aofn = [x for x in regfl if x.startswith(f'{ok2}/AS_ADDR_OBJ')]
+    aofn = [x for x in aofn if not ('PARAMS' in x or 'DIVISION' in x)]
+    mhfn = [x for x in regfl if x.startswith(f'{ok2}/AS_MUN_HIERARCHY')]
+    return Files(hs=first(hsfn), hp=first(hpfn), ao=first(aofn),
+                 mh=first(mhfn))
+
+
+def list_delta_regions(zfn: str) -> Dict[str, Files]:
+    """List the regions of a delta archive with their source files."""
+    with zipfile.ZipFile(zfn) as z:
+        names = z.namelist()
+    by_region = {}
+    for name in names:
+        if name[2:3] == '/':
+            by_region.setdefault(name[:2], []).append(name)
+    regions = {x: select_delta_members(y, x) for x, y in by_region.items()}
+    return {x: y for x, y in sorted(regions.items()) if any(y)}
+
+
+def load_delta_data(zfn: str, members: Files) -> namedtuple:
+    """Load all records of the delta files of a region (unfiltered, with
+    record `ID`s) into a namedtuple of DataFrames.
+    """
+    Data = namedtuple('Data', 'hs hp mh ao')
+    frames = {}
+    with zipfile.ZipFile(zfn) as z:
+        for key in FRAMES:
+            name = getattr(members, key)
+            if name is None:
+                frames[key] = getattr(empty_state_data(), key)
+                continue
+            with z.open(name) as xml_file:
+                frames[key] = parse_xml(xml_file, TAGS[key],
+                                        STATE_ATTRS[key])
+    return Data(**frames)
+
+
+def apply_row_filter(df: pd.DataFrame, row_filter: RowFilter) -> pd.DataFrame:
+    """Keep the records that pass all attribute predicates of a row
+    filter (see `filter_data.ROW_FILTERS`).
+    """
+    keep = np.ones(len(df), dtype=bool)
+    for attr, check in row_filter.items():
+        values = df[attr].astype(object)
+        values = values.where(values.notna(), None)
+        keep &= np.array([check(x) for x in values], dtype=bool)
+    return df.loc[keep].reset_index(drop=True)
+
+
+def upsert(state: pd.DataFrame, delta: pd.DataFrame,
+           row_filter: Optional[RowFilter] = None) -> pd.DataFrame:
+    """Replace state records by delta records with the same `ID` and
+add new ones. Delta records that do not pass the row filter only remove
+the state records they replace (state records have passed it already).
+    """
+    kept = state.loc[~state.ID.isin(delta.ID)].astype(object)
+    delta = apply_row_filter(delta, row_filter) if row_filter else delta
+    return pd.concat([kept, delta.astype(object)], ignore_index=True)
+
+
+def changed_objectids(delta: namedtuple) -> np.ndarray:
+    """Collect the OBJECTIDs of all objects that have delta records."""
+    ids = [pd.to_numeric(getattr(delta, x).OBJECTID).to_numpy(dtype=np.int64)
+           for x in FRAMES]
+    return np.unique(np.concatenate(ids))
+
+
+def descendants(objectids: np.ndarray, mhs: List[pd.DataFrame]) -> np.ndarray:
+    """Find the given objects and all their descendants along the
+    muni_hierarchy records of any of the `mhs` frames.
+    """
+    mh = pd.concat([x[['OBJECTID', 'PARENTOBJID']] for x in mhs])
+    child = pd.to_numeric(mh.OBJECTID).to_numpy(dtype=np.int64)
+    parent = pd.to_numeric(mh.PARENTOBJID).fillna(0).to_numpy(dtype=np.int64)
+    found = np.unique(objectids)
+    frontier = found
+    while len(frontier):
+        frontier = np.setdiff1d(child[np.isin(parent, frontier)], found)
+        found = np.union1d(found, frontier)
+    return found
+
+
+def ancestors(objectids: np.ndarray, mh: pd.DataFrame) -> np.ndarray:
+    """Find the given objects and all their ancestors along the
+    muni_hierarchy records `mh`.
+    """
+    child = pd.to_numeric(mh.OBJECTID).to_numpy(dtype=np.int64)
+    parent = pd.to_numeric(mh.PARENTOBJID).fillna(0).to_numpy(dtype=np.int64)
+    found = np.unique(objectids)
+    frontier = found
+    while len(frontier):
+        frontier = np.setdiff1d(parent[np.isin(child, frontier)], found)
+        found = np.union1d(found, frontier)
+    return found
+
+
+def related_data(data: namedtuple, objectids: np.ndarray) -> namedtuple:
+    """Select the source records that the houses with the given
+    OBJECTIDs are compiled from: their own hs and hp records and the mh
+    and ao records of them and all their ancestors.
+    """
+    Data = namedtuple('Data', 'hs hp mh ao')
+    chain = ancestors(objectids, data.mh)
+    frames = {}
+    for key in FRAMES:
+        df = getattr(data, key)
+        ids = chain if key in ('mh', 'ao') else objectids
+        keep = pd.to_numeric(df.OBJECTID).isin(ids).to_numpy()
+        frames[key] = df.loc[keep].reset_index(drop=True)
+    return Data(**frames)
+
+
+def merge_region_rows(old: pd.DataFrame, new: pd.DataFrame,
+                      objectids: np.ndarray) -> pd.DataFrame:
+    """Replace the rows of the given houses in ready region data by
+    freshly compiled ones, in OBJECTID order. Categorical columns stay
+    categorical.
+    """
+    kept = old.loc[~old.objectid.isin(objectids)]
+    df = pd.concat([kept, new], ignore_index=True)
+    for col in old.columns:
+        if isinstance(old[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object).astype('category')
+    df = df.sort_values('objectid', kind='stable')
+    return df.reset_index(drop=True)
+
+
+def text_rows(region: pd.DataFrame) -> pd.DataFrame:
+    """Convert ready region data into text bucket rows as they would be
+    read back from the export by the change log (see
+    `changelog.read_fias_fast`).
+    """
+    columns = {}
+    for x in FIAS_COLUMNS:
+        values = region['objectguid' if x == 'guid' else x].astype(object)
+        values = values.where(values.notna(), '').astype(str)
+        columns[x] = values.where(~values.isin(NA_VALUES), '')
+    df = pd.DataFrame(columns)
+    df['addr'] = df[ADDR_COLUMNS[0]].str.cat(df[ADDR_COLUMNS[1:]], sep='-')
+    return df[['guid', 'current', 'postalcode', 'addr']]
+
+
+def apply_region_delta(zfn: str, region: str, members: Files, state_dir: str,
+                       config: Config) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Apply the delta records of a region to its state, compile the
+    affected houses again and save the new state. Return the old and the
+    new rows of the affected houses. The region must have a state.
+    """
+    Data = namedtuple('Data', 'hs hp mh ao')
+    t1 = time.perf_counter()
+    state = load_state_data(state_dir, region)
+    old = load_state_region(state_dir, region)
+    delta = load_delta_data(zfn, members)
+    data = Data(**{x: upsert(getattr(state, x), getattr(delta, x),
+                             ROW_FILTERS.get(x))
+                   for x in FRAMES})
+    affected = descendants(changed_objectids(delta),
+                           [state.mh, delta.mh, data.mh])
+    related = related_data(data, affected)
+    if related.hs.empty:
+        # no active houses are affected, their old rows are only removed
+        new = old.iloc[:0]
+    else:
+        new = compile_region(drop_ids(related), region, config, affected)
+    save_state_data(state_dir, region, data)
+    save_state_region(state_dir, region,
+                      merge_region_rows(old, new, affected))
+    t = round(time.perf_counter() - t1, 2)
+    logger.success(f'Region {region}: {len(affected)} objects affected, '
+                   f'{len(new)} rows compiled in {t} sec.')
+    return old.loc[old.objectid.isin(affected)], new
+
+
+def apply_delta(delta_zfn: str, state_dir: str, dest_fn: str,
+                chlog_fn: str, config: Optional[Config] = None) -> None:
+    """Apply a delta archive to the state, write the updated export to
+    `dest_fn` and the change log against the previous export to
+    `chlog_fn`.
+    """
+    config = get_config() if config is None else config
+    old_rows, new_rows = [], []
+    for region, members in list_delta_regions(delta_zfn).items():
+        if not has_state(state_dir, region):
+            logger.warning(f'Region {region} has no state, skipped.')
+            continue
+        old, new = apply_region_delta(delta_zfn, region, members, state_dir,
+                                      config)
+        old_rows.append(text_rows(old))
+        new_rows.append(text_rows(new))
+    logger.info(f'Delta applied. Starting export -> {dest_fn}')
+    merge_all_files(regions_dir(state_dir), dest_fn, config)
+    logger.info(f'Export complete. Starting change log {chlog_fn}')
+    empty = text_rows(pd.DataFrame(columns=['objectguid'] + FIAS_COLUMNS[1:]))
+    chlog = compare_frames(pd.concat([empty] + old_rows, ignore_index=True),
+                           pd.concat([empty] + new_rows, ignore_index=True))
+    with open(chlog_fn, 'w', encoding='utf-8', newline='') as fh:
+        write_changelog(fh, [chlog])
+    logger.success(f'{len(chlog)} changes saved to {chlog_fn}.')
+
+
+def main() -> int:
+    """Script running function."""
+    if len(sys.argv) != 5:
+        print('Syntax Error.')
+        print(f'Usage: {__file__} [delta_gar_xml.zip] [state_dir] '
+              '[ready_fias.csv] [previous_fias.csv]')
+        return 1
+    zfn, state_dir, dcsv, pcsv = sys.argv[1:]
+    if not os.path.isdir(regions_dir(state_dir)):
+        logger.error(f'No state of a full run in {state_dir}.')
+        return 1
+    config = get_config()
+    logger.info(f'Applying {zfn} to {state_dir}')
+    apply_delta(zfn, state_dir, dcsv, compute_changelog_fn(pcsv, dcsv),
+                config)
+    logger.success('All done.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
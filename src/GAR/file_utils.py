@@ -10,15 +10,57 @@ Includes:
 1.  Unzip region from a source distribution
 2.  Read XML file into a pandas DataFrame
 3.  Concatenate ready region files
+4.  Index the archive members of every region in one central directory
+    read
+5.  Parse the files of a region concurrently, splitting huge files into
+    record-aligned chunks
+6.  Read indexed members straight from their local header offsets, so
+    that loading a file does not re-read the zip central directory
 """
 
 from collections import namedtuple
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import io
+import os
+import struct
+from typing import IO, Callable, Dict, Iterator, List, Optional
 import zipfile
+import zlib
 
 from loguru import logger
 from lxml import etree
 import pandas as pd
+import pyarrow as pa
+
+
+Files = namedtuple('Files', 'hs hp ao mh')
+Member = namedtuple('Member', 'name size crc offset csize method')
+RowFilter = Dict[str, Callable[[Optional[str]], bool]]
+
+# XML element tags and attributes loaded from each of the four files
+TAGS = {'hs': 'HOUSE', 'hp': 'PARAM', 'mh': 'ITEM', 'ao': 'OBJECT'}
+ATTRS = {
+    'hs': ['OBJECTID', 'OBJECTGUID', 'HOUSENUM', 'HOUSETYPE', 'ISACTIVE',
+           'ADDNUM1', 'ADDTYPE1', 'ADDNUM2', 'ADDTYPE2'],
+    'hp': ['OBJECTID', 'CHANGEIDEND', 'TYPEID', 'VALUE'],
+    'mh': ['OBJECTID', 'PARENTOBJID', 'OKTMO', 'ISACTIVE', 'NEXTID',
+           'ENDDATE'],
+    'ao': ['OBJECTID', 'NAME', 'TYPENAME', 'LEVEL', 'ISACTIVE', 'ISACTUAL',
+           'NEXTID', 'ENDDATE']
+}
+
+# parsed records are flushed into Arrow batches of this many rows
+PARSE_BATCH_ROWS = 2**16
+
+# archive indexes built in this process, see `get_archive_index`
+index_memo = {}
+
+# zip local file header: signature, versions, flags, compression method,
+# time, date, CRC32, sizes, name and extra field lengths
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_SIGNATURE = b'PK\x03\x04'
+# compressed bytes read from an archive member at a time
+READ_BLOCK = 2**20
 
 
 def test_src_availability(fn: str) -> bool:
@@ -40,81 +82,368 @@ def test_src_availability(fn: str) -> bool:
     return True
 
 
+def select_region_members(regfl: List[str], ok2: str) -> Optional[Files]:
+    """Pick the names of the four files required for region processing
+    out of the member names of region `ok2`. Return None if any of
+    them is missing.
+    """
+    hsfn = sorted([x for x in regfl if x.startswith(f'{ok2}/AS_HOUSES')])
+    aofn = [x for x in regfl if x.startswith(f'{ok2}/AS_ADDR_OBJ')]
+    aofn = [x for x in aofn if not ('PARAMS' in x or 'DIVISION' in x)]
+    mhfn = [x for x in regfl if x.startswith(f'{ok2}/AS_MUN_HIERARCHY')]
+    if len(hsfn) < 2 or not aofn or not mhfn:
+        return None
+    return Files(hs=hsfn[0], hp=hsfn[1], ao=aofn[0], mh=mhfn[0])
+
+
+def build_archive_index(zfn: str) -> Dict[str, Files]:
+    """Read the zip central directory once and index the four files
+    required for processing of every region (region -> Files of
+    Member records).
+    """
+    with zipfile.ZipFile(zfn) as z:
+        infos = {x.filename: x for x in z.infolist()}
+    by_region = {}
+    for name in infos:
+        if name[2:3] == '/':
+            by_region.setdefault(name[:2], []).append(name)
+    index = {}
+    for ok2 in sorted(by_region):
+        names = select_region_members(by_region[ok2], ok2)
+        if names is None:
+            logger.warning(f'Region {ok2} is incomplete in {zfn}, skipped.')
+            continue
+        members = [infos[x] for x in names]
+        index[ok2] = Files(*[Member(name=x.filename, size=x.file_size,
+                                    crc=x.CRC, offset=x.header_offset,
+                                    csize=x.compress_size,
+                                    method=x.compress_type)
+                             for x in members])
+    return index
+
+
+def get_archive_index(zfn: str) -> Dict[str, Files]:
+    """Return the archive index of `zfn`. The index is built once per
+    process and archive (see `build_archive_index`) and reused by all
+    the helpers below.
+    """
+    memo_key = archive_memo_key(zfn)
+    if memo_key not in index_memo:
+        index_memo[memo_key] = build_archive_index(zfn)
+    return index_memo[memo_key]
+
+
+def archive_memo_key(zfn: str) -> tuple:
+    """Identify an archive file by its path, size and modification
+    time.
+    """
+    st = os.stat(zfn)
+    return (os.path.abspath(zfn), st.st_size, st.st_mtime)
+
+
+def seed_archive_index(zfn: str, index: Dict[str, Files]) -> None:
+    """Register an index built elsewhere (e.g. in the parent process)
+    as the archive index of `zfn` in this process.
+    """
+    index_memo[archive_memo_key(zfn)] = index
+
+
 def get_list_of_regions(zipfn: str) -> List[str]:
     """Read the contents of the zip file and return a list of regions
     that it contains.
     """
-    with zipfile.ZipFile(zipfn) as z:
-        fl = z.namelist()
-    regfl = set([x[:2] for x in fl])
-    regfl.remove('AS')
-    return sorted(list(regfl))
+    return sorted(get_archive_index(zipfn))
 
 
 def get_region_filenames(zipfn: str, ok2: str) -> namedtuple:
     """Read the contents of the GAR zipfile and return the names of the
     four files required for region processing.
     """
-    Files = namedtuple('Files', 'hs hp ao mh')
-    with zipfile.ZipFile(zipfn) as z:
-        fl = z.namelist()
-    regfl = [x for x in fl if x.startswith(f'{ok2}/')]
-    hsfn = sorted([x for x in regfl if x.startswith(f'{ok2}/AS_HOUSES')])
-    aofn = [x for x in regfl if x.startswith(f'{ok2}/AS_ADDR_OBJ')]
-    aofn = [x for x in aofn if not ('PARAMS' in x or 'DIVISION' in x)]
-    mhfn = [x for x in regfl if x.startswith(f'{ok2}/AS_MUN_HIERARCHY')]
-    return Files(hs=hsfn[0], hp=hsfn[1], ao=aofn[0], mh=mhfn[0])
+    members = get_archive_index(zipfn)[ok2]
+    return Files(*[x.name for x in members])
 
 
-def load_xml_from_zip(zfn: str, xmlfn: str, tag: str,
-                      req_attr: List[str]) -> pd.DataFrame:
-    """Access an XML file (`xmlfn`) stored inside a zip file (`zfn`).
-    Iteratively read through it and load only required attributes (`req_attr`)
-    into a pandas DataFrame.
+class MemberReader(io.RawIOBase):
+    """Raw stream of the uncompressed data of a stored or deflated
+    archive member, read from the archive file `fh` positioned at the
+    start of the member data. The CRC32 and size are checked at the end.
     """
-    z = zipfile.ZipFile(zfn)
-    xml = etree.iterparse(z.open(xmlfn), tag=tag, events=['end'])
-    rows = []
+
+    def __init__(self, fh: IO[bytes], member: Member) -> None:
+        super().__init__()
+        self.fh = fh
+        self.member = member
+        self.left = member.csize
+        self.inflate = zlib.decompressobj(-zlib.MAX_WBITS) \
+            if member.method == zipfile.ZIP_DEFLATED else None
+        self.crc = 0
+        self.size = 0
+        self.block = b''
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def next_block(self) -> bytes:
+        """Read and decompress data until some output is produced."""
+        while self.left:
+            data = self.fh.read(min(READ_BLOCK, self.left))
+            if not data:
+                raise zipfile.BadZipFile(f'{self.member.name} is truncated.')
+            self.left -= len(data)
+            if self.inflate is not None:
+                data = self.inflate.decompress(data)
+                if not self.left:
+                    data += self.inflate.flush()
+            if data:
+                self.crc = zlib.crc32(data, self.crc)
+                self.size += len(data)
+                return data
+        if self.size != self.member.size or self.crc != self.member.crc:
+            raise zipfile.BadZipFile(f'Bad CRC-32 for {self.member.name}.')
+        return b''
+
+    def readinto(self, buffer) -> int:
+        if self.pos == len(self.block):
+            self.block, self.pos = self.next_block(), 0
+        n = min(len(buffer), len(self.block) - self.pos)
+        buffer[:n] = memoryview(self.block)[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self) -> None:
+        self.fh.close()
+        super().close()
+
+
+def open_member(zfn: str, member: Member) -> IO[bytes]:
+    """Open an indexed archive member (see `build_archive_index`) for
+    reading by seeking to its local header, without reading the zip
+    central directory. Members compressed by methods other than deflate
+    are opened through `zipfile`.
+    """
+    if member.method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        z = zipfile.ZipFile(zfn)
+        return z.open(member.name)
+    fh = open(zfn, 'rb')
+    try:
+        fh.seek(member.offset)
+        header = LOCAL_HEADER.unpack(fh.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_SIGNATURE:
+            raise zipfile.BadZipFile(f'Bad local header of {member.name}.')
+        fh.seek(header[-2] + header[-1], io.SEEK_CUR)
+    except Exception:
+        fh.close()
+        raise
+    return io.BufferedReader(MemberReader(fh, member), READ_BLOCK)
+
+
+def parse_xml(xml_file: IO[bytes], tag: str, req_attr: List[str],
+              row_filter: Optional[RowFilter] = None) -> pd.DataFrame:
+    """Iteratively read through an XML stream and load only required
+    attributes (`req_attr`) of `tag` elements into a pandas DataFrame
+    (see `parse_xml_table`).
+    """
+    return table_to_df(parse_xml_table(xml_file, tag, req_attr,
+                                       row_filter))
+
+
+def parse_xml_table(xml_file: IO[bytes], tag: str, req_attr: List[str],
+                    row_filter: Optional[RowFilter] = None) -> pa.Table:
+    """Iteratively read through an XML stream and load only required
+    attributes (`req_attr`) of `tag` elements into an Arrow table of
+    string columns. Elements that fail any of the `row_filter` attribute
+    predicates are skipped. Every element is cleared (together with its
+    already processed siblings) as soon as it is read, so the XML tree
+    never grows, and attribute values are flushed from per-column
+    buffers into Arrow record batches every `PARSE_BATCH_ROWS` rows, so
+    only one batch of values is held as Python objects.
+    """
+    schema = pa.schema([(x, pa.string()) for x in req_attr])
+    columns = [[] for _ in req_attr]
+    appends = [column.append for column in columns]
+    fields = list(zip(appends, req_attr))
+    checks = list(row_filter.items()) if row_filter else []
+    batches = []
+    n_rows = 0
+    xml = etree.iterparse(xml_file, tag=tag, events=['end'])
     for _, element in xml:
-        row = {}
-        for attr in req_attr:
-            row[attr] = element.get(attr)
-        rows.append(row)
-    df = pd.DataFrame(rows)
-    z.close()
+        get = element.get
+        if not checks or all(check(get(attr)) for attr, check in checks):
+            for append, attr in fields:
+                append(get(attr))
+            n_rows += 1
+            if n_rows == PARSE_BATCH_ROWS:
+                batches.append(flush_columns(columns, schema))
+                n_rows = 0
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    del xml
+    if n_rows:
+        batches.append(flush_columns(columns, schema))
+    return pa.Table.from_batches(batches, schema)
+
+
+def flush_columns(columns: List[list], schema: pa.Schema) -> pa.RecordBatch:
+    """Move the values of per-column buffers into a record batch and
+    empty the buffers.
+    """
+    batch = pa.RecordBatch.from_arrays(
+        [pa.array(x, pa.string()) for x in columns], schema=schema)
+    for column in columns:
+        column.clear()
+    return batch
+
+
+def table_to_df(table: pa.Table) -> pd.DataFrame:
+    """Build the DataFrame of a parsed table with the dtypes of a
+    DataFrame built from lists of values: columns without any value
+    hold None objects.
+    """
+    df = table.to_pandas()
+    for name in table.column_names:
+        if table[name].null_count == len(table):
+            df[name] = pd.Series([None] * len(df), dtype=object)
+    if not len(table):
+        return pd.DataFrame({x: [] for x in table.column_names},
+                            columns=table.column_names)
     return df
 
 
-def load_all_data(zfn: str, region: str) -> namedtuple:
+def split_records(xml_file: IO[bytes], tag: str,
+                  split_bytes: int) -> Iterator[bytes]:
+    """Read an XML stream of `tag` records and yield it in chunks of
+    about `split_bytes` that start and end on record boundaries (the
+    `<TAG ` of the next record). The XML declaration and the root
+    element are left out. At least one (possibly empty) chunk is
+    yielded.
+    """
+    mark = f'<{tag} '.encode()
+    carry = b''
+    head = True
+    while True:
+        block = xml_file.read(split_bytes)
+        data = carry + block
+        if head:
+            start = data.find(mark)
+            if start < 0 and block:
+                carry = data
+                continue
+            data = data[max(start, 0):] if start >= 0 else b''
+            head = False
+        if not block:
+            # drop the closing tag of the root element
+            end = data.rfind(b'</')
+            yield data[:end] if end >= 0 else data
+            return
+        cut = data.rfind(mark)
+        if cut <= 0:
+            carry = data
+            continue
+        yield data[:cut]
+        carry = data[cut:]
+
+
+def parse_chunk(chunk: bytes, tag: str, req_attr: List[str],
+                row_filter: Optional[RowFilter] = None) -> pa.Table:
+    """Parse a chunk of records (see `split_records`) and return the
+    table of the records that pass `row_filter`.
+    """
+    xml_file = io.BytesIO(b'<CHUNK>' + chunk + b'</CHUNK>')
+    return parse_xml_table(xml_file, tag, req_attr, row_filter)
+
+
+def load_xml_from_zip(zfn: str, member: Member, tag: str,
+                      req_attr: List[str],
+                      row_filter: Optional[RowFilter] = None
+                      ) -> pd.DataFrame:
+    """Access an XML file (an indexed `member`, see `open_member`)
+    stored inside a zip file (`zfn`). Stream through it and load only
+    required attributes (`req_attr`) of the rows that pass `row_filter`
+    into a pandas DataFrame.
+    """
+    with open_member(zfn, member) as xml_file:
+        df = parse_xml(xml_file, tag, req_attr, row_filter)
+    return df
+
+
+def load_all_data(zfn: str, region: str,
+                  row_filters: Optional[Dict[str, RowFilter]] = None,
+                  attrs: Optional[Dict[str, List[str]]] = None,
+                  workers: int = 1, split_bytes: int = 0) -> namedtuple:
     """Load all required files from a zip archive into a namedtuple of
-    DataFrames.
+    DataFrames. `row_filters` maps a file key (hs, hp, mh, ao) to the
+    attribute predicates applied while parsing that file (see
+    `filter_data.ROW_FILTERS`). `attrs` overrides the loaded attributes
+    (`ATTRS`). With more than one worker the files are parsed in a
+    process pool (see `load_all_data_parallel`).
+    """
+    if workers > 1:
+        return load_all_data_parallel(zfn, region, row_filters, attrs,
+                                      workers, split_bytes)
+    Data = namedtuple('Data', 'hs hp mh ao')
+    rf = {} if row_filters is None else row_filters
+    attrs = ATTRS if attrs is None else attrs
+    members = get_archive_index(zfn)[region]
+    frames = {x: load_xml_from_zip(zfn, getattr(members, x), TAGS[x],
+                                   attrs[x], rf.get(x))
+              for x in Data._fields}
+    return Data(**frames)
+
+
+def load_all_data_parallel(zfn: str, region: str,
+                           row_filters: Optional[Dict[str, RowFilter]] = None,
+                           attrs: Optional[Dict[str, List[str]]] = None,
+                           workers: int = 2, split_bytes: int = 0
+                           ) -> namedtuple:
+    """Load all required files of a region like `load_all_data`, parsing
+    them in a pool of `workers` processes at the same time. Files larger
+    than `split_bytes` (if it is set) are decompressed here and split
+    into record-aligned chunks (see `split_records`) that are parsed by
+    all workers and put together in file order. At most two chunks per
+    worker wait in the pool at a time.
     """
     Data = namedtuple('Data', 'hs hp mh ao')
-    hs_attrs = ['OBJECTID', 'OBJECTGUID', 'HOUSENUM', 'HOUSETYPE', 'ISACTIVE',
-                'ADDNUM1', 'ADDTYPE1', 'ADDNUM2', 'ADDTYPE2']
-    hp_attrs = ['OBJECTID', 'CHANGEIDEND', 'TYPEID', 'VALUE']
-    ao_attrs = ['OBJECTID', 'NAME', 'TYPENAME', 'LEVEL', 'ISACTIVE',
-                'ISACTUAL', 'NEXTID', 'ENDDATE']
-    mh_attrs = ['OBJECTID', 'PARENTOBJID', 'OKTMO', 'ISACTIVE', 'NEXTID',
-                'ENDDATE']
-    filenames = get_region_filenames(zfn, region)
-    data = Data(
-        hs=load_xml_from_zip(zfn, filenames.hs, 'HOUSE', hs_attrs),
-        hp=load_xml_from_zip(zfn, filenames.hp, 'PARAM', hp_attrs),
-        mh=load_xml_from_zip(zfn, filenames.mh, 'ITEM', mh_attrs),
-        ao=load_xml_from_zip(zfn, filenames.ao, 'OBJECT', ao_attrs)
-    )
-    return data
+    rf = {} if row_filters is None else row_filters
+    attrs = ATTRS if attrs is None else attrs
+    members = get_archive_index(zfn)[region]
+    whole, parts = {}, {}
+    split = [x for x in Data._fields
+             if split_bytes and getattr(members, x).size > split_bytes]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for key in Data._fields:
+            if key not in split:
+                whole[key] = pool.submit(load_xml_from_zip, zfn,
+                                         getattr(members, key), TAGS[key],
+                                         attrs[key], rf.get(key))
+        split.sort(key=lambda x: getattr(members, x).size, reverse=True)
+        for key in split:
+            parts[key] = []
+            with open_member(zfn, getattr(members, key)) as xml_file:
+                for chunk in split_records(xml_file, TAGS[key],
+                                           split_bytes):
+                    pending = [x for y in parts.values() for x in y
+                               if not x.done()]
+                    if len(pending) >= 2 * workers:
+                        wait(pending, return_when=FIRST_COMPLETED)
+                    parts[key].append(pool.submit(
+                        parse_chunk, chunk, TAGS[key], attrs[key],
+                        rf.get(key)))
+        frames = {x: y.result() for x, y in whole.items()}
+        for key, futures in parts.items():
+            frames[key] = table_to_df(pa.concat_tables(
+                [x.result() for x in futures]))
+    logger.trace(f'Region {region} loaded by {workers} workers, '
+                 f'{len(split)} files split.')
+    return Data(**frames)
 
 
 def get_filesize(zfn: str, ok2: str) -> List[int]:
     """Compute file sizes of all four meaningful files within
     archive.
     """
-    rfn = get_region_filenames(zfn, ok2)
-    with zipfile.ZipFile(zfn) as z:
-        fss = [z.getinfo(fn).file_size for fn in rfn]
-    return fss
+    return [x.size for x in get_archive_index(zfn)[ok2]]
 
 
 def get_all_filesizes(zfn: str) -> pd.DataFrame:
@@ -127,11 +456,19 @@ def get_all_filesizes(zfn: str) -> pd.DataFrame:
     return fsdf
 
 
-def get_list_of_active_regions(zfn: str) -> List[str]:
-    """Scan a list of regions and return only those that have real
+def get_active_filesizes(zfn: str) -> pd.DataFrame:
+    """Compute file size statistics only for the regions that have real
     address data.
     """
     fsdf = get_all_filesizes(zfn)
     fltd = fsdf.loc[fsdf.hs > 100]
+    return fltd.reset_index(drop=True)
+
+
+def get_list_of_active_regions(zfn: str) -> List[str]:
+    """Scan a list of regions and return only those that have real
+    address data.
+    """
+    fltd = get_active_filesizes(zfn)
     active_regions = list(fltd.region)
     return active_regions
@@ -10,21 +10,55 @@ the records that are required for GAR processing.
 """
 
 from collections import namedtuple
+from typing import Optional
 
 import pandas as pd
 
 
+HOUSE_TYPES = [0, 1, 2, 3, 5, 7, 8, 9, 10]
+
+
+def is_active(value: Optional[str]) -> bool:
+    """Raw XML attribute check: ISACTIVE == 1."""
+    return value is not None and int(value) == 1
+
+
+def is_house_type(value: Optional[str]) -> bool:
+    """Raw XML attribute check: house (or additional) type is one of
+    `HOUSE_TYPES`, a missing type counts as 0.
+    """
+    return (0 if value is None else int(value)) in HOUSE_TYPES
+
+
+def is_postcode(value: Optional[str]) -> bool:
+    """Raw XML attribute check: house parameter TYPEID == 5."""
+    return value is not None and int(value) == 5
+
+
+# Row predicates that `file_utils.load_all_data` can apply while parsing
+# the source XML. They mirror the filters below (and the casts in
+# `cast_types`), so pushing them down does not change the results.
+# ADDTYPE2 has no predicate of its own: `cast_types_hs` fills it from
+# ADDTYPE1.
+ROW_FILTERS = {
+    'hs': {'ISACTIVE': is_active, 'HOUSETYPE': is_house_type,
+           'ADDTYPE1': is_house_type},
+    'hp': {'TYPEID': is_postcode},
+    'mh': {'ISACTIVE': is_active},
+    'ao': {'ISACTIVE': is_active}
+}
+
+
 def filter_hs(src_hs: pd.DataFrame) -> pd.DataFrame:
     """Take source houses dataframe (as imported from XML and cast into
     proper types) and filter redundand records out:
     1. Keep only active records
     2. Keep only records of certain types (discard garages, mines, etc.)
     """
-    hf = src_hs.loc[src_hs.ISACTIVE == 1]
-    hf = hf.loc[hf.HOUSETYPE.isin([0, 1, 2, 3, 5, 7, 8, 9, 10])]
-    hf = hf.loc[hf.ADDTYPE1.isin([0, 1, 2, 3, 5, 7, 8, 9, 10])]
-    hf = hf.loc[hf.ADDTYPE2.isin([0, 1, 2, 3, 5, 7, 8, 9, 10])]
-    return hf.reset_index(drop=True)
+    keep = ((src_hs.ISACTIVE == 1) & src_hs.HOUSETYPE.isin(HOUSE_TYPES)
+            & src_hs.ADDTYPE1.isin(HOUSE_TYPES)
+            & src_hs.ADDTYPE2.isin(HOUSE_TYPES))
+    return src_hs.loc[keep.to_numpy()].reset_index(drop=True)
 
 
 def filter_hp(src_hp: pd.DataFrame, f_hs: pd.DataFrame) -> pd.DataFrame:
@@ -35,11 +69,11 @@ def filter_hp(src_hp: pd.DataFrame, f_hs: pd.DataFrame) -> pd.DataFrame:
     3. Keep house_params records only for filtered houses (see.
        filter_houses function).
     """
-    hp = src_hp.copy()
-    hpf = hp.loc[hp.TYPEID == 5]
+    # duplicates are found per house, so houses can be filtered first
+    keep = (src_hp.TYPEID == 5) & src_hp.OBJECTID.isin(f_hs.OBJECTID)
+    hpf = src_hp.loc[keep.to_numpy()]
     hpf = hpf.sort_values(by=['OBJECTID', 'CHANGEIDEND'])
     hpf = hpf.drop_duplicates(['OBJECTID', 'VALUE'])
-    hpf = hpf.loc[hpf.OBJECTID.isin(f_hs.OBJECTID)]
     return hpf.reset_index(drop=True)
 
 
@@ -47,10 +81,9 @@ def filter_ao(src_ao: pd.DataFrame) -> pd.DataFrame:
     """Process `ao` dataset to keep only records that are reuqired in
     GAR processing - i.e. only active ao.
     """
-    aof = src_ao.loc[src_ao.ISACTIVE == 1].copy()
+    aof = src_ao.loc[(src_ao.ISACTIVE == 1).to_numpy()]
     assert len(aof.OBJECTID.unique()) == len(aof)
-    aof.drop('ISACTIVE', axis=1, inplace=True)
-    return aof.reset_index(drop=True)
+    return aof.drop(columns='ISACTIVE').reset_index(drop=True)
 
 
 def filter_mh(src_mh: pd.DataFrame, f_hs: pd.DataFrame,
@@ -61,19 +94,19 @@ def filter_mh(src_mh: pd.DataFrame, f_hs: pd.DataFrame,
     2. Keep records only for `active` houses and `active` AO,
     3. Keep only units, whose parents are active AO.
     """
-    mhf = src_mh.loc[src_mh.ISACTIVE == 1].copy()
-    mhf = mhf.loc[mhf.OBJECTID.isin(f_hs.OBJECTID) |
-                  mhf.OBJECTID.isin(f_ao.OBJECTID)].copy()
-    mhf = mhf.loc[mhf.PARENTOBJID.isin(f_ao.OBJECTID)].copy()
+    keep = ((src_mh.ISACTIVE == 1)
+            & (src_mh.OBJECTID.isin(f_hs.OBJECTID)
+               | src_mh.OBJECTID.isin(f_ao.OBJECTID))
+            & src_mh.PARENTOBJID.isin(f_ao.OBJECTID))
+    mhf = src_mh.loc[keep.to_numpy()].drop(columns='ISACTIVE')
     # Add level info to filter out duplicates (highest level prefered)
     mhm = mhf.merge(f_ao[['OBJECTID', 'LEVEL']], how='left',
                     left_on='PARENTOBJID', right_on='OBJECTID',
                     suffixes=('', 'x'))
-    mhm.sort_values(['OBJECTID', 'PARENTOBJID', 'LEVEL'], inplace=True)
-    mhm.drop_duplicates(['OBJECTID'], inplace=True, ignore_index=True)
-    mhf = mhm[mhf.columns].copy()
+    mhm = mhm.sort_values(['OBJECTID', 'PARENTOBJID', 'LEVEL'])
+    mhm = mhm.drop_duplicates(['OBJECTID'], ignore_index=True)
+    mhf = mhm[mhf.columns]
     assert len(mhf.OBJECTID.unique()) == len(mhf)
-    mhf.drop('ISACTIVE', axis=1, inplace=True)
     return mhf.reset_index(drop=True)
 
 
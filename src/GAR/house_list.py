@@ -83,15 +83,21 @@ def make_house_list(hs: pd.DataFrame, full_hp: pd.DataFrame) -> pd.DataFrame:
 
 
 def format_house_list(house_list: pd.DataFrame) -> pd.DataFrame:
-    """Format houses with PC history to required GAR format."""
+    """Format houses with PC history to required GAR format. Rows are
+    ordered by house and then by the end of the postcode record
+    (CHANGEIDEND, the current record first); ties keep the source
+    order. Partitioned runs reproduce it (see
+    `partition.merge_partitions`).
+    """
     hpc = house_list.copy()
     hpc['BUILDNUM'] = hpc['ADDNUM1']
     hpc['STRUCNUM'] = hpc['ADDNUM2']
     hpc['POSTALCODE'] = hpc['VALUE'].fillna('').astype(str)
     hpc['CURRENT'] = 0
     hpc.loc[hpc.CHANGEIDEND == 0, 'CURRENT'] = 1
+    hpc = hpc.sort_values(by=['OBJECTID', 'CHANGEIDEND'], kind='stable')
     hr = hpc[['OBJECTGUID', 'CURRENT', 'POSTALCODE', 'HOUSENUM', 'BUILDNUM',
-              'STRUCNUM', 'OBJECTID']].sort_values(by='OBJECTID')
+              'STRUCNUM', 'OBJECTID']]
     return hr
 
 
@@ -0,0 +1,243 @@
+"""
+GAR
+===
+
+Inverted
+--------
+
+A submodule of the GAR package that builds inverted indexes of the
+export and answers queries from them:
+- `postcode` - postal code -> rows,
+- `street` - (region ISO code, city, street) -> rows, the city being
+  the place of a house that is not in a city,
+- `current` - the rows of current postcode records.
+Rows are export `id`s, so that the rows themselves can be read from
+the CSV file or from the GUID lookup index (see `GAR.lookup`). Terms are
+lowercased with spaces collapsed; rows without a postcode or a street
+are not in the respective index.
+
+Every region builds a partial index of its ready data with region-local
+row numbers (see `region.process_region`), and the export merges them,
+offset by the first `id` of each region (see `merge_to_csv`). An index
+is stored as sorted arrays: fixed-width UTF-8 terms, the offsets of
+their rows and the rows of all terms (each list sorted), which are
+memory-mapped by `open_inverted_index`.
+"""
+
+from collections import namedtuple
+import os
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+
+POSTINGS = ['postcode', 'street']
+INDEX_COLUMNS = ['postalcode', 'region_iso_code', 'city_f', 'place_f',
+                 'street_f', 'current']
+# separator of the parts of a street term
+SEPARATOR = '\x1f'
+
+Postings = namedtuple('Postings', 'terms offsets rows')
+InvertedIndex = namedtuple('InvertedIndex', 'postcode street current')
+
+
+def normalize_term(value: object) -> str:
+    """Lowercase a text value, strip it and collapse inner spaces."""
+    return ' '.join(str(value).lower().split())
+
+
+def normalize(values: pd.Series) -> np.ndarray:
+    """Normalize text values (see `normalize_term`), every distinct
+    value once. Missing values become empty strings.
+    """
+    codes, uniques = pd.factorize(values)
+    text = [normalize_term(x) for x in uniques] + ['']
+    return np.array(text, dtype=object)[codes]
+
+
+def street_terms(region: pd.DataFrame) -> np.ndarray:
+    """Make the street terms of ready region data; rows without a street
+    get empty terms.
+    """
+    street = normalize(region.street_f)
+    city = normalize(region.city_f)
+    city = np.where(city == '', normalize(region.place_f), city)
+    terms = normalize(region.region_iso_code) + SEPARATOR + city + \
+        SEPARATOR + street
+    return np.where(street == '', '', terms)
+
+
+def make_postings(terms: np.ndarray) -> Postings:
+    """Invert an array of terms (empty terms are left out)."""
+    rows = np.flatnonzero(terms != '')
+    codes, uniques = pd.factorize(terms[rows], sort=True)
+    counts = np.bincount(codes, minlength=len(uniques))
+    return Postings(
+        terms=np.char.encode(np.asarray(uniques, dtype=str), 'utf-8'),
+        offsets=np.concatenate([[0], np.cumsum(counts)]),
+        rows=rows[np.argsort(codes, kind='stable')])
+
+
+def region_index_fn(region_fn: str) -> str:
+    """Name the partial index file of a region file."""
+    return f'{os.path.splitext(region_fn)[0]}.inv.npz'
+
+
+def region_index(region: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Build the partial index of ready region data (with lowercase
+    export columns) as named arrays.
+    """
+    arrays = {'current_rows': np.flatnonzero(region.current.to_numpy() == 1)}
+    for name, terms in [('postcode', normalize(region.postalcode)),
+                        ('street', street_terms(region))]:
+        for field, values in make_postings(terms)._asdict().items():
+            arrays[f'{name}_{field}'] = values
+    return arrays
+
+
+def save_region_index(region: pd.DataFrame, fn: str) -> None:
+    """Build the partial index of ready region data and save it to
+    `fn`.
+    """
+    arrays = region_index(region)
+    tmp_fn = f'{fn}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_fn, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp_fn, fn)
+
+
+def read_index_columns(region_fn: str) -> pd.DataFrame:
+    """Read the columns of a region file that are indexed."""
+    return feather.read_table(region_fn, columns=INDEX_COLUMNS).to_pandas()
+
+
+def load_region_index(region_fn: str) -> Dict[str, np.ndarray]:
+    """Load the partial index of a region file, or build it from the
+    region file if it was not saved (e.g. for state region files).
+    """
+    fn = region_index_fn(region_fn)
+    if not os.path.isfile(fn):
+        return region_index(read_index_columns(region_fn))
+    with np.load(fn) as arrays:
+        return dict(arrays)
+
+
+def merge_postings(parts: List[Tuple[Postings, int]]) -> Postings:
+    """Merge postings of regions with the first row of every region.
+    Regions must be given in row order.
+    """
+    terms = [x.terms for x, _ in parts] or [np.zeros(0, dtype='S1')]
+    uniques, codes = np.unique(np.concatenate(terms), return_inverse=True)
+    codes = codes.reshape(-1)
+    term_codes, rows, start = [], [], 0
+    for postings, first in parts:
+        counts = np.diff(postings.offsets)
+        term_codes.append(np.repeat(codes[start:start + len(counts)], counts))
+        rows.append(postings.rows + first)
+        start += len(counts)
+    term_codes = np.concatenate([np.zeros(0, dtype=np.int64)] + term_codes)
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + rows)
+    counts = np.bincount(term_codes, minlength=len(uniques))
+    return Postings(terms=uniques,
+                    offsets=np.concatenate([[0], np.cumsum(counts)]),
+                    rows=rows[np.argsort(term_codes, kind='stable')])
+
+
+def save_inverted_index(parts: List[Tuple[Dict[str, np.ndarray], int]],
+                        index_dir: str) -> int:
+    """Merge the partial indexes of regions (with the first row of every
+    region, in row order) and replace the index in `index_dir`. Return
+    the number of terms.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {'current_rows': np.concatenate(
+        [np.zeros(0, dtype=np.int64)]
+        + [x['current_rows'] + first for x, first in parts])}
+    n_terms = 0
+    for name in POSTINGS:
+        postings = merge_postings([
+            (Postings(*[x[f'{name}_{y}'] for y in Postings._fields]), first)
+            for x, first in parts])
+        n_terms += len(postings.terms)
+        for field, values in postings._asdict().items():
+            arrays[f'{name}_{field}'] = values
+    for name, values in arrays.items():
+        fn = os.path.join(index_dir, f'{name}.npy')
+        tmp_fn = f'{fn}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_fn, 'wb') as fh:
+            np.save(fh, values)
+        os.replace(tmp_fn, fn)
+    return n_terms
+
+
+def open_inverted_index(index_dir: str) -> InvertedIndex:
+    """Memory-map an index saved by `save_inverted_index`."""
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+
+    postings = {x: Postings(*[load(f'{x}_{y}') for y in Postings._fields])
+                for x in POSTINGS}
+    return InvertedIndex(current=load('current_rows'), **postings)
+
+
+def term_rows(postings: Postings, term: str) -> np.ndarray:
+    """Find the sorted rows of a normalized term."""
+    key = np.array(term.encode('utf-8'))
+    if key.dtype.itemsize > postings.terms.dtype.itemsize:
+        return np.zeros(0, dtype=np.int64)
+    i = np.searchsorted(postings.terms, key)
+    if i == len(postings.terms) or postings.terms[i] != key:
+        return np.zeros(0, dtype=np.int64)
+    return np.asarray(postings.rows[postings.offsets[i]:
+                                    postings.offsets[i + 1]])
+
+
+def postcode_rows(index: InvertedIndex, postcode: str) -> np.ndarray:
+    """Find the rows of a postal code."""
+    return term_rows(index.postcode, normalize_term(postcode))
+
+
+def street_rows(index: InvertedIndex, region: str, city: str,
+                street: str) -> np.ndarray:
+    """Find the rows of a street of a city (or a place) of a region
+    (given by its ISO code, e.g. 'MOW').
+    """
+    terms = [normalize_term(x) for x in [region, city, street]]
+    return term_rows(index.street, SEPARATOR.join(terms))
+
+
+def binary_member(haystack: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """Test which of the `needles` are in the sorted `haystack` by
+    binary search, which only reads a few pages of a long mapped list.
+    """
+    pos = np.searchsorted(haystack, needles)
+    found = pos < len(haystack)
+    found[found] = haystack[pos[found]] == needles[found]
+    return found
+
+
+def find_rows(index: InvertedIndex, postcode: Optional[str] = None,
+              street: Optional[Tuple[str, str, str]] = None,
+              current: bool = False) -> np.ndarray:
+    """Find the sorted rows that match all of the given conditions: a
+    postal code, a (region, city, street) triple and, if `current` is
+    set, only current postcode records. The shortest row list is
+    searched for in the others.
+    """
+    lists = []
+    if postcode is not None:
+        lists.append(postcode_rows(index, postcode))
+    if street is not None:
+        lists.append(street_rows(index, *street))
+    if not lists:
+        raise ValueError('A postcode or a street is required.')
+    if current:
+        lists.append(index.current)
+    lists.sort(key=len)
+    rows = lists[0]
+    for other in lists[1:]:
+        rows = rows[binary_member(other, rows)]
+    return np.asarray(rows)
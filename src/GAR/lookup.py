@@ -0,0 +1,226 @@
+"""
+GAR
+===
+
+Lookup
+------
+
+A submodule of the GAR package that builds a GUID lookup index of the
+export and answers point and batch lookups from it.
+
+The index is built alongside the export (see `merge_to_csv`) into a
+directory of three files:
+- `data.arrow` - the exported rows in export order, an uncompressed
+  Arrow IPC file with plain (not dictionary encoded) columns,
+- `guid.npy` - the house GUIDs of all rows as sorted 16-byte keys,
+- `row.npy` - the row number in `data.arrow` of every key.
+All three are memory-mapped by `open_guid_index`, so lookups read only
+the pages of the keys and rows they touch. The rows of a GUID (one per
+postcode record of a house) follow each other in the sorted keys.
+"""
+
+from collections import namedtuple
+import os
+from typing import Dict, List, Sequence, Tuple, Union
+import uuid
+
+from loguru import logger
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+DATA_FILE = 'data.arrow'
+GUID_FILE = 'guid.npy'
+ROW_FILE = 'row.npy'
+GUID_COLUMN = 'guid'
+INT_COLUMNS = ['id', 'current']
+# value of every hex digit character, 255 - not a hex digit
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+HEX_VALUES[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = range(16)
+HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = range(10, 16)
+# batches of up to this many GUID strings are converted in Python
+SMALL_BATCH = 64
+
+IndexWriter = namedtuple('IndexWriter',
+                         'index_dir tmp_fn sink schema writer keys rows '
+                         'sizes')
+GuidIndex = namedtuple('GuidIndex', 'guids rows reader offsets')
+
+
+def guid_keys(guids: Union[pa.Array, pa.ChunkedArray, Sequence[str]]
+              ) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert GUID strings to 16-byte keys (`S16`) that sort as the
+    lowercase strings do. Return the keys and a mask of valid GUIDs;
+    keys of invalid or missing GUIDs are zero.
+    """
+    is_arrow = isinstance(guids, (pa.Array, pa.ChunkedArray))
+    if not is_arrow and len(guids) <= SMALL_BATCH:
+        return small_guid_keys(guids)
+    text = guids if is_arrow else pa.array(guids, pa.large_string())
+    text = pc.cast(text, pa.large_string())
+    if isinstance(text, pa.ChunkedArray):
+        text = text.combine_chunks()
+    text = pc.replace_substring(text, '-', '')
+    valid = pc.fill_null(pc.equal(pc.binary_length(text), 32), False)
+    valid = valid.to_numpy(zero_copy_only=False)
+    text = pc.if_else(valid, text, '0' * 32)
+    keys = np.zeros((len(text), 16), dtype=np.uint8)
+    if len(text):
+        _, offsets, data = text.buffers()
+        offsets = np.frombuffer(offsets, dtype=np.int64,
+                                count=len(text) + 1, offset=text.offset * 8)
+        chars = np.frombuffer(data, dtype=np.uint8, count=offsets[-1],
+                              offset=0)[offsets[0]:offsets[-1]]
+        digits = HEX_VALUES[chars.reshape(-1, 32)]
+        valid &= (digits != 255).all(axis=1)
+        keys = (digits[:, 0::2] << 4) | (digits[:, 1::2] & 15)
+        keys[~valid] = 0
+    return np.ascontiguousarray(keys).view('S16').reshape(-1), valid
+
+
+def small_guid_keys(guids: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """`guid_keys` of a few GUID strings, without the per call overhead
+    of Arrow kernels.
+    """
+    keys = np.zeros(len(guids), dtype='S16')
+    valid = np.zeros(len(guids), dtype=bool)
+    for i, guid in enumerate(guids):
+        digits = guid.replace('-', '') if isinstance(guid, str) else ''
+        if len(digits) == 32:
+            try:
+                keys[i] = bytes.fromhex(digits)
+                valid[i] = True
+            except ValueError:
+                pass
+    return keys, valid
+
+
+def index_schema(columns: List[str]) -> pa.Schema:
+    """Schema of the data file: `INT_COLUMNS` are int64 and all other
+    columns plain large strings, so that regions with different
+    dictionaries fit one file.
+    """
+    return pa.schema([(x, pa.int64() if x in INT_COLUMNS
+                       else pa.large_string()) for x in columns])
+
+
+def open_index_writer(index_dir: str, columns: List[str]) -> IndexWriter:
+    """Start building a GUID index of export tables with `columns` in
+    `index_dir`.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_fn = os.path.join(index_dir, f'{DATA_FILE}.{uuid.uuid4().hex}.tmp')
+    sink = pa.OSFile(tmp_fn, 'wb')
+    schema = index_schema(columns)
+    return IndexWriter(index_dir=index_dir, tmp_fn=tmp_fn, sink=sink,
+                       schema=schema, writer=pa.ipc.new_file(sink, schema),
+                       keys=[], rows=[], sizes=[])
+
+
+def write_index_table(index: IndexWriter, table: pa.Table) -> None:
+    """Append an export table (with a `guid` column) to the index. Rows
+    with invalid GUIDs are written but not indexed.
+    """
+    keys, valid = guid_keys(table[GUID_COLUMN])
+    if not valid.all():
+        logger.warning(f'{len(valid) - valid.sum()} rows with invalid '
+                       f'GUIDs are not indexed.')
+    index.keys.append(keys[valid])
+    index.rows.append(np.flatnonzero(valid) + sum(index.sizes))
+    index.sizes.append(table.num_rows)
+    index.writer.write_table(table.cast(index.schema))
+
+
+def close_index_writer(index: IndexWriter, complete: bool = True) -> int:
+    """Sort the keys and replace the index files, or discard the index
+    if it is not `complete`. Return the number of rows indexed.
+    """
+    index.writer.close()
+    index.sink.close()
+    if not complete:
+        os.remove(index.tmp_fn)
+        return 0
+    keys = np.concatenate([np.zeros(0, dtype='S16')] + index.keys)
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + index.rows)
+    parts = keys.view('>u8').reshape(-1, 2)
+    order = np.lexsort((parts[:, 1], parts[:, 0]))
+    for name, values in [(GUID_FILE, keys[order]), (ROW_FILE, rows[order])]:
+        fn = os.path.join(index.index_dir, name)
+        tmp_fn = f'{fn}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_fn, 'wb') as fh:
+            np.save(fh, values)
+        os.replace(tmp_fn, fn)
+    os.replace(index.tmp_fn, os.path.join(index.index_dir, DATA_FILE))
+    return len(keys)
+
+
+def open_guid_index(index_dir: str) -> GuidIndex:
+    """Memory-map a GUID index built by `close_index_writer`."""
+    source = pa.memory_map(os.path.join(index_dir, DATA_FILE))
+    reader = pa.ipc.open_file(source)
+    sizes = [reader.get_batch(i).num_rows
+             for i in range(reader.num_record_batches)]
+    return GuidIndex(
+        guids=np.load(os.path.join(index_dir, GUID_FILE), mmap_mode='r'),
+        rows=np.load(os.path.join(index_dir, ROW_FILE), mmap_mode='r'),
+        reader=reader, offsets=np.cumsum([0] + sizes))
+
+
+def find_rows(index: GuidIndex, guids: Sequence[str]
+              ) -> Tuple[np.ndarray, np.ndarray]:
+    """Binary search GUIDs in the index. Return the position in `guids`
+    and the data row of every match, in the order of `guids` (rows of
+    one GUID in export order).
+    """
+    keys, valid = guid_keys(guids)
+    order = np.argsort(keys, kind='stable')
+    lo = np.empty(len(keys), dtype=np.int64)
+    hi = np.empty(len(keys), dtype=np.int64)
+    lo[order] = np.searchsorted(index.guids, keys[order], side='left')
+    hi[order] = np.searchsorted(index.guids, keys[order], side='right')
+    counts = np.where(valid, hi - lo, 0)
+    query = np.repeat(np.arange(len(keys)), counts)
+    starts = np.cumsum(counts) - counts
+    pos = np.arange(counts.sum()) + np.repeat(lo - starts, counts)
+    return query, np.asarray(index.rows[pos])
+
+
+def read_rows(index: GuidIndex, rows: np.ndarray) -> pa.Table:
+    """Read data rows by number, in the given order. Consecutive rows
+    of a record batch (as the rows of one house are) are sliced rather
+    than taken.
+    """
+    batches = np.searchsorted(index.offsets, rows, side='right') - 1
+    order = np.argsort(batches, kind='stable')
+    pieces = []
+    starts = np.flatnonzero(np.diff(batches[order], prepend=-1))
+    for lo, hi in zip(starts, np.append(starts[1:], len(rows))):
+        b = batches[order[lo]]
+        batch = index.reader.get_batch(b)
+        positions = rows[order[lo:hi]] - index.offsets[b]
+        if (np.diff(positions) == 1).all():
+            pieces.append(batch.slice(positions[0], len(positions)))
+        else:
+            pieces.append(batch.take(positions))
+    if not pieces:
+        return index.reader.schema.empty_table()
+    table = pa.Table.from_batches(pieces)
+    if (np.diff(order) == 1).all():
+        return table
+    return table.take(np.argsort(order))
+
+
+def lookup_guids(index: GuidIndex, guids: Sequence[str]) -> pa.Table:
+    """Look up a batch of GUIDs and return all their rows with a `query`
+    column (the position of the GUID in `guids`). Unknown and invalid
+    GUIDs have no rows.
+    """
+    query, rows = find_rows(index, guids)
+    table = read_rows(index, rows)
+    return table.append_column('query', pa.array(query, pa.int64()))
+
+
+def lookup_guid(index: GuidIndex, guid: str) -> List[Dict]:
+    """Look up the rows of a single GUID as dicts."""
+    return read_rows(index, find_rows(index, [guid])[1]).to_pylist()
@@ -10,24 +10,36 @@ A module that acts as the coordinating processor of the GAR dataset.
 
 import os
 import sys
+from typing import List, Optional
 
 from loguru import logger
 
-from GAR.file_utils import get_list_of_active_regions
-from GAR.region import process_region
+from GAR.config import Config, get_config
+from GAR.file_utils import get_active_filesizes
 from GAR.merge_to_csv import merge_all_files
+from GAR.metrics import collect_metrics
 from GAR.changelog import make_changelog
+from GAR.pipeline import run_pipeline
+from GAR.scheduler import (Result, make_tasks, report_results, run_pool,
+                           run_serial)
 
 
-def process_all_regions(src_zip_fn: str, dest_dir: str) -> None:
-    """Process all regions one by one in a multiprocess pool and
-    serialize the results to a `dest_dir` directory.
+def process_all_regions(src_zip_fn: str, dest_dir: str,
+                        config: Optional[Config] = None) -> List[Result]:
+    """Process all regions in a multiprocess pool (`config.workers`
+    processes, one by one if it is 1) and serialize the results to a
+    `dest_dir` directory. Largest regions are started first.
     """
+    config = get_config() if config is None else config
     os.makedirs(dest_dir, exist_ok=True)
-    regions = get_list_of_active_regions(src_zip_fn)
-    for region in regions:
-        process_region(src_zip_fn, region, dest_dir)
+    tasks = make_tasks(get_active_filesizes(src_zip_fn))
+    if config.workers == 1:
+        results = run_serial(tasks, src_zip_fn, dest_dir, config)
+    else:
+        results = run_pool(tasks, src_zip_fn, dest_dir, config)
     print('')
+    report_results(results)
+    return results
 
 
 def greeting() -> None:
@@ -64,14 +76,31 @@ def main() -> int:
     ddir = sys.argv[2]
     dcsv = sys.argv[3]
     pcsv = sys.argv[4]
-    logger.info(f'Starting processing {zfn} -> {ddir}')
-    process_all_regions(zfn, ddir)
-    logger.info(f'Processing complete. Starting export {ddir} -> {dcsv}')
-    merge_all_files(ddir, dcsv)
+    config = get_config()
+    logger.info(f'Starting processing {zfn} -> {ddir} '
+                f'({config.workers} workers)')
+    if config.pipeline:
+        logger.info(f'Processing and exporting {ddir} -> {dcsv}')
+        results = run_pipeline(zfn, ddir, dcsv, config)
+        print('')
+        report_results(results)
+        if not all(x.ok for x in results):
+            logger.error('Some regions failed, export is incomplete.')
+            return 1
+    else:
+        results = process_all_regions(zfn, ddir, config)
+        if not all(x.ok for x in results):
+            logger.error('Some regions failed, export is not started.')
+            return 1
+        logger.info(f'Processing complete. Starting export {ddir} -> {dcsv}')
+        merge_all_files(ddir, dcsv, config)
     logger.success('Export complete.')
     remove_temp_dir(ddir)
     logger.info(f'Export complete. Starting change log {pcsv}:{dcsv}')
-    make_changelog(pcsv, dcsv, ddir)
+    make_changelog(pcsv, dcsv, ddir, config)
+    if config.metrics_dir:
+        collect_metrics(config.metrics_dir)
+        logger.info(f'Metrics saved to {config.metrics_dir}.')
     logger.success('All done.')
     return 0
 
@@ -6,36 +6,204 @@ Merge files to CSV
 ------------------
 
 Merge all region files into a single CSV file.
+
+Region files are streamed through a single buffered output handle.
+Rows are formatted column-wise with pyarrow compute kernels (quoting
+as the csv module does with QUOTE_MINIMAL), and the `id` column is
+numbered across all regions. A GUID lookup index of the export (see
+`GAR.lookup`) is built at the same time if `config.lookup_dir` is set,
+and the inverted indexes of the regions (see `GAR.inverted`) are merged
+if `config.inverted_dir` is set.
 """
 
 import os
+import time
+from typing import BinaryIO, Dict, List, Optional
 
 from loguru import logger
-import pandas as pd
-
-
-def merge_all_files(src_dir: str, dest_fn: str) -> None:
-    """Merge all individual region files into a single CSV file."""
-    official_columns = ['id', 'guid', 'current', 'postalcode', 'housenum',
-                        'buildnum', 'strucnum', 'housenum_en', 'buildnum_en',
-                        'strucnum_en', 'street_s', 'street_f', 'street_s_en',
-                        'street_f_en', 'terr_s', 'terr_f', 'terr_s_en',
-                        'terr_f_en', 'place_s', 'place_f', 'place_s_en',
-                        'place_f_en', 'city_s', 'city_f', 'city_s_en',
-                        'city_f_en', 'muni_s', 'muni_f', 'muni_s_en',
-                        'muni_f_en', 'munr_s', 'munr_f', 'munr_s_en',
-                        'munr_f_en', 'region_s', 'region_f', 'region_s_en',
-                        'region_f_en', 'region_iso_code']
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from GAR.config import Config
+from GAR.inverted import load_region_index, save_inverted_index
+from GAR.lookup import (IndexWriter, close_index_writer, open_index_writer,
+                        write_index_table)
+from GAR.metrics import measure, save_metrics
+
+
+OFFICIAL_COLUMNS = ['id', 'guid', 'current', 'postalcode', 'housenum',
+                    'buildnum', 'strucnum', 'housenum_en', 'buildnum_en',
+                    'strucnum_en', 'street_s', 'street_f', 'street_s_en',
+                    'street_f_en', 'terr_s', 'terr_f', 'terr_s_en',
+                    'terr_f_en', 'place_s', 'place_f', 'place_s_en',
+                    'place_f_en', 'city_s', 'city_f', 'city_s_en',
+                    'city_f_en', 'muni_s', 'muni_f', 'muni_s_en',
+                    'muni_f_en', 'munr_s', 'munr_f', 'munr_s_en',
+                    'munr_f_en', 'region_s', 'region_f', 'region_s_en',
+                    'region_f_en', 'region_iso_code']
+SEPARATOR = '¬'
+# characters that make a field quoted
+QUOTE_PATTERN = f'[{SEPARATOR}"\r\n]'
+EMPTY = pa.scalar('', pa.large_string())
+BATCH_ROWS = 2**18
+BUFFER_SIZE = 2**24
+
+
+def csv_field(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Convert a column to CSV field text: missing values become empty
+    strings and fields containing the separator, quotes or line breaks
+    are quoted with inner quotes doubled.
+    """
+    text = pc.cast(column, pa.large_string())
+    text = pc.fill_null(text, '')
+    needs_quotes = pc.match_substring_regex(text, QUOTE_PATTERN)
+    if not pc.any(needs_quotes).as_py():
+        return text
+    escaped = pc.replace_substring(text, '"', '""')
+    quote = pa.scalar('"', pa.large_string())
+    quoted = pc.binary_join_element_wise(quote, escaped, quote, EMPTY)
+    return pc.if_else(needs_quotes, quoted, text)
+
+
+def format_csv_lines(table: pa.Table) -> memoryview:
+    """Format a table as CSV lines (without header) and return a view
+    of the resulting UTF-8 text.
+    """
+    fields = [csv_field(table[x]) for x in table.column_names]
+    sep = pa.scalar(SEPARATOR, pa.large_string())
+    lines = pc.binary_join_element_wise(*fields, sep)
+    newline = pa.scalar('\n', pa.large_string())
+    lines = pc.binary_join_element_wise(lines, EMPTY, newline)
+    lines = lines.combine_chunks()
+    if len(lines) == 0:
+        return memoryview(b'')
+    _, offsets, data = lines.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64, count=len(lines) + 1,
+                            offset=lines.offset * 8)
+    return memoryview(data)[offsets[0]:offsets[-1]]
+
+
+def write_csv_header(fh: BinaryIO) -> None:
+    """Write the header line of the export."""
+    fh.write((SEPARATOR.join(OFFICIAL_COLUMNS) + '\n').encode('utf-8'))
+
+
+def read_region_table(fea_fn: str, first_id: int) -> pa.Table:
+    """Read a region file as an export table with official columns and
+    `id`s numbered from `first_id`.
+    """
+    table = feather.read_table(fea_fn)
+    ids = pa.array(np.arange(first_id, first_id + table.num_rows))
+    table = table.append_column('id', ids)
+    names = ['guid' if x == 'objectguid' else x for x in table.column_names]
+    table = table.rename_columns(names)
+    return table.select(OFFICIAL_COLUMNS)
+
+
+def write_region_csv(fh: BinaryIO, fea_fn: str, first_id: int,
+                     index: Optional[IndexWriter] = None) -> int:
+    """Append a region file to an open CSV export (and to a GUID lookup
+    `index`, if given) and return the number of rows written.
+    """
+    table = read_region_table(fea_fn, first_id)
+    if index is not None:
+        write_index_table(index, table)
+    for start in range(0, table.num_rows, BATCH_ROWS):
+        fh.write(format_csv_lines(table.slice(start, BATCH_ROWS)))
+    return table.num_rows
+
+
+def open_lookup_index(config: Optional[Config]) -> Optional[IndexWriter]:
+    """Start a GUID lookup index of the export in `config.lookup_dir`,
+    if it is set.
+    """
+    if config is None or not config.lookup_dir:
+        return None
+    return open_index_writer(config.lookup_dir, OFFICIAL_COLUMNS)
+
+
+def close_lookup_index(index: Optional[IndexWriter], records: List[Dict],
+                       config: Optional[Config],
+                       complete: bool = True) -> None:
+    """Sort and save a GUID lookup index started by `open_lookup_index`
+    (measured as the `lookup` stage), or discard it if the export is not
+    `complete`.
+    """
+    if index is None:
+        return
+    if not complete:
+        close_index_writer(index, complete=False)
+        return
+    with measure(records, 'lookup', config=config) as m:
+        m['rows_out'] = close_index_writer(index)
+    logger.success(f'Lookup index saved to {config.lookup_dir}.')
+
+
+def open_inverted_parts(config: Optional[Config]) -> Optional[List]:
+    """Start collecting the partial inverted indexes of the regions, if
+    `config.inverted_dir` is set.
+    """
+    if config is None or not config.inverted_dir:
+        return None
+    return []
+
+
+def add_region_index(parts: Optional[List], fea_fn: str,
+                     first_id: int) -> None:
+    """Collect the partial inverted index of an exported region file
+    whose rows start at `first_id`.
+    """
+    if parts is not None:
+        parts.append((load_region_index(fea_fn), first_id))
+
+
+def close_inverted_parts(parts: Optional[List], records: List[Dict],
+                         config: Optional[Config],
+                         complete: bool = True) -> None:
+    """Merge and save the collected partial inverted indexes (measured
+    as the `inverted` stage) if the export is `complete`.
+    """
+    if parts is None or not complete:
+        return
+    with measure(records, 'inverted', config=config) as m:
+        m['rows_out'] = save_inverted_index(parts, config.inverted_dir)
+    logger.success(f'Inverted indexes saved to {config.inverted_dir}.')
+
+
+def merge_all_files(src_dir: str, dest_fn: str,
+                    config: Optional[Config] = None) -> None:
+    """Merge all individual region files into a single CSV file. Per
+    region metrics are saved to `config.metrics_dir` if it is set.
+    A GUID lookup index is saved to `config.lookup_dir` and inverted
+    indexes to `config.inverted_dir` if they are set.
+    """
     fl = os.listdir(src_dir)
     fl = [x for x in fl if x[-4:] == '.fea']
     fl = sorted([os.path.join(src_dir, x) for x in fl])
-    for fn in fl:
-        logger.success(f'Merging {fn}...')
-        df = pd.read_feather(fn).reset_index()
-        df.rename(columns={'index': 'id', 'objectguid': 'guid'}, inplace=True)
-        if not os.path.isfile(dest_fn):
-            df[official_columns].to_csv(dest_fn, sep='\u00ac', index=False)
-        else:
-            df[official_columns].to_csv(dest_fn, mode='a', sep='\u00ac',
-                                        header=False, index=False)
+    t1 = time.perf_counter()
+    n_rows = 0
+    records = []
+    index = open_lookup_index(config)
+    parts = open_inverted_parts(config)
+    complete = False
+    try:
+        with open(dest_fn, 'wb', buffering=BUFFER_SIZE) as fh:
+            write_csv_header(fh)
+            for fn in fl:
+                region = os.path.splitext(os.path.basename(fn))[0]
+                with measure(records, 'export', region, config) as m:
+                    m['rows_out'] = write_region_csv(fh, fn, n_rows, index)
+                    add_region_index(parts, fn, n_rows)
+                n_rows += m['rows_out']
+                rate = round(n_rows / max(time.perf_counter() - t1, 1e-9))
+                logger.success(f'Merged {fn}: {n_rows} rows, '
+                               f'{rate} rows/sec.')
+        complete = True
+    finally:
+        close_lookup_index(index, records, config, complete)
+        close_inverted_parts(parts, records, config, complete)
+    if config is not None and config.metrics_dir:
+        save_metrics(records, config.metrics_dir, 'export')
     return None
@@ -0,0 +1,131 @@
+"""
+GAR
+===
+
+Metrics
+-------
+
+A submodule of the GAR package that instruments the stages of the
+pipeline. Every stage records its wall time, CPU time, peak RSS growth
+and row counts in and out, and some stages the memory of their input
+and output frames. Selected stages (`GAR_PROFILE_STAGES`) can
+also be run under cProfile and tracemalloc. Records are saved as JSON
+and CSV reports in `GAR_METRICS_DIR`, one pair of files per region and
+per export / change log run, and collected into a single `metrics.csv`
+that can be compared across runs.
+"""
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+from GAR.config import Config
+
+
+REPORT_COLUMNS = ['region', 'stage', 'wall_sec', 'cpu_sec', 'rss_delta_mb',
+                  'max_rss_mb', 'traced_peak_mb', 'rows_in', 'rows_out',
+                  'frame_mb_in', 'frame_mb_out']
+ROW_COLUMNS = ['rows_in', 'rows_out']
+
+
+def max_rss_mb() -> float:
+    """Return the peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def is_profiled(config: Optional[Config], stage: str) -> bool:
+    """Check if a stage is to be run under the profilers."""
+    return (config is not None and bool(config.metrics_dir)
+            and stage in config.profile_stages)
+
+
+def record_frames(record: Dict, side: str, frames: Iterable[pd.DataFrame],
+                  config: Optional[Config] = None) -> None:
+    """Set the row count of the input or output (`side`) frames of a
+    stage record and, if metrics are saved, their memory in MB.
+    """
+    frames = list(frames)
+    record[f'rows_{side}'] = sum(len(x) for x in frames)
+    if config is not None and config.metrics_dir:
+        size = sum(x.memory_usage(deep=True).sum() for x in frames)
+        record[f'frame_mb_{side}'] = round(size / 2**20, 2)
+
+
+@contextmanager
+def measure(records: List[Dict], stage: str, region: str = '',
+            config: Optional[Config] = None) -> Iterator[Dict]:
+    """Measure the stage run inside the `with` block and append its
+    record to `records`. The stage may set `rows_in` and `rows_out` of
+    the yielded record. If the stage is profiled (see `is_profiled`),
+    cProfile statistics are saved to `<region>_<stage>.prof` in
+    `config.metrics_dir` and the tracemalloc peak is recorded.
+    """
+    record = {x: None for x in REPORT_COLUMNS}
+    record.update(region=region, stage=stage)
+    profiled = is_profiled(config, stage)
+    if profiled:
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+    rss = max_rss_mb()
+    cpu = time.process_time()
+    t1 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_sec'] = round(time.perf_counter() - t1, 4)
+        record['cpu_sec'] = round(time.process_time() - cpu, 4)
+        record['max_rss_mb'] = round(max_rss_mb(), 1)
+        record['rss_delta_mb'] = round(record['max_rss_mb'] - rss, 1)
+        if profiled:
+            profiler.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            record['traced_peak_mb'] = round(peak / 2**20, 1)
+            os.makedirs(config.metrics_dir, exist_ok=True)
+            fn = f'{region or "run"}_{stage}.prof'
+            profiler.dump_stats(os.path.join(config.metrics_dir, fn))
+        records.append(record)
+
+
+def report_table(records: List[Dict]) -> pd.DataFrame:
+    """Convert stage records into a report table (row counts stay
+    integer where some are missing).
+    """
+    df = pd.DataFrame(records, columns=REPORT_COLUMNS)
+    df[ROW_COLUMNS] = df[ROW_COLUMNS].astype('Int64')
+    return df
+
+
+def save_metrics(records: List[Dict], metrics_dir: str, name: str) -> None:
+    """Save stage records as `<name>.json` and `<name>.csv` reports."""
+    os.makedirs(metrics_dir, exist_ok=True)
+    base = os.path.join(metrics_dir, name)
+    with open(f'{base}.json', 'w', encoding='utf-8') as fh:
+        json.dump(records, fh, indent=1)
+    report_table(records).to_csv(f'{base}.csv', index=False)
+
+
+def collect_metrics(metrics_dir: str) -> pd.DataFrame:
+    """Collect all JSON reports of a run into a single table and save it
+    as `metrics.csv`.
+    """
+    fl = sorted(x for x in os.listdir(metrics_dir)
+                if x.endswith('.json') and x != 'metrics.json')
+    records = []
+    for fn in fl:
+        with open(os.path.join(metrics_dir, fn), encoding='utf-8') as fh:
+            records += json.load(fh)
+    df = report_table(records)
+    df.to_csv(os.path.join(metrics_dir, 'metrics.csv'), index=False)
+    return df
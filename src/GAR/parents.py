@@ -7,69 +7,166 @@ Parents
 
 A submodule of the GAR package that contains functions to traverse the
 addresses parents hierarchy.
+
+The muni_hierarchy is encoded as a NumPy parent pointer array over a
+dense remap of OBJECTIDs. Ancestor chains are resolved with array
+gathers once per address object, and houses pick up their parents from
+that table through their direct parent.
 """
 
-import math
+from collections import namedtuple
+from typing import Optional
 
+import numpy as np
 import pandas as pd
 
 
-def fill_parents(hl: pd.DataFrame, mh: pd.DataFrame,
-                 ao: pd.DataFrame) -> pd.DataFrame:
-    """Fill parent information for every house subsequently."""
-    p = hl.copy()
-    p.rename(columns={'OBJECTID': 'px'}, inplace=True)
-    mhf = mh[['OBJECTID', 'PARENTOBJID']].copy()
-    aof = ao[['OBJECTID', 'NAME', 'TYPENAME', 'LEVEL']].copy()
-    for i in range(1, 7):
-        p = p.merge(mhf, how='left', left_on='px', right_on='OBJECTID')
-        p = p.drop('OBJECTID', axis=1)
-        p = p.merge(aof, how='left', left_on='PARENTOBJID', right_on='OBJECTID')
-        p = p.rename(columns={'px':f'p{i - 1}'})
-        p = p.rename(columns={'NAME':f'n{i}', 'TYPENAME':f't{i}', 'LEVEL':f'l{i}'})
-        p = p.drop('PARENTOBJID', axis=1)
-        p = p.rename(columns={'OBJECTID':'px'})
-    maxlevel = p.l6.max()
-    assert math.isnan(maxlevel) or maxlevel == 1  # i.e. top level is `region`
-    return p.reset_index(drop=True)
-
-
-def format_final(hl_w_parents: pd.DataFrame) -> pd.DataFrame:
-    """Prepare a formatted stub of the final table, i.e. create and
-    fill all required columns with default values.
+# Output levels, ao LEVEL 1 is REGION, 2 is ADMR, ..., 8 is STREET
+LEVELS = ['STREET', 'TERR', 'PLACE', 'CITY', 'MUNI', 'MUNR', 'ADMR', 'REGION']
+DEPTH = 6
+
+Hierarchy = namedtuple('Hierarchy', 'ids parent level name typename '
+                                     'name_categories type_categories')
+AncestorTable = namedtuple('AncestorTable', 'hierarchy row names types top')
+
+
+def dictionary_encode(values: pd.Series) -> tuple:
+    """Dictionary-encode a string column: return its category codes and
+    the categories, with '' always among the categories, and the code of
+    ''.
+    """
+    cat = values.astype('category')
+    if '' not in cat.cat.categories:
+        cat = cat.cat.add_categories([''])
+    categories = cat.cat.categories
+    empty = categories.get_loc('')
+    return cat.cat.codes.to_numpy(), categories, empty
+
+
+def encode_hierarchy(mh: pd.DataFrame, ao: pd.DataFrame) -> Hierarchy:
+    """Encode muni_hierarchy and ao as flat arrays indexed by dense
+    object positions (`ids` holds the sorted OBJECTIDs). `parent` points
+    to the position of the parent ao, or -1 if the parent is not an
+    active ao. NAME and TYPENAME are kept as category codes. Every array
+    has an extra sentinel element at the end, so that position -1 can be
+    gathered safely.
+    """
+    ao_ids = ao.OBJECTID.to_numpy(dtype=np.int64)
+    mh_ids = mh.OBJECTID.to_numpy(dtype=np.int64)
+    mh_par = mh.PARENTOBJID.to_numpy(dtype=np.int64)
+    ids = np.unique(np.concatenate([ao_ids, mh_ids, mh_par]))
+    n = len(ids)
+    ao_pos = np.searchsorted(ids, ao_ids)
+    child = np.searchsorted(ids, mh_ids)
+    par = np.searchsorted(ids, mh_par)
+    is_ao = np.zeros(n + 1, dtype=bool)
+    is_ao[ao_pos] = True
+    keep = is_ao[par]
+    parent = np.full(n + 1, -1, dtype=np.int64)
+    parent[child[keep]] = par[keep]
+    level = np.full(n + 1, -1, dtype=np.int64)
+    level[ao_pos] = ao.LEVEL.to_numpy(dtype=np.int64)
+    name_codes, name_categories, name_empty = dictionary_encode(ao.NAME)
+    name = np.full(n + 1, name_empty, dtype=np.int32)
+    name[ao_pos] = name_codes
+    type_codes, type_categories, type_empty = dictionary_encode(ao.TYPENAME)
+    typename = np.full(n + 1, type_empty, dtype=np.int32)
+    typename[ao_pos] = type_codes
+    return Hierarchy(ids=ids, parent=parent, level=level, name=name,
+                     typename=typename, name_categories=name_categories,
+                     type_categories=type_categories)
+
+
+def lookup_positions(ids: np.ndarray, objectids: pd.Series) -> np.ndarray:
+    """Map OBJECTIDs to dense positions in `ids` (-1 if absent)."""
+    oid = objectids.to_numpy(dtype=np.int64)
+    pos = np.searchsorted(ids, oid)
+    pos[pos == len(ids)] = 0
+    found = (ids[pos] == oid) if len(ids) else np.zeros(len(oid), bool)
+    return np.where(found, pos, -1)
+
+
+def build_ancestor_table(mh: pd.DataFrame,
+                         ao: pd.DataFrame) -> AncestorTable:
+    """Resolve the ancestry of every address object once. Row `r` of
+    `names`/`types` holds the level-by-level NAME/TYPENAME codes of ao
+    `r` and its ancestors (`DEPTH` objects in total, a higher one
+    overrides a lower one of the same level), i.e. everything a house
+    whose direct parent is that ao inherits. `row` maps dense object
+    positions to table rows and `top` keeps the level of the last
+    object of each chain. The last table row is an empty sentinel.
+    The table depends on mh and ao only, so it can be reused for any
+    number of house lists of the region.
+    """
+    hierarchy = encode_hierarchy(mh, ao)
+    ao_pos = lookup_positions(hierarchy.ids, ao.OBJECTID)
+    n = len(ao_pos)
+    row = np.full(len(hierarchy.parent), -1, dtype=np.int64)
+    row[ao_pos] = np.arange(n)
+    names = np.full((n + 1, len(LEVELS) + 1), hierarchy.name[-1],
+                    dtype=np.int32)
+    types = np.full((n + 1, len(LEVELS) + 1), hierarchy.typename[-1],
+                    dtype=np.int32)
+    rows = np.arange(n)
+    cur = ao_pos
+    for step in range(DEPTH):
+        if step:
+            cur = hierarchy.parent[cur]
+        lvl = hierarchy.level[cur]
+        ok = (lvl >= 1) & (lvl <= len(LEVELS))
+        names[rows[ok], lvl[ok]] = hierarchy.name[cur[ok]]
+        types[rows[ok], lvl[ok]] = hierarchy.typename[cur[ok]]
+    top = np.append(hierarchy.level[cur], -1)
+    return AncestorTable(hierarchy=hierarchy, row=row, names=names,
+                         types=types, top=top)
+
+
+def fill_parents(hl: pd.DataFrame, table: AncestorTable) -> np.ndarray:
+    """Find the ancestor table row of every house, i.e. the row of its
+    direct parent ao (the sentinel row if there is none).
+    """
+    hierarchy = table.hierarchy
+    pos = lookup_positions(hierarchy.ids, hl.OBJECTID)
+    rows = table.row[hierarchy.parent[pos]]
+    top = table.top[rows]
+    found = top[top >= 0]
+    maxlevel = found.max() if len(found) else None
+    assert maxlevel is None or maxlevel == 1  # i.e. top level is `region`
+    return rows
+
+
+def format_final(hl: pd.DataFrame, table: AncestorTable,
+                 rows: np.ndarray) -> pd.DataFrame:
+    """Compile the final table: house columns followed by the short
+    (`_S`) and full (`_F`) names of every parent level, gathered from
+    the ancestor table as categorical columns.
     """
     hcols = ['OBJECTGUID', 'CURRENT', 'POSTALCODE', 'HOUSENUM', 'BUILDNUM',
              'STRUCNUM']
-    fl = hl_w_parents[hcols].copy()
-    levels = ['STREET', 'TERR', 'PLACE', 'CITY', 'MUNI', 'MUNR', 'ADMR',
-              'REGION']
-    for level in levels:
-        fl[f'{level}_S'] = ''
-        fl[f'{level}_F'] = ''
-    return fl
-
-
-def spread_out_parents_by_level(format_hl: pd.DataFrame, parents_hl: pd.DataFrame) -> pd.DataFrame:
-    """Put values into their proper columns by level."""
-    r = format_hl.copy()
-    p = parents_hl.copy()
-    levels = ['STREET', 'TERR', 'PLACE', 'CITY', 'MUNI', 'MUNR', 'ADMR',
-              'REGION']
-    for idx, level in enumerate(levels[::-1], 1):
-        for col in range(1, 7):
-            r.loc[p[f'l{col}'] == idx, f'{level}_S'] = p[f't{col}']
-            r.loc[p[f'l{col}'] == idx, f'{level}_F'] = p[f'n{col}']
-    return r.reset_index(drop=True)
-
-
-def add_parents(hl: pd.DataFrame, mh: pd.DataFrame,
-                ao: pd.DataFrame) -> pd.DataFrame:
+    fl = hl[hcols].reset_index(drop=True)
+    columns = {x: fl[x] for x in hcols}
+    tcat = table.hierarchy.type_categories
+    ncat = table.hierarchy.name_categories
+    for level in LEVELS:
+        idx = len(LEVELS) - LEVELS.index(level)
+        columns[f'{level}_S'] = pd.Categorical.from_codes(
+            table.types[rows, idx], categories=tcat)
+        columns[f'{level}_F'] = pd.Categorical.from_codes(
+            table.names[rows, idx], categories=ncat)
+    return pd.DataFrame(columns)
+
+
+def add_parents(hl: pd.DataFrame, mh: pd.DataFrame, ao: pd.DataFrame,
+                table: Optional[AncestorTable] = None) -> pd.DataFrame:
     """Take formatted house list, muni_hierarchy source dataset and ao
     source dataset and compile all three into the ready region table.
+    A prebuilt ancestor `table` of the same mh and ao can be passed in
+    to skip the hierarchy resolution.
     """
-    parents = fill_parents(hl=hl, mh=mh, ao=ao)
-    empty_t = format_final(parents)
-    final = spread_out_parents_by_level(empty_t, parents)
+    if table is None:
+        table = build_ancestor_table(mh, ao)
+    rows = fill_parents(hl, table)
+    final = format_final(hl, table, rows)
     final.drop('ADMR_S', axis=1, inplace=True)
     final.drop('ADMR_F', axis=1, inplace=True)
     return final.reset_index(drop=True)
@@ -0,0 +1,172 @@
+"""
+GAR
+===
+
+Partition
+---------
+
+A submodule of the GAR package that splits the houses of an oversized
+region into partitions that are compiled one at a time (see
+`region.compile_partitions`), and merges the compiled partitions back
+into a single region file in the order of an unpartitioned run.
+
+Houses are grouped by their top municipal ancestor below the region,
+so that a partition holds whole municipal subtrees. If a single subtree
+is too large for evenly sized partitions, houses are spread by a hash
+of their OBJECTID instead.
+"""
+
+from collections import namedtuple
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from GAR.parents import DEPTH, Hierarchy, lookup_positions
+
+
+# estimated memory of a house list row while it is being compiled
+ROW_BYTES = 1024
+# largest subtree, relative to an even share, that still allows subtree
+# partitions
+MAX_SKEW = 1.5
+HASH_FACTOR = 2654435761
+MERGE_ROWS = 2**13
+# rows per record batch of a partition file
+PART_ROWS = 2**12
+
+Part = namedtuple('Part', 'fn objectids offsets')
+
+
+def count_partitions(n_rows: int, budget: int) -> int:
+    """Compute the number of partitions of a region with about `n_rows`
+    house list rows for a memory budget in bytes (0 - no limit).
+    """
+    if not budget:
+        return 1
+    return max(1, math.ceil(n_rows * ROW_BYTES / budget))
+
+
+def top_ancestors(objectids: pd.Series, hierarchy: Hierarchy) -> np.ndarray:
+    """Find the dense position of the top municipal ancestor below the
+    region of every house (-1 if a house has no parent).
+    """
+    pos = lookup_positions(hierarchy.ids, objectids)
+    cur = hierarchy.parent[pos]
+    for _ in range(DEPTH):
+        up = hierarchy.parent[cur]
+        move = (cur >= 0) & (up >= 0) & (hierarchy.level[up] != 1)
+        cur = np.where(move, up, cur)
+    return cur
+
+
+def assign_partitions(keys: np.ndarray, objectids: pd.Series,
+                      n_parts: int) -> Tuple[np.ndarray, str]:
+    """Assign every house to a partition. Subtrees (houses with the same
+    key, see `top_ancestors`) are packed largest first into the least
+    loaded partition, unless the largest one exceeds `MAX_SKEW` even
+    shares; then a hash of the OBJECTID is used. Return the partition
+    of every house and the method used ('subtree' or 'hash').
+    """
+    uniques, codes, counts = np.unique(keys, return_inverse=True,
+                                       return_counts=True)
+    if len(uniques) and counts.max() <= MAX_SKEW * len(keys) / n_parts:
+        load = np.zeros(n_parts, dtype=np.int64)
+        bins = np.zeros(len(uniques), dtype=np.int64)
+        for i in np.argsort(-counts, kind='stable'):
+            bins[i] = np.argmin(load)
+            load[bins[i]] += counts[i]
+        return bins[codes.reshape(-1)], 'subtree'
+    oid = objectids.to_numpy(dtype=np.int64)
+    return (oid * HASH_FACTOR) % 2**32 % n_parts, 'hash'
+
+
+def save_partition(df: pd.DataFrame, fn: str) -> Part:
+    """Save a compiled partition (with an `objectid` column) in record
+    batches of `PART_ROWS` rows and describe it for `merge_partitions`.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    batches = table.to_batches(max_chunksize=PART_ROWS)
+    with pa.OSFile(fn, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    offsets = np.cumsum([0] + [x.num_rows for x in batches])
+    return Part(fn=fn, objectids=df.objectid.to_numpy(), offsets=offsets)
+
+
+def read_rows(reader: pa.ipc.RecordBatchFileReader, part: Part, lo: int,
+              hi: int, cache: Dict) -> pa.Table:
+    """Read rows `lo:hi` of a partition file. The last record batch read
+    is kept in `cache`, as the next rows usually start in it.
+    """
+    first = np.searchsorted(part.offsets, lo, side='right') - 1
+    last = np.searchsorted(part.offsets, hi, side='left')
+    batches = []
+    for i in range(first, last):
+        if cache.get('index') != i:
+            cache.update(index=i, batch=reader.get_batch(i))
+        batches.append(cache['batch'])
+    table = pa.Table.from_batches(batches)
+    return table.slice(lo - part.offsets[first], hi - lo)
+
+
+def merge_partitions(parts: List[Part], dest_fn: str,
+                     state_fn: Optional[str] = None) -> int:
+    """Merge compiled partitions into a region file `dest_fn` (without
+    the `objectid` column) and, if given, a state region file
+    `state_fn` (with it). Rows are put in OBJECTID order, keeping the
+    order of the rows of every house, i.e. as in an unpartitioned run.
+    Every partition is read forward in `MERGE_ROWS` row steps of the
+    output, so only a few record batches are in memory at a time.
+    At least one (possibly empty) partition is required, as the schema
+    is taken from it. Return the number of rows.
+    """
+    if not parts:
+        raise ValueError('No partitions to merge.')
+    order = np.argsort(np.concatenate([x.objectids for x in parts]),
+                       kind='stable')
+    part_of = np.repeat(np.arange(len(parts)),
+                        [len(x.objectids) for x in parts])[order]
+    sources = [pa.OSFile(x.fn) for x in parts]
+    readers = [pa.ipc.open_file(x) for x in sources]
+    caches = [{} for _ in parts]
+    schema = readers[0].schema
+    columns = [x for x in schema.names if x != 'objectid']
+    dests = [(dest_fn, columns)]
+    if state_fn:
+        dests.append((state_fn, schema.names))
+    options = pa.ipc.IpcWriteOptions(compression='lz4')
+    tmp_fns, sinks, writers = [], [], []
+    for fn, cols in dests:
+        tmp_fns.append(f'{fn}.{uuid.uuid4().hex}.tmp')
+        sinks.append(pa.OSFile(tmp_fns[-1], 'wb'))
+        writers.append(pa.ipc.new_file(
+            sinks[-1], pa.schema([schema.field(x) for x in cols],
+                                 metadata=schema.metadata),
+            options=options))
+    done = np.zeros(len(parts), dtype=np.int64)
+    for start in range(0, len(order), MERGE_ROWS):
+        part = part_of[start:start + MERGE_ROWS]
+        counts = np.bincount(part, minlength=len(parts))
+        pieces, positions = [], []
+        for p in np.flatnonzero(counts):
+            pieces.append(read_rows(readers[p], parts[p], done[p],
+                                    done[p] + counts[p], caches[p]))
+            positions.append(np.flatnonzero(part == p))
+            done[p] += counts[p]
+        chunk = pa.concat_tables(pieces)
+        chunk = chunk.take(np.argsort(np.concatenate(positions)))
+        for writer, (_, cols) in zip(writers, dests):
+            writer.write_table(chunk.select(cols))
+    for source in sources:
+        source.close()
+    for writer, sink, tmp_fn, (fn, _) in zip(writers, sinks, tmp_fns, dests):
+        writer.close()
+        sink.close()
+        os.replace(tmp_fn, fn)
+    return len(order)
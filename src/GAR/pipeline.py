@@ -0,0 +1,153 @@
+"""
+GAR
+===
+
+Pipeline
+--------
+
+A submodule of the GAR package that overlaps region processing with
+the export. Regions are processed in region code order (possibly
+finishing out of order) and a writer thread appends every region to the
+final CSV file as soon as it is next in sequence, deleting its region
+file afterwards. A bounded queue between the two stages and a limit on
+the number of finished but unwritten regions keep memory and temporary
+disk use in check.
+"""
+
+import os
+from queue import Queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from GAR.config import Config, get_config
+from GAR.file_utils import get_active_filesizes
+from GAR.inverted import region_index_fn
+from GAR.merge_to_csv import (BUFFER_SIZE, add_region_index,
+                              close_inverted_parts, close_lookup_index,
+                              open_inverted_parts, open_lookup_index,
+                              write_csv_header, write_region_csv)
+from GAR.metrics import measure, save_metrics
+from GAR.scheduler import Result, Task, make_tasks, run_pool, run_serial
+
+
+def write_queue(queue: Queue, dest_fn: str, errors: List[str],
+                records: Optional[List[Dict]] = None,
+                config: Optional[Config] = None) -> None:
+    """Writer stage: take region file names from the `queue` until None
+    arrives and append them to the CSV file `dest_fn`. An error is
+    recorded in `errors` and the rest of the queue is drained unwritten,
+    so that the producer is never blocked. Per region metrics are
+    appended to `records`. A GUID lookup index and inverted indexes
+    are saved to `config.lookup_dir` and `config.inverted_dir` if they
+    are set and every region was written.
+    """
+    records = [] if records is None else records
+    t1 = time.perf_counter()
+    n_rows = 0
+    index = open_lookup_index(config)
+    parts = open_inverted_parts(config)
+    complete = False
+    try:
+        with open(dest_fn, 'wb', buffering=BUFFER_SIZE) as fh:
+            write_csv_header(fh)
+            while True:
+                fn = queue.get()
+                if fn is None:
+                    break
+                if errors:
+                    continue
+                region = os.path.splitext(os.path.basename(fn))[0]
+                try:
+                    with measure(records, 'export', region, config) as m:
+                        m['rows_out'] = write_region_csv(fh, fn, n_rows,
+                                                         index)
+                        add_region_index(parts, fn, n_rows)
+                    n_rows += m['rows_out']
+                    os.remove(fn)
+                    if os.path.isfile(region_index_fn(fn)):
+                        os.remove(region_index_fn(fn))
+                except Exception as e:
+                    logger.exception(f'Export of {fn} failed.')
+                    errors.append(repr(e))
+                    continue
+                rate = round(n_rows / max(time.perf_counter() - t1, 1e-9))
+                logger.success(f'Merged {fn}: {n_rows} rows, '
+                               f'{rate} rows/sec.')
+        complete = not errors
+    finally:
+        try:
+            close_lookup_index(index, records, config, complete)
+            close_inverted_parts(parts, records, config, complete)
+        except Exception as e:
+            logger.exception('Export indexes failed.')
+            errors.append(repr(e))
+
+
+def run_pipeline(src_zip_fn: str, dest_dir: str, dest_fn: str,
+                 config: Optional[Config] = None) -> List[Result]:
+    """Process all regions into a `dest_dir` directory and export them
+    to `dest_fn` at the same time. Regions are submitted in region code
+    order; a region is not started while `config.max_pending` finished
+    regions wait for the writer, unless it is the next one to be
+    written. After a failed region or a failed export no new regions
+    are started and the export stops. Regions that were never started
+    are reported as failed.
+    """
+    config = get_config() if config is None else config
+    os.makedirs(dest_dir, exist_ok=True)
+    tasks = make_tasks(get_active_filesizes(src_zip_fn))
+    tasks = sorted(tasks, key=lambda x: x.region)
+    order = [x.region for x in tasks]
+    state = {'next': 0, 'ready': set(), 'failed': False}
+    queue = Queue(maxsize=config.max_pending)
+    errors = []
+    records = []
+    writer = threading.Thread(target=write_queue,
+                              args=(queue, dest_fn, errors, records, config),
+                              daemon=True)
+    writer.start()
+
+    def stopped() -> bool:
+        # a failed region or a failed export stops the pipeline
+        return state['failed'] or bool(errors)
+
+    def on_result(result: Result) -> None:
+        if not result.ok:
+            state['failed'] = True
+            return
+        state['ready'].add(result.region)
+        while (not stopped() and state['next'] < len(order)
+               and order[state['next']] in state['ready']):
+            region = order[state['next']]
+            state['ready'].remove(region)
+            state['next'] += 1
+            queue.put(os.path.join(dest_dir, f'{region}.fea'))
+
+    def admit(task: Task) -> bool:
+        if stopped():
+            return False
+        if task.region == order[state['next']]:
+            return True
+        return len(state['ready']) + queue.qsize() < config.max_pending
+
+    try:
+        if config.workers == 1:
+            results = run_serial(tasks, src_zip_fn, dest_dir, config,
+                                 on_result, stopped)
+        else:
+            results = run_pool(tasks, src_zip_fn, dest_dir, config,
+                               on_result, admit)
+    finally:
+        queue.put(None)
+        writer.join()
+    if config.metrics_dir:
+        save_metrics(records, config.metrics_dir, 'export')
+    done = set(x.region for x in results)
+    results += [Result(x, False, 0.0, 'not started')
+                for x in order if x not in done]
+    if errors:
+        results.append(Result('export', False, 0.0, errors[0]))
+    return results
@@ -9,18 +9,29 @@ A submodule of the GAR package that contains functions necessary to
 process a single region of GAR address data.
 """
 
+from collections import namedtuple
 import os
-import time
+import shutil
+from typing import Dict, List, Optional
 
 from loguru import logger
+import numpy as np
 import pandas as pd
 
-from GAR.cast_types import cast_types
+from GAR.cache import load_all_data_cached
+from GAR.cast_types import cast_types, cast_types_compact
+from GAR.config import Config, get_config
 from GAR.file_utils import load_all_data
-from GAR.filter_data import filter_all
+from GAR.filter_data import ROW_FILTERS, filter_all
 from GAR.house_list import full_house_list
-from GAR.parents import add_parents
-from GAR.translit import translit_df
+from GAR.inverted import read_index_columns, region_index_fn, save_region_index
+from GAR.metrics import measure, record_frames, save_metrics
+from GAR.parents import AncestorTable, add_parents, build_ancestor_table
+from GAR.partition import (assign_partitions, count_partitions,
+                           merge_partitions, save_partition, top_ancestors)
+from GAR.state import (STATE_ATTRS, drop_ids, regions_dir, save_state_data,
+                       save_state_region)
+from GAR.translit import load_translit_memo, save_translit_memo, translit_df
 
 
 def add_region_iso_code(df: pd.DataFrame, reg_code: str) -> pd.DataFrame:
@@ -44,38 +55,229 @@ def add_region_iso_code(df: pd.DataFrame, reg_code: str) -> pd.DataFrame:
              '86': 'KHM', '87': 'CHU', '89': 'YAN', '91': 'CR', '92': 'SEV',
              '99': 'KZ-BAY'}
     res = df.copy()
-    res['region_iso_code'] = rciso[reg_code]
+    codes = np.zeros(len(res), dtype=np.int8)
+    res['region_iso_code'] = pd.Categorical.from_codes(
+        codes, categories=[rciso[reg_code]])
     return res
 
 
 def save_region(df: pd.DataFrame, save_fn: str) -> None:
-    """Serialize ready region data to disk."""
+    """Serialize ready region data to disk. Categorical columns are
+    stored dictionary-encoded.
+    """
     df.to_feather(save_fn)
 
 
-def process_region(src_zip_fn: str, reg_code: str, dest_dir: str) -> None:
-    """Extract region data from source archive, convert it as required
-    by contract and return ready data as a pandas DataFrame.
+def load_region_data(src_zip_fn: str, reg_code: str,
+                     config: Config) -> namedtuple:
+    """Load source data of a region, through the parsed data cache if
+    `config.cache_dir` is set. Record `ID`s are loaded too if
+    `config.state_dir` is set. The source files are parsed in
+    `config.load_workers` processes.
+    """
+    attrs = STATE_ATTRS if config.state_dir else None
+    if config.cache_dir:
+        return load_all_data_cached(src_zip_fn, reg_code, config.cache_dir,
+                                    config.cache_size, ROW_FILTERS, attrs,
+                                    config.load_workers, config.split_bytes)
+    return load_all_data(src_zip_fn, reg_code, ROW_FILTERS, attrs,
+                         config.load_workers, config.split_bytes)
+
+
+def translit_region(region: pd.DataFrame, config: Config,
+                    memo: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """Transliterate region data, through the persistent memo table if
+    `config.translit_memo` is set. A `memo` already loaded by the caller
+    is updated but not saved.
+    """
+    if not config.translit_memo:
+        return translit_df(region)
+    if memo is not None:
+        return translit_df(region, memo)
+    memo = load_translit_memo(config.translit_memo)
+    n_known = len(memo)
+    region = translit_df(region, memo)
+    if len(memo) > n_known:
+        save_translit_memo(memo, config.translit_memo)
+    return region
+
+
+def count_rows(data: namedtuple) -> int:
+    """Count the rows of all DataFrames of a namedtuple."""
+    return sum(len(x) for x in data)
+
+
+def prepare_region(data: namedtuple, reg_code: str, config: Config,
+                   records: List[Dict]) -> namedtuple:
+    """Cast and filter loaded source data of a region. Source columns
+    are cast to compact types if `config.compact` is set.
     """
-    t1 = time.perf_counter()
-    data = load_all_data(src_zip_fn, reg_code)
-    logger.trace('load_all_data completed')
-    data = cast_types(data)
+    with measure(records, 'cast', reg_code, config) as m:
+        record_frames(m, 'in', data, config)
+        data = cast_types_compact(data) if config.compact else \
+            cast_types(data)
+        record_frames(m, 'out', data, config)
     logger.trace('cast_types completed')
-    data = filter_all(data)
+    with measure(records, 'filter', reg_code, config) as m:
+        record_frames(m, 'in', data, config)
+        data = filter_all(data)
+        record_frames(m, 'out', data, config)
     logger.trace('filter_all completed')
-    f_hl = full_house_list(hs=data.hs, hp=data.hp)
+    return data
+
+
+def compile_houses(hs: pd.DataFrame, hp: pd.DataFrame, data: namedtuple,
+                   reg_code: str, config: Config, records: List[Dict],
+                   table: Optional[AncestorTable] = None,
+                   memo: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """Compile ready data of the houses `hs` (with their postcode
+    records `hp`) out of prepared region data (see `prepare_region`),
+    with an extra `objectid` column. A prebuilt ancestor `table` of the
+    region (see `parents.add_parents`) and a loaded translit `memo` (see
+    `translit_region`) can be passed in.
+    """
+    with measure(records, 'house_list', reg_code, config) as m:
+        record_frames(m, 'in', [hs, hp], config)
+        f_hl = full_house_list(hs=hs, hp=hp)
+        record_frames(m, 'out', [f_hl], config)
     logger.trace('full_house_list completed')
-    region = add_parents(hl=f_hl, mh=data.mh, ao=data.ao)
+    with measure(records, 'parents', reg_code, config) as m:
+        record_frames(m, 'in', [f_hl], config)
+        region = add_parents(hl=f_hl, mh=data.mh, ao=data.ao, table=table)
+        record_frames(m, 'out', [region], config)
     logger.trace('add_parents completed')
-    region = translit_df(region)
+    with measure(records, 'translit', reg_code, config) as m:
+        record_frames(m, 'in', [region], config)
+        region = translit_region(region, config, memo)
+        record_frames(m, 'out', [region], config)
     logger.trace('translit_df completed')
     region = add_region_iso_code(region, reg_code)
     logger.trace('add_region_iso_code completed')
     region.columns = [x.lower() for x in region.columns]
-    filename = os.path.join(dest_dir, f'{reg_code}.fea')
-    save_region(region, filename)
-    logger.trace('save_region completed')
-    t2 = time.perf_counter()
-    t = round(t2 - t1, 2)
+    region['objectid'] = f_hl.OBJECTID.to_numpy()
+    return region
+
+
+def compile_region(data: namedtuple, reg_code: str, config: Config,
+                   objectids: Optional[np.ndarray] = None,
+                   records: Optional[List[Dict]] = None) -> pd.DataFrame:
+    """Convert loaded source data of a region as required by contract
+    and return ready data with an extra `objectid` column (the OBJECTID
+    of the house of every row). If `objectids` is given, only the
+    houses with these OBJECTIDs are compiled. Stage metrics are
+    appended to `records` (see `GAR.metrics`).
+    """
+    records = [] if records is None else records
+    data = prepare_region(data, reg_code, config, records)
+    hs, hp = data.hs, data.hp
+    if objectids is not None:
+        hs = hs.loc[hs.OBJECTID.isin(objectids)].reset_index(drop=True)
+        hp = hp.loc[hp.OBJECTID.isin(objectids)].reset_index(drop=True)
+    return compile_houses(hs, hp, data, reg_code, config, records)
+
+
+def compile_partitions(data: namedtuple, reg_code: str, config: Config,
+                       n_parts: int, save_fn: str,
+                       records: List[Dict]) -> int:
+    """Convert prepared data of a region (see `prepare_region`) in
+    `n_parts` partitions of houses (see `GAR.partition`) that share one
+    ancestor table, and
+    merge them into the region file `save_fn` (and the state, if
+    `config.state_dir` is set). The translit memo table is loaded once
+    and saved after the last partition. The result is the same as that
+    of `compile_region`. Return the number of rows.
+    """
+    table = build_ancestor_table(data.mh, data.ao)
+    keys = top_ancestors(data.hs.OBJECTID, table.hierarchy)
+    parts, method = assign_partitions(keys, data.hs.OBJECTID, n_parts)
+    logger.info(f'Region {reg_code}: {n_parts} partitions by {method}.')
+    parts_dir = f'{save_fn}.parts'
+    os.makedirs(parts_dir, exist_ok=True)
+    memo = load_translit_memo(config.translit_memo) \
+        if config.translit_memo else None
+    n_known = len(memo) if memo is not None else 0
+    saved = []
+    for i in range(n_parts):
+        hs = data.hs.loc[parts == i].reset_index(drop=True)
+        if hs.empty:
+            continue
+        hp = data.hp.loc[data.hp.OBJECTID.isin(hs.OBJECTID)]
+        region = compile_houses(hs, hp.reset_index(drop=True), data,
+                                reg_code, config, records, table, memo)
+        saved.append(save_partition(region,
+                                    os.path.join(parts_dir, f'{i}.fea')))
+        del region
+    if not saved:
+        # no houses left after filtering: save an empty partition, so
+        # that the region file has the columns of a compiled region
+        region = compile_houses(data.hs, data.hp, data, reg_code, config,
+                                records, table, memo)
+        saved.append(save_partition(region,
+                                    os.path.join(parts_dir, '0.fea')))
+    if memo is not None and len(memo) > n_known:
+        save_translit_memo(memo, config.translit_memo)
+    state_fn = None
+    if config.state_dir:
+        os.makedirs(regions_dir(config.state_dir), exist_ok=True)
+        state_fn = os.path.join(regions_dir(config.state_dir),
+                                f'{reg_code}.fea')
+    with measure(records, 'save', reg_code, config) as m:
+        m['rows_in'] = m['rows_out'] = merge_partitions(saved, save_fn,
+                                                        state_fn)
+    shutil.rmtree(parts_dir)
+    return m['rows_out']
+
+
+def process_region(src_zip_fn: str, reg_code: str, dest_dir: str,
+                   config: Optional[Config] = None) -> None:
+    """Extract region data from source archive, convert it as required
+    by contract and save ready data to `dest_dir`. The source records
+    and the ready data are also saved to `config.state_dir` if it is
+    set (see `GAR.state`). A region whose house list would take more
+    than `config.partition_bytes` is compiled in partitions (see
+    `compile_partitions`). A partial inverted index of the ready data
+    is saved next to it if `config.inverted_dir` is set (see
+    `GAR.inverted`). Stage metrics are saved to `config.metrics_dir` if
+    it is set.
+    """
+    config = get_config() if config is None else config
+    records = []
+    with measure(records, 'region', reg_code, config) as total:
+        with measure(records, 'load', reg_code, config) as m:
+            data = load_region_data(src_zip_fn, reg_code, config)
+            m['rows_out'] = count_rows(data)
+        logger.trace('load_all_data completed')
+        total['rows_in'] = count_rows(data)
+        if config.state_dir:
+            save_state_data(config.state_dir, reg_code, data)
+        filename = os.path.join(dest_dir, f'{reg_code}.fea')
+        n_parts = count_partitions(len(data.hs) + len(data.hp),
+                                   config.partition_bytes)
+        if n_parts > 1:
+            # the loaded records are released once they are prepared
+            data = prepare_region(drop_ids(data), reg_code, config, records)
+            total['rows_out'] = compile_partitions(
+                data, reg_code, config, n_parts, filename, records)
+            region = None
+        else:
+            region = compile_region(drop_ids(data), reg_code, config,
+                                    records=records)
+            if config.state_dir:
+                save_state_region(config.state_dir, reg_code, region)
+            region = region.drop(columns='objectid')
+            with measure(records, 'save', reg_code, config) as m:
+                save_region(region, filename)
+                m['rows_in'] = m['rows_out'] = len(region)
+            total['rows_out'] = len(region)
+        logger.trace('save_region completed')
+        if config.inverted_dir:
+            with measure(records, 'inverted', reg_code, config) as m:
+                if region is None:
+                    region = read_index_columns(filename)
+                save_region_index(region, region_index_fn(filename))
+                m['rows_in'] = len(region)
+            logger.trace('save_region_index completed')
+    if config.metrics_dir:
+        save_metrics(records, config.metrics_dir, f'region_{reg_code}')
+    t = round(total['wall_sec'], 2)
     logger.success(f'Region {reg_code} done in {t} sec.')
@@ -0,0 +1,175 @@
+"""
+GAR
+===
+
+Scheduler
+---------
+
+A submodule of the GAR package that runs region processing in a pool
+of worker processes. Regions are started largest first, the number of
+simultaneously running big regions is capped and, optionally, regions
+are held back while the estimated memory of the running ones would
+exceed a set limit.
+"""
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import time
+from typing import Callable, List, Optional
+
+from loguru import logger
+import pandas as pd
+
+from GAR.config import Config
+from GAR.file_utils import get_archive_index, seed_archive_index
+from GAR.region import process_region
+
+
+Task = namedtuple('Task', 'region size')
+Result = namedtuple('Result', 'region ok seconds error')
+
+
+def make_tasks(fsdf: pd.DataFrame) -> List[Task]:
+    """Turn a file size table (see `file_utils.get_all_filesizes`) into
+    a list of region tasks ordered largest region first.
+    """
+    sizes = fsdf[['hs', 'hp', 'ao', 'mh']].sum(axis=1)
+    tasks = [Task(region=r, size=int(s)) for r, s in zip(fsdf.region, sizes)]
+    return sorted(tasks, key=lambda x: x.size, reverse=True)
+
+
+def estimate_rss(task: Task, config: Config) -> int:
+    """Estimate peak memory needed to process a region from the
+    uncompressed size of its source XML files. Every loader process
+    beyond the first (`config.load_workers`) parses a whole source file
+    or up to two chunks of `config.split_bytes` at a time, which counts
+    as much as that part of the region.
+    """
+    part = task.size
+    if config.split_bytes:
+        part = min(part, 2 * config.split_bytes)
+    size = task.size + (config.load_workers - 1) * part
+    return int(size * config.rss_factor)
+
+
+def pick_next(pending: List[Task], running: List[Task], config: Config,
+              admit: Optional[Callable[[Task], bool]] = None
+              ) -> Optional[Task]:
+    """Select the first pending task that can be started right now or
+    return None if every pending task has to wait.
+    """
+    n_big = len([x for x in running if x.region in config.big_regions])
+    rss = sum(estimate_rss(x, config) for x in running)
+    for task in pending:
+        if admit is not None and not admit(task):
+            continue
+        if task.region in config.big_regions and n_big >= config.max_big:
+            continue
+        over_limit = rss + estimate_rss(task, config) > config.max_rss
+        if running and config.max_rss and over_limit:
+            continue
+        return task
+    return None
+
+
+def run_region(src_zip_fn: str, region: str, dest_dir: str,
+               config: Config) -> Result:
+    """Process a single region and report the outcome instead of
+    raising, so that one failed region does not stop the others.
+    """
+    t1 = time.perf_counter()
+    try:
+        process_region(src_zip_fn, region, dest_dir, config)
+    except Exception as e:
+        logger.exception(f'Region {region} failed.')
+        t = round(time.perf_counter() - t1, 2)
+        return Result(region=region, ok=False, seconds=t, error=repr(e))
+    t = round(time.perf_counter() - t1, 2)
+    return Result(region=region, ok=True, seconds=t, error='')
+
+
+def run_serial(tasks: List[Task], src_zip_fn: str, dest_dir: str,
+               config: Config,
+               on_result: Optional[Callable[[Result], None]] = None,
+               stop: Optional[Callable[[], bool]] = None
+               ) -> List[Result]:
+    """Process tasks one by one in the current process. No more tasks
+    are started once `stop` returns True.
+    """
+    results = []
+    for task in tasks:
+        if stop is not None and stop():
+            break
+        result = run_region(src_zip_fn, task.region, dest_dir, config)
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+    return results
+
+
+def run_pool(tasks: List[Task], src_zip_fn: str, dest_dir: str,
+             config: Config,
+             on_result: Optional[Callable[[Result], None]] = None,
+             admit: Optional[Callable[[Task], bool]] = None
+             ) -> List[Result]:
+    """Process tasks in a pool of `config.workers` processes. Tasks are
+    submitted in list order as soon as a worker is free and `pick_next`
+    lets them in. `on_result` is called in the parent process for every
+    finished region. Workers get the archive index of the parent, so
+    that they never re-read the zip central directory.
+    """
+    pending = list(tasks)
+    results = []
+    running = {}
+    index = get_archive_index(src_zip_fn)
+    with ProcessPoolExecutor(max_workers=config.workers,
+                             initializer=seed_archive_index,
+                             initargs=(src_zip_fn, index)) as pool:
+        while pending or running:
+            while len(running) < config.workers:
+                task = pick_next(pending, list(running.values()), config,
+                                 admit)
+                if task is None:
+                    break
+                pending.remove(task)
+                try:
+                    future = pool.submit(run_region, src_zip_fn, task.region,
+                                         dest_dir, config)
+                except BrokenProcessPool as e:
+                    pending.insert(0, task)
+                    failed = [Result(x.region, False, 0.0, repr(e))
+                              for x in pending]
+                    results.extend(failed)
+                    pending = []
+                    break
+                running[future] = task
+                logger.info(f'Region {task.region} started.')
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f'Region {task.region} worker died: {e!r}')
+                    result = Result(task.region, False, 0.0, repr(e))
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+    return results
+
+
+def report_results(results: List[Result]) -> None:
+    """Log per-region timings and failures."""
+    for result in sorted(results, key=lambda x: x.region):
+        if result.ok:
+            logger.info(f'Region {result.region}: {result.seconds} sec.')
+        else:
+            logger.error(f'Region {result.region}: FAILED after '
+                         f'{result.seconds} sec. ({result.error})')
+    failed = [x.region for x in results if not x.ok]
+    total = round(sum(x.seconds for x in results), 2)
+    logger.info(f'{len(results) - len(failed)} regions done, '
+                f'{len(failed)} failed, {total} sec. of region time.')
@@ -0,0 +1,114 @@
+"""
+GAR
+===
+
+State
+-----
+
+A submodule of the GAR package that keeps the per-region state of a
+full run on disk, so that delta archives can be applied to it later
+(see `GAR.delta`). The state of a region consists of its loaded source
+records (with their record `ID`s) and its ready region data together
+with the OBJECTID of the house of every row.
+"""
+
+from collections import namedtuple
+import os
+import shutil
+from typing import Optional
+import uuid
+
+import pandas as pd
+
+from GAR.file_utils import ATTRS
+
+
+FRAMES = ['hs', 'hp', 'mh', 'ao']
+# source attributes kept in the state: record ID first
+STATE_ATTRS = {key: ['ID'] + value for key, value in ATTRS.items()}
+
+
+def source_dir(state_dir: str, region: str) -> str:
+    """Compute the directory of the source records of a region."""
+    return os.path.join(state_dir, 'source', region)
+
+
+def regions_dir(state_dir: str) -> str:
+    """Compute the directory of the ready region files."""
+    return os.path.join(state_dir, 'regions')
+
+
+def has_state(state_dir: str, region: str) -> bool:
+    """Check if the state has both source records and ready data of a
+    region.
+    """
+    region_fn = os.path.join(regions_dir(state_dir), f'{region}.fea')
+    return (os.path.isdir(source_dir(state_dir, region))
+            and os.path.isfile(region_fn))
+
+
+def save_state_data(state_dir: str, region: str, data: namedtuple) -> None:
+    """Save the source records of a region, replacing the previous
+    ones. The records are written to a temporary directory first and
+    then moved into place.
+    """
+    entry = source_dir(state_dir, region)
+    tmp = f'{entry}_{uuid.uuid4().hex}.tmp'
+    os.makedirs(tmp)
+    for x in FRAMES:
+        getattr(data, x).reset_index(drop=True).to_feather(
+            os.path.join(tmp, f'{x}.fea'))
+    old = f'{tmp}.old'
+    if os.path.isdir(entry):
+        os.rename(entry, old)
+    os.rename(tmp, entry)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def load_state_data(state_dir: str, region: str) -> Optional[namedtuple]:
+    """Read the source records of a region or return None if the state
+    has none.
+    """
+    Data = namedtuple('Data', 'hs hp mh ao')
+    entry = source_dir(state_dir, region)
+    if not os.path.isdir(entry):
+        return None
+    frames = {x: pd.read_feather(os.path.join(entry, f'{x}.fea'))
+              for x in FRAMES}
+    return Data(**frames)
+
+
+def empty_state_data() -> namedtuple:
+    """Create source records of a region that has no state yet."""
+    Data = namedtuple('Data', 'hs hp mh ao')
+    frames = {x: pd.DataFrame({y: pd.Series([], dtype=object)
+                               for y in STATE_ATTRS[x]})
+              for x in FRAMES}
+    return Data(**frames)
+
+
+def drop_ids(data: namedtuple) -> namedtuple:
+    """Remove the record `ID` columns from source records."""
+    Data = namedtuple('Data', 'hs hp mh ao')
+    frames = {x: getattr(data, x).drop(columns='ID', errors='ignore')
+              for x in FRAMES}
+    return Data(**frames)
+
+
+def save_state_region(state_dir: str, region: str, df: pd.DataFrame) -> None:
+    """Save the ready data of a region (with an `objectid` column)."""
+    os.makedirs(regions_dir(state_dir), exist_ok=True)
+    fn = os.path.join(regions_dir(state_dir), f'{region}.fea')
+    tmp = f'{fn}.{uuid.uuid4().hex}.tmp'
+    df.reset_index(drop=True).to_feather(tmp)
+    os.replace(tmp, fn)
+
+
+def load_state_region(state_dir: str, region: str) -> Optional[pd.DataFrame]:
+    """Read the ready data of a region or return None if the state has
+    none.
+    """
+    fn = os.path.join(regions_dir(state_dir), f'{region}.fea')
+    if not os.path.isfile(fn):
+        return None
+    return pd.read_feather(fn)
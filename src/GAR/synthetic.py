@@ -0,0 +1,343 @@
+"""
+GAR
+===
+
+Synthetic
+---------
+
+A module that writes synthetic GAR archives for tests and benchmarks.
+The archive has the member layout of a real GAR distribution
+(`NN/AS_HOUSES_*.XML`, `NN/AS_HOUSES_PARAMS_*.XML`, `NN/AS_ADDR_OBJ_*.XML`,
+`NN/AS_MUN_HIERARCHY_*.XML` and the files the processing skips) and
+roughly realistic data: a municipal hierarchy up to 6 levels deep under
+the region, many duplicate object names, renamed and liquidated
+objects, inactive houses and hierarchy records, and postcode history
+chains with missing or doubled current postcodes.
+
+The same size, seed and update number always give the same archive.
+An update (1, 2, ...) is the next version of the base archive: a few
+objects are renamed, some houses are deactivated or get new postcodes
+and a few new houses are added.
+
+Usage: python -m GAR.synthetic [dest_gar_xml.zip] [size] [seed] [update]
+"""
+
+from collections import namedtuple
+import datetime
+import itertools
+import random
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+import zipfile
+
+from loguru import logger
+
+
+# houses in the largest region (77), the others are scaled by weight
+SIZES = {'tiny': 10**3, 'small': 10**4, 'medium': 10**5, 'large': 5 * 10**5,
+         'moscow': 2 * 10**6}
+REGION_WEIGHTS = {'01': 0.05, '23': 0.3, '50': 0.4, '77': 1.0, '99': 0.0}
+BASE_DATE = datetime.date(2023, 1, 5)
+END_DATE = '2079-06-06'
+CHUNK_HOUSES = 10**4
+# record IDs and OBJECTIDs of a region start at its code times this
+ID_RANGE = 2 * 10**7
+
+STREET_NAMES = ['Ленина', 'Советская', 'Мира', 'Садовая', 'Школьная',
+                'Молодежная', 'Центральная', 'Лесная', 'Новая', 'Набережная',
+                'Заречная', 'Полевая', 'Луговая', 'Садовая 1-я', 'Октябрьская',
+                'Комсомольская', 'Гагарина', 'Пушкина', 'Щорса', 'Ёлочная',
+                'Елецкая', 'Эльбрус', 'Подъездная', 'Объездная', 'Южная',
+                'Коммунистическая', 'Энтузиастов', 'ЖК "Солнечный"',
+                'Соловьёва', 'Аэропорт']
+PLACE_NAMES = ['Ивановка', 'Петровское', 'Александровка', 'Никольское',
+               'Михайловка', 'Березовка', 'Покровское', 'Знаменка',
+               'Краснополье', 'Сосновка', 'Новоселки', 'Еловое']
+TYPENAMES = {3: ['м.р-н', 'г.о.', 'м.о.'], 4: ['г.п.', 'с.п.'],
+             5: ['г', 'г.'], 6: ['д', 'с', 'п', 'рп'],
+             7: ['тер. СНТ', 'мкр', 'тер.'], 8: ['ул', 'пер', 'пр-кт', 'б-р']}
+HOUSENUMS = ['1', '2', '3', '5', '10', '12', '2а', '15к', '7/1', '18Б',
+             'Е1', 'ЭЯ', '101', None]
+# HOUSETYPE and ADDTYPE weights; 4 (garage) and 6 (boiler room) are
+# filtered out by the processing
+HOUSETYPES = [2] * 12 + [5, 5, 7, 10, 4, 6, None]
+ADDTYPES = [None] * 16 + [1, 1, 2, 3, 6]
+# number of postcode records of a house
+POSTCODE_CHAIN = [0] + [1] * 6 + [2, 2, 3, 4]
+
+Hierarchy = namedtuple('Hierarchy', 'ao mh streets places')
+
+
+def region_houses(size: int, region: str) -> int:
+    """Compute the number of houses of a region for an archive size
+    (the number of houses of the largest region).
+    """
+    weight = REGION_WEIGHTS[region]
+    return max(1, int(size * weight)) if weight else 0
+
+
+def version_date(update: int) -> str:
+    """Compute the version date of an archive (a week per update)."""
+    date = BASE_DATE + datetime.timedelta(days=7 * update)
+    return date.strftime('%Y%m%d')
+
+
+def make_guid(rng: random.Random) -> str:
+    """Generate a random GUID string."""
+    x = '%032x' % rng.getrandbits(128)
+    return f'{x[:8]}-{x[8:12]}-{x[12:16]}-{x[16:20]}-{x[20:]}'
+
+
+def element(tag: str, attrs: List[Tuple[str, object]]) -> str:
+    """Format an empty XML element. None attributes are left out."""
+    text = ' '.join(f'{x}="{escape(str(y), {chr(34): "&quot;"})}"'
+                    for x, y in attrs if y is not None)
+    return f'<{tag} {text} />'
+
+
+def make_hierarchy(rng: random.Random, mr: random.Random, region: str,
+                   houses: int, update: int, ids: Dict[str, int]
+                   ) -> Hierarchy:
+    """Generate the address objects and their municipal hierarchy items
+    of a region. `rng` drives the base data and `mr` the changes of an
+    update. `ids` holds the next record ID and OBJECTID of the region.
+    Return the formatted records together with the OBJECTIDs of the
+    streets and of the places that houses can be attached to.
+    """
+    ao, mh = [], []
+    oktmo = f'{int(region) * 10**6:08d}'
+
+    def new(key: str) -> int:
+        ids[key] += 1
+        return ids[key]
+
+    def add_object(level: int, name: str, parent: Optional[int]) -> int:
+        oid = new('object')
+        typename = rng.choice(TYPENAMES.get(level, ['обл']))
+        renamed = rng.random() < 0.03
+        liquidated = rng.random() < 0.01
+        if update and mr.random() < 0.005:
+            name = f'{name} {update}-я'
+        rec_id = new('record')
+        if renamed:
+            # the record of the former name
+            old_id = new('record')
+            ao.append(element('OBJECT', [
+                ('ID', old_id), ('OBJECTID', oid), ('OBJECTGUID', None),
+                ('NAME', rng.choice(STREET_NAMES)), ('TYPENAME', typename),
+                ('LEVEL', level), ('OPERTYPEID', 1), ('NEXTID', rec_id),
+                ('STARTDATE', '1990-01-01'), ('ENDDATE', '2015-03-01'),
+                ('ISACTUAL', 0), ('ISACTIVE', 0)]))
+        guid = make_guid(rng)
+        active = 0 if liquidated else 1
+        ao.append(element('OBJECT', [
+            ('ID', rec_id), ('OBJECTID', oid), ('OBJECTGUID', guid),
+            ('NAME', name), ('TYPENAME', typename), ('LEVEL', level),
+            ('OPERTYPEID', 20 if renamed else 10), ('NEXTID', 0),
+            ('STARTDATE', '2015-03-01'), ('ENDDATE', END_DATE),
+            ('ISACTUAL', active), ('ISACTIVE', active)]))
+        if parent is not None:
+            mh.append(element('ITEM', [
+                ('ID', new('record')), ('OBJECTID', oid),
+                ('PARENTOBJID', parent), ('OKTMO', oktmo), ('NEXTID', 0),
+                ('STARTDATE', '2015-03-01'), ('ENDDATE', END_DATE),
+                ('ISACTIVE', 1)]))
+        return oid
+
+    reg = add_object(1, f'Регион {region}', None)
+    n_streets = max(1, houses // 30)
+    n_places = max(1, n_streets // 8)
+    n_muni = max(1, n_places // 3)
+    n_munr = max(1, n_muni // 5)
+    munrs = [add_object(3, rng.choice(PLACE_NAMES), reg)
+             for _ in range(n_munr)]
+    munis = [add_object(4, rng.choice(PLACE_NAMES), rng.choice(munrs))
+             for _ in range(n_muni)]
+    places = []
+    for _ in range(n_places):
+        # urban okrugs have no settlement level
+        parent = rng.choice(munrs if rng.random() < 0.3 else munis)
+        places.append(add_object(rng.choice([5, 6, 6]),
+                                 rng.choice(PLACE_NAMES), parent))
+    terrs = [add_object(7, rng.choice(STREET_NAMES), rng.choice(places))
+             for _ in range(max(1, n_places // 4))]
+    streets = [add_object(8, rng.choice(STREET_NAMES),
+                          rng.choice(terrs if rng.random() < 0.1 else places))
+               for _ in range(n_streets)]
+    return Hierarchy(ao=ao, mh=mh, streets=streets, places=places + terrs)
+
+
+def house_records(rng: random.Random, mr: random.Random, region: str,
+                  houses: int, update: int, hierarchy: Hierarchy,
+                  ids: Dict[str, int]) -> Iterator[Tuple[str, str, str]]:
+    """Generate the houses of a region in chunks of `CHUNK_HOUSES`. Yield
+    the formatted AS_HOUSES, AS_HOUSES_PARAMS and AS_MUN_HIERARCHY
+    records of every chunk. The output depends only on the arguments,
+    so the houses can be generated again for every archive member.
+    """
+    oktmo = f'{int(region) * 10**6:08d}'
+    streets, places = hierarchy.streets, hierarchy.places
+    street_postcodes = {}
+
+    def new(key: str) -> int:
+        ids[key] += 1
+        return ids[key]
+
+    def house(hs: List[str], hp: List[str], mh: List[str]) -> None:
+        oid = new('object')
+        parent = (rng.choice(streets) if rng.random() < 0.9
+                  else rng.choice(places))
+        if parent not in street_postcodes:
+            street_postcodes[parent] = rng.randint(100000, 699999)
+        active = 1 if rng.random() < 0.93 else 0
+        if update and mr.random() < 0.02:
+            active = 0
+        hs.append(element('HOUSE', [
+            ('ID', new('record')), ('OBJECTID', oid),
+            ('OBJECTGUID', make_guid(rng)),
+            ('CHANGEID', new('record')), ('HOUSENUM', rng.choice(HOUSENUMS)),
+            ('ADDNUM1', rng.choice([None, None, None, '1', '2', 'Б'])),
+            ('ADDNUM2', rng.choice([None] * 5 + ['3'])),
+            ('HOUSETYPE', rng.choice(HOUSETYPES)),
+            ('ADDTYPE1', rng.choice(ADDTYPES)),
+            ('ADDTYPE2', rng.choice(ADDTYPES)), ('OPERTYPEID', 10),
+            ('STARTDATE', '2015-03-01'), ('ENDDATE', END_DATE),
+            ('ISACTUAL', active), ('ISACTIVE', active)]))
+        mh.append(element('ITEM', [
+            ('ID', new('record')), ('OBJECTID', oid), ('PARENTOBJID', parent),
+            ('OKTMO', oktmo), ('NEXTID', 0), ('STARTDATE', '2015-03-01'),
+            ('ENDDATE', END_DATE), ('ISACTIVE', 1)]))
+        if rng.random() < 0.08:
+            # the former parent of a house
+            mh.append(element('ITEM', [
+                ('ID', new('record')), ('OBJECTID', oid),
+                ('PARENTOBJID', rng.choice(places)), ('OKTMO', oktmo),
+                ('NEXTID', ids['record'] - 1), ('STARTDATE', '2000-01-01'),
+                ('ENDDATE', '2015-03-01'), ('ISACTIVE', 0)]))
+        postcode = street_postcodes[parent]
+        n_codes = rng.choice(POSTCODE_CHAIN)
+        current = rng.random() < 0.95
+        doubled = rng.random() < 0.01
+        for i in range(n_codes):
+            last = i == n_codes - 1
+            value = postcode + (n_codes - 1 - i) * rng.randint(0, 3)
+            if last and update and mr.random() < 0.03:
+                value = mr.randint(100000, 699999)
+            change_id = new('record')
+            end = 0 if (last and current) or (doubled and i == 0) else \
+                change_id + 1
+            hp.append(element('PARAM', [
+                ('ID', new('record')), ('OBJECTID', oid),
+                ('CHANGEID', change_id), ('CHANGEIDEND', end), ('TYPEID', 5),
+                ('VALUE', value), ('STARTDATE', '2015-03-01'),
+                ('ENDDATE', END_DATE if end == 0 else '2019-01-01')]))
+        for typeid in (6, 7, 8):
+            if rng.random() < 0.7:
+                hp.append(element('PARAM', [
+                    ('ID', new('record')), ('OBJECTID', oid),
+                    ('CHANGEID', new('record')), ('CHANGEIDEND', 0),
+                    ('TYPEID', typeid), ('VALUE', rng.randint(1, 10**10)),
+                    ('STARTDATE', '2015-03-01'), ('ENDDATE', END_DATE)]))
+
+    n_new = houses // 100 * update
+    for start in range(0, houses + n_new, CHUNK_HOUSES):
+        hs, hp, mh = [], [], []
+        for _ in range(start, min(start + CHUNK_HOUSES, houses + n_new)):
+            house(hs, hp, mh)
+        yield ''.join(hs), ''.join(hp), ''.join(mh)
+
+
+def write_member(z: zipfile.ZipFile, name: str, root: str,
+                 chunks: Iterator[str]) -> None:
+    """Write an XML archive member from chunks of formatted records."""
+    with z.open(name, 'w', force_zip64=True) as fh:
+        fh.write(f'<?xml version="1.0" encoding="utf-8"?><{root}>'.encode())
+        for chunk in chunks:
+            fh.write(chunk.encode('utf-8'))
+        fh.write(f'</{root}>'.encode())
+
+
+def write_region(z: zipfile.ZipFile, region: str, houses: int, seed: int,
+                 update: int) -> None:
+    """Write all members of a region to an open archive."""
+    date = version_date(update)
+    region_seed = seed * 1000 + int(region)
+
+    def member(prefix: str) -> str:
+        guid = make_guid(random.Random(f'{region}{prefix}{seed}{update}'))
+        return f'{region}/{prefix}_{date}_{guid}.XML'
+
+    def generate() -> Tuple[Hierarchy, Iterator[Tuple[str, str, str]]]:
+        rng = random.Random(region_seed)
+        mr = random.Random(region_seed * 1000 + update)
+        # real IDs fit into 32 bits as well
+        base = int(region) * ID_RANGE
+        ids = {'record': base, 'object': base}
+        hierarchy = make_hierarchy(rng, mr, region, houses, update, ids)
+        return hierarchy, house_records(rng, mr, region, houses, update,
+                                        hierarchy, ids)
+
+    hierarchy, _ = generate()
+    write_member(z, member('AS_ADDR_OBJ'), 'ADDRESSOBJECTS', hierarchy.ao)
+    write_member(z, member('AS_ADDR_OBJ_DIVISION'), 'ITEMS', [])
+    write_member(z, member('AS_ADDR_OBJ_PARAMS'), 'PARAMS', [])
+    # the houses are generated again for each of their three members
+    for i, (prefix, root) in enumerate([('AS_HOUSES', 'HOUSES'),
+                                        ('AS_HOUSES_PARAMS', 'PARAMS'),
+                                        ('AS_MUN_HIERARCHY', 'ITEMS')]):
+        hierarchy, records = generate()
+        chunks = (x[i] for x in records)
+        if prefix == 'AS_MUN_HIERARCHY':
+            chunks = itertools.chain(hierarchy.mh, chunks)
+        write_member(z, member(prefix), root, chunks)
+
+
+def make_archive(zfn: str, size: int, seed: int = 0, update: int = 0,
+                 regions: Optional[List[str]] = None) -> None:
+    """Write a synthetic GAR archive. `size` is the number of houses of
+    the largest region (see `SIZES` and `REGION_WEIGHTS`), `update` the
+    version of the archive (0 is the base one).
+    """
+    regions = sorted(REGION_WEIGHTS) if regions is None else regions
+    t1 = time.perf_counter()
+    date = version_date(update)
+    with zipfile.ZipFile(zfn, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as z:
+        types = ''.join(element('HOUSETYPE', [('ID', x), ('NAME', y)])
+                        for x, y in [(2, 'Дом'), (4, 'Гараж'), (5, 'Корпус'),
+                                     (6, 'Котельная'), (7, 'Строение'),
+                                     (10, 'Здание')])
+        write_member(z, f'AS_HOUSE_TYPES_{date}_0.XML', 'HOUSETYPES', [types])
+        write_member(z, f'AS_ADDHOUSE_TYPES_{date}_0.XML', 'HOUSETYPES',
+                     [types])
+        for region in regions:
+            write_region(z, region, region_houses(size, region), seed,
+                         update)
+            logger.info(f'Region {region} written.')
+    t = round(time.perf_counter() - t1, 2)
+    logger.success(f'Synthetic archive {zfn} written in {t} sec.')
+
+
+def parse_size(value: str) -> int:
+    """Read an archive size: a name from `SIZES` or a number of
+    houses.
+    """
+    return SIZES[value] if value in SIZES else int(value)
+
+
+def main() -> int:
+    """Script running function."""
+    if not 2 <= len(sys.argv) <= 5:
+        print('Syntax Error.')
+        print(f'Usage: {__file__} [dest_gar_xml.zip] [size] [seed] [update]')
+        print(f'Sizes: {", ".join(SIZES)} or a number of houses.')
+        return 1
+    args = sys.argv[1:] + ['tiny', '0', '0'][len(sys.argv) - 2:]
+    make_archive(args[0], parse_size(args[1]), int(args[2]), int(args[3]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,34 +6,67 @@ Translit
 --------
 
 A submodule of the GAR package that contains functions necessary to
-transliterate data.
+transliterate data. Only distinct values of a column are transliterated;
+an optional memo table keeps the results across regions and runs.
+Strings are transliterated in batches by a vectorized NumPy engine that
+reproduces the original regex based rules (`translit_series_regex`).
 """
 
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
 import pandas as pd
 
 
-def translit_series(cyr: pd.Series) -> pd.Series:
+LOWER = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e',
+         'ё': 'yo', 'ж': 'zh', 'з': 'z', 'и': 'i', 'й':'y', 'к': 'k',
+         'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+         'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts',
+         'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ь': 'ь', 'ы': 'y', 'ъ': 'ъ',
+         'э': 'e', 'ю': 'yu', 'я': 'ya'}
+UPPER = {'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'Ye',
+         'Ё': 'Yo', 'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й':'Y', 'К': 'K',
+         'Л': 'L', 'М': 'M', 'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R',
+         'С': 'S', 'Т': 'T', 'У': 'U', 'Ф': 'F', 'Х': 'Kh', 'Ц': 'Ts',
+         'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch', 'Ы': 'Y', 'Э': 'E', 'Ю': 'Yu',
+         'Я': 'Ya'}
+# characters after which `e` is written as `ye`
+VOWELS = ' AaEeOoIiUuYyьъ'
+SEPARATOR = '\x00'
+BATCH_SIZE = 2**20
+
+
+def make_tables() -> tuple:
+    """Compile the character tables into code point lookup arrays for
+    the cyrillic block (U+0400 - U+04FF): output length, output code
+    points and a vowel flag per input code point. Lower and upper case
+    keys do not overlap, so one table does both.
+    """
+    mapping = {**LOWER, **UPPER}
+    width = max(len(x) for x in mapping.values())
+    lengths = np.ones(0x500, dtype=np.int64)
+    chars = np.zeros((0x500, width), dtype=np.uint32)
+    chars[:, 0] = np.arange(0x500)
+    for key, value in mapping.items():
+        lengths[ord(key)] = len(value)
+        chars[ord(key), :len(value)] = [ord(x) for x in value]
+    vowels = np.zeros(0x500, dtype=bool)
+    vowels[[ord(x) for x in VOWELS]] = True
+    return lengths, chars, vowels
+
+
+TABLE_LENGTHS, TABLE_CHARS, TABLE_VOWELS = make_tables()
+
+
+def translit_series_regex(cyr: pd.Series) -> pd.Series:
     """Take a string in cyrillic script and return its equivalent in
-    Latin.
+    Latin. This is the reference implementation (character tables and
+    regular expressions) that `translit_series` reproduces.
     """
-    lower = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e',
-             'ё': 'yo', 'ж': 'zh', 'з': 'z', 'и': 'i', 'й':'y', 'к': 'k',
-             'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
-             'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts',
-             'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ь': 'ь', 'ы': 'y', 'ъ': 'ъ',
-             'э': 'e', 'ю': 'yu', 'я': 'ya'}
-    lowertr = str.maketrans(lower)
-    lat = cyr.str.translate(lowertr)
-    upper = {'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'Ye',
-             'Ё': 'Yo', 'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й':'Y', 'К': 'K',
-             'Л': 'L', 'М': 'M', 'Н': 'N', 'О': 'O', 'П': 'P', 'Р': 'R',
-             'С': 'S', 'Т': 'T', 'У': 'U', 'Ф': 'F', 'Х': 'Kh', 'Ц': 'Ts',
-             'Ч': 'Ch', 'Ш': 'Sh', 'Щ': 'Sch', 'Ы': 'Y', 'Э': 'E', 'Ю': 'Yu',
-             'Я': 'Ya'}
-    uppertr = str.maketrans(upper)
-    lat = lat.str.translate(uppertr)
-    vowelsr = ' AaEeOoIiUuYyьъ'
-    lat = lat.str.replace(fr'([{vowelsr}])e', r'\g<1>ye', regex=True)
+    lat = cyr.str.translate(str.maketrans(LOWER))
+    lat = lat.str.translate(str.maketrans(UPPER))
+    lat = lat.str.replace(fr'([{VOWELS}])e', r'\g<1>ye', regex=True)
     lat = lat.str.replace(r'[A-Z][a-z][A-Z]', lambda x: x.group(0).upper(),
                           regex=True)
     lat = lat.str.replace('ь', '')
@@ -41,25 +74,180 @@ def translit_series(cyr: pd.Series) -> pd.Series:
     return lat
 
 
-def translit_df(src: pd.DataFrame) -> pd.DataFrame:
+def chain_starts(mask: np.ndarray) -> np.ndarray:
+    """For every element of a boolean array return its offset from the
+    start of the run of True values it belongs to.
+    """
+    idx = np.arange(len(mask))
+    start = mask.copy()
+    start[1:] &= ~mask[:-1]
+    run_start = np.maximum.accumulate(np.where(start, idx, 0))
+    return idx - run_start
+
+
+def translate_codepoints(cp: np.ndarray) -> np.ndarray:
+    """Replace every code point found in the character tables with its
+    (one to three letter) latin equivalent.
+    """
+    in_block = cp < 0x500
+    key = np.where(in_block, cp, 0)
+    lengths = np.where(in_block, TABLE_LENGTHS[key], 1)
+    src = np.repeat(np.arange(len(cp)), lengths)
+    offset = np.arange(len(src)) - np.repeat(np.cumsum(lengths) - lengths,
+                                             lengths)
+    out = TABLE_CHARS[key[src], offset]
+    return np.where(in_block[src], out, cp[src])
+
+
+def translit_codepoints(cp: np.ndarray) -> np.ndarray:
+    """Apply the context rules of the transliteration to an array of
+    code points of table-translated text:
+    1.  `e` after a character of `VOWELS` becomes `ye` (matches do not
+        overlap, so in a run of `e` every second one is affected),
+    2.  a lower case letter between two upper case ones is upper cased
+        (non-overlapping left to right, as a regex substitution would),
+    3.  soft signs are dropped, hard signs become apostrophes.
+    """
+    n = len(cp)
+    is_e = cp == ord('e')
+    prev_vowel = np.zeros(n, dtype=bool)
+    prev_vowel[1:] = (cp[:-1] < 0x500) & TABLE_VOWELS[cp[:-1] % 0x500]
+    k = chain_starts(is_e)
+    first_ye = prev_vowel[np.arange(n) - k]
+    ye = is_e & ((k % 2 == 0) == first_ye)
+    cp = np.insert(cp, np.flatnonzero(ye), ord('y'))
+    n = len(cp)
+    upper = (cp >= ord('A')) & (cp <= ord('Z'))
+    lower = (cp >= ord('a')) & (cp <= ord('z'))
+    match = np.zeros(n, dtype=bool)
+    if n > 2:
+        match[:-2] = upper[:-2] & lower[1:-1] & upper[2:]
+    for parity in (0, 1):
+        chain = match[parity::2]
+        match[parity::2] = chain & (chain_starts(chain) % 2 == 0)
+    cp[1:][match[:-1]] -= ord('a') - ord('A')
+    cp = cp[cp != ord('ь')]
+    cp[cp == ord('ъ')] = ord("'")
+    return cp
+
+
+def translit_strings(values: List[str]) -> List[str]:
+    """Transliterate a list of strings in a single vectorized pass: the
+    strings are joined and the code point array of the whole batch goes
+    through the character tables and the context rules (see
+    `translate_codepoints` and `translit_codepoints`).
+    """
+    text = SEPARATOR.join(values)
+    if text.count(SEPARATOR) != len(values) - 1:
+        raise ValueError('Separator character found in the values.')
+    cp = np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+    cp = translit_codepoints(translate_codepoints(cp))
+    lat = cp.astype('<u4').tobytes().decode('utf-32-le')
+    return lat.split(SEPARATOR)
+
+
+def translit_series(cyr: pd.Series) -> pd.Series:
+    """Take a string in cyrillic script and return its equivalent in
+    Latin. As in `translit_series_regex`, missing values (None, NaN,
+    pd.NA) are kept as they are and other non-string values become NaN.
+    """
+    values = cyr.to_numpy(dtype=object)
+    is_str = np.array([isinstance(x, str) for x in values], dtype=bool)
+    strings = values[is_str].tolist()
+    try:
+        lat = []
+        for i in range(0, len(strings), BATCH_SIZE):
+            lat += translit_strings(strings[i:i + BATCH_SIZE])
+    except (ValueError, UnicodeError):
+        return translit_series_regex(cyr)
+    res = np.where(pd.isna(values), values, np.nan).astype(object)
+    res[is_str] = lat
+    return pd.Series(res, index=cyr.index, dtype=object)
+
+
+def translit_values(values: pd.Series,
+                    memo: Optional[Dict[str, str]] = None) -> np.ndarray:
+    """Transliterate a Series of distinct strings. Values found in the
+    `memo` (cyrillic -> latin) are not transliterated again, new ones
+    are added to it.
+    """
+    values = values.astype(object)
+    if memo is None:
+        return translit_series(values).to_numpy(dtype=object)
+    lat = values.map(memo).astype(object)
+    new = lat.isna() & values.notna()
+    if new.any():
+        fresh = translit_series(values.loc[new])
+        lat.loc[new] = fresh
+        memo.update(zip(values.loc[new], fresh))
+    return lat.to_numpy(dtype=object)
+
+
+def translit_unique(cyr: pd.Series,
+                    memo: Optional[Dict[str, str]] = None) -> pd.Series:
+    """Transliterate a column by transliterating its unique values only
+    and mapping the results back by code.
+    """
+    codes, uniques = pd.factorize(cyr)
+    lat = translit_values(pd.Series(uniques, dtype=object), memo)
+    lat = np.append(lat, np.nan)
+    return pd.Series(lat[codes], index=cyr.index, dtype=object)
+
+
+def translit_categorical(cyr: pd.Series,
+                         memo: Optional[Dict[str, str]] = None) -> pd.Series:
+    """Transliterate a categorical column by transliterating its
+    categories only. Categories that become equal in Latin are merged.
+    """
+    lat = translit_values(pd.Series(cyr.cat.categories, dtype=object), memo)
+    new_codes, new_categories = pd.factorize(lat)
+    codes = cyr.cat.codes.to_numpy()
+    lat_codes = np.where(codes >= 0, new_codes[codes], -1)
+    cat = pd.Categorical.from_codes(lat_codes, categories=new_categories)
+    return pd.Series(cat, index=cyr.index)
+
+
+def translit_column(cyr: pd.Series,
+                    memo: Optional[Dict[str, str]] = None) -> pd.Series:
+    """Transliterate a column, keeping categorical columns
+    categorical.
+    """
+    if isinstance(cyr.dtype, pd.CategoricalDtype):
+        return translit_categorical(cyr, memo)
+    return translit_unique(cyr, memo)
+
+
+def translit_df(src: pd.DataFrame,
+                memo: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     """Create latin equivalent copies of all cyrillic-containing
-    columns in the dataframe."""
+    columns in the dataframe. A `memo` dictionary (see
+    `load_translit_memo`) is shared by all columns."""
     df = src.copy()
-    df['HOUSENUM_EN'] = translit_series(df['HOUSENUM'])
-    df['BUILDNUM_EN'] = translit_series(df['BUILDNUM'])
-    df['STRUCNUM_EN'] = translit_series(df['STRUCNUM'])
-    df['STREET_S_EN'] = translit_series(df['STREET_S'])
-    df['STREET_F_EN'] = translit_series(df['STREET_F'])
-    df['TERR_S_EN'] = translit_series(df['TERR_S'])
-    df['TERR_F_EN'] = translit_series(df['TERR_F'])
-    df['PLACE_S_EN'] = translit_series(df['PLACE_S'])
-    df['PLACE_F_EN'] = translit_series(df['PLACE_F'])
-    df['CITY_S_EN'] = translit_series(df['CITY_S'])
-    df['CITY_F_EN'] = translit_series(df['CITY_F'])
-    df['MUNI_S_EN'] = translit_series(df['MUNI_S'])
-    df['MUNI_F_EN'] = translit_series(df['MUNI_F'])
-    df['MUNR_S_EN'] = translit_series(df['MUNR_S'])
-    df['MUNR_F_EN'] = translit_series(df['MUNR_F'])
-    df['REGION_S_EN'] = translit_series(df['REGION_S'])
-    df['REGION_F_EN'] = translit_series(df['REGION_F'])
+    cols = ['HOUSENUM', 'BUILDNUM', 'STRUCNUM', 'STREET_S', 'STREET_F',
+            'TERR_S', 'TERR_F', 'PLACE_S', 'PLACE_F', 'CITY_S', 'CITY_F',
+            'MUNI_S', 'MUNI_F', 'MUNR_S', 'MUNR_F', 'REGION_S', 'REGION_F']
+    for col in cols:
+        df[f'{col}_EN'] = translit_column(df[col], memo)
     return df
+
+
+def load_translit_memo(memo_fn: str) -> Dict[str, str]:
+    """Read a persistent cyrillic -> latin memo table (Feather file with
+    `cyr` and `lat` columns). A missing file gives an empty memo.
+    """
+    if not os.path.isfile(memo_fn):
+        return {}
+    df = pd.read_feather(memo_fn)
+    return dict(zip(df.cyr, df.lat))
+
+
+def save_translit_memo(memo: Dict[str, str], memo_fn: str) -> None:
+    """Write a memo table to disk. Entries stored by other processes in
+    the meantime are kept, the file is replaced atomically.
+    """
+    merged = load_translit_memo(memo_fn)
+    merged.update(memo)
+    df = pd.DataFrame({'cyr': list(merged), 'lat': list(merged.values())})
+    tmp_fn = f'{memo_fn}.{os.getpid()}.tmp'
+    df.to_feather(tmp_fn)
+    os.replace(tmp_fn, memo_fn)
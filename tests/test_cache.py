@@ -0,0 +1,67 @@
+"""Check the keys and entries of the parsed region data cache."""
+
+import os
+
+import pandas as pd
+
+from GAR import cache, filter_data
+from GAR.cache import (cache_key, load_all_data_cached, member_type,
+                       predicate_digest)
+from GAR.filter_data import ROW_FILTERS
+from GAR.synthetic import make_archive
+
+
+def test_member_type():
+    name = '01/AS_HOUSES_20230105_0f1e2d3c-0000-4000-8000-000000000000.XML'
+    assert member_type(name) == '01/AS_HOUSES'
+    assert member_type('01/AS_HOUSES_PARAMS_20230112_1.XML') == \
+        '01/AS_HOUSES_PARAMS'
+
+
+def test_predicate_digest(monkeypatch):
+    digest = predicate_digest(filter_data.is_house_type)
+    assert digest == predicate_digest(filter_data.is_house_type)
+    assert digest != predicate_digest(filter_data.is_active)
+    # a module-level constant read by the predicate changes its digest
+    monkeypatch.setattr(filter_data, 'HOUSE_TYPES', [0, 1, 2])
+    assert digest != predicate_digest(filter_data.is_house_type)
+
+
+def test_cache_key(tmp_path, monkeypatch):
+    base_fn, next_fn = str(tmp_path / 'a.zip'), str(tmp_path / 'b.zip')
+    make_archive(base_fn, 100, regions=['01', '77'])
+    make_archive(next_fn, 100, update=1, regions=['01', '77'])
+    key = cache_key(base_fn, '01', ROW_FILTERS)
+    assert key.startswith('01_')
+    assert key == cache_key(base_fn, '01', ROW_FILTERS)
+    assert key != cache_key(base_fn, '01')
+    assert key != cache_key(base_fn, '77', ROW_FILTERS)
+    # region 01 is the same in both releases, region 77 is not
+    assert key == cache_key(next_fn, '01', ROW_FILTERS)
+    assert cache_key(base_fn, '77', ROW_FILTERS) != \
+        cache_key(next_fn, '77', ROW_FILTERS)
+    monkeypatch.setattr(filter_data, 'HOUSE_TYPES', [0, 1, 2])
+    assert key != cache_key(base_fn, '01', ROW_FILTERS)
+
+
+def test_load_cached(tmp_path, monkeypatch):
+    zfn, cache_dir = str(tmp_path / 'a.zip'), str(tmp_path / 'cache')
+    make_archive(zfn, 100, regions=['01', '77'])
+    first = load_all_data_cached(zfn, '77', cache_dir, 2**30, ROW_FILTERS)
+    assert len(os.listdir(cache_dir)) == 1
+
+    def fail(*args):
+        raise AssertionError('parsed again')
+
+    monkeypatch.setattr(cache, 'load_all_data', fail)
+    second = load_all_data_cached(zfn, '77', cache_dir, 2**30, ROW_FILTERS)
+    for x in cache.FRAMES:
+        pd.testing.assert_frame_equal(getattr(first, x), getattr(second, x))
+
+
+def test_evict(tmp_path):
+    zfn, cache_dir = str(tmp_path / 'a.zip'), str(tmp_path / 'cache')
+    make_archive(zfn, 100, regions=['01', '77'])
+    load_all_data_cached(zfn, '01', cache_dir, 2**30, ROW_FILTERS)
+    load_all_data_cached(zfn, '77', cache_dir, 1)
+    assert os.listdir(cache_dir) == []
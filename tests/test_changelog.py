@@ -0,0 +1,124 @@
+"""Check the change log readers and that all change log modes write the
+same file.
+"""
+
+import csv
+import os
+import random
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from GAR.changelog import (FIAS_COLUMNS, bucket_prefixes, make_changelog,
+                           make_snapshot, read_fias_fast, read_fias_python,
+                           read_fias_tables, read_rows_at, save_row_offsets,
+                           select_rows)
+from GAR.config import default_config
+
+
+VALUES = ['Ленина', 'ул', '1', '15к', '', 'NA', 'N/A', 'null', 'a¬b',
+          'x"y', 'line\nbreak', ' sp ', 'ЖК "Солнечный"']
+
+
+def random_rows(n: int, seed: int = 0) -> list:
+    """Generate `n` rows of the FIAS columns used by the change log."""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        guid = str(uuid.UUID(int=rng.getrandbits(128)))
+        row = [guid, rng.choice('01'), str(rng.randint(100000, 100100))]
+        rows.append(row + [rng.choice(VALUES) for _ in FIAS_COLUMNS[3:]])
+    return rows
+
+
+def write_fias(fn: str, rows: list) -> None:
+    """Write rows as a FIAS CSV file, with an `id` column first."""
+    with open(fn, 'w', encoding='utf-8', newline='') as fh:
+        writer = csv.writer(fh, delimiter='¬', lineterminator='\n')
+        writer.writerow(['id'] + FIAS_COLUMNS)
+        writer.writerows([i] + x for i, x in enumerate(rows))
+
+
+def next_rows(rows: list, seed: int = 1) -> list:
+    """Change, remove, duplicate and add rows, as the next release."""
+    rng = random.Random(seed)
+    res = []
+    for row in rows:
+        x = rng.random()
+        if x < 0.1:
+            continue
+        if x < 0.2:
+            row = row[:5] + [rng.choice(VALUES)] + row[6:]
+        elif x < 0.25:
+            res.append(row[:3] + row[3:][::-1])
+        res.append(row)
+    return res + random_rows(len(rows) // 10, seed)
+
+
+def test_read_fast_matches_python(tmp_path):
+    fn = str(tmp_path / 'a.csv')
+    write_fias(fn, random_rows(500))
+    fast = pa.concat_tables(read_fias_fast(fn)).to_pandas()
+    golden = pa.concat_tables(read_fias_python(fn)).to_pandas()
+    pd.testing.assert_frame_equal(fast, golden)
+    assert len(fast) == 500
+
+
+def test_fast_reader_rejects_its_separator(tmp_path):
+    fn = str(tmp_path / 'a.csv')
+    rows = random_rows(10)
+    rows[3][7] = 'a\x1fb'
+    write_fias(fn, rows)
+    with pytest.raises(ValueError):
+        list(read_fias_fast(fn))
+    tables = read_fias_tables(fn)
+    assert sum(x.num_rows for x in tables) == 10
+
+
+def test_save_row_offsets(tmp_path):
+    fn, offsets_fn = str(tmp_path / 'a.csv'), str(tmp_path / 'offsets.bin')
+    write_fias(fn, random_rows(300))
+    with open(fn, 'ab') as fh:
+        fh.write(b'\n')
+    assert save_row_offsets(fn, offsets_fn) == 300
+    offsets = np.fromfile(offsets_fn, dtype='<u8')
+    assert offsets[-1] == os.path.getsize(fn)
+    with open(fn, 'rb') as fh:
+        data = fh.read()
+    assert all(data[x - 1:x] == b'\n' for x in offsets[:-1])
+    rows = np.array([0, 1, 2, 50, 51, 120, 299])
+    golden = select_rows(read_fias_tables(fn), rows).to_pandas()
+    found = read_rows_at(fn, rows, offsets_fn).to_pandas()
+    pd.testing.assert_frame_equal(found, golden)
+
+
+@pytest.mark.parametrize('mode', [
+    {'chlog_hash': True},
+    {'chlog_hash': True, 'chlog_prefix': 2, 'chlog_workers': 2},
+    {'snapshot': True},
+    {'chlog_prefix': 2, 'chlog_workers': 2},
+])
+def test_modes_write_the_same_file(tmp_path, mode):
+    rows = random_rows(2000)
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    write_fias(str(src_dir / 'a.csv'), rows)
+    write_fias(str(src_dir / 'b.csv'), next_rows(rows))
+    saved = {}
+    for name, kw in [('text', {}), ('mode', mode)]:
+        work_dir = tmp_path / name
+        shutil.copytree(src_dir, work_dir)
+        config = default_config()._replace(**kw)
+        if config.snapshot:
+            make_snapshot(str(work_dir / 'a.csv'),
+                          bucket_prefixes(config.chlog_prefix))
+        make_changelog(str(work_dir / 'a.csv'), str(work_dir / 'b.csv'),
+                       str(work_dir / 'tmp'), config)
+        with open(work_dir / 'a_b_change_log.csv', 'rb') as fh:
+            saved[name] = fh.read()
+    assert saved['mode'] == saved['text']
+    assert saved['text'].count(b'\n') > 200
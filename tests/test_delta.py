@@ -0,0 +1,82 @@
+"""Check applying delta records to the state of a full run."""
+
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from GAR.config import default_config
+from GAR.delta import apply_delta, descendants, upsert
+from GAR.filter_data import is_active
+from GAR.main import process_all_regions
+from GAR.merge_to_csv import merge_all_files
+from GAR.synthetic import make_archive, version_date
+
+
+def test_upsert():
+    state = pd.DataFrame({'ID': ['1', '2', '3'], 'ISACTIVE': ['1'] * 3,
+                          'NAME': ['a', 'b', 'c']})
+    delta = pd.DataFrame({'ID': ['2', '3', '4', '5'],
+                          'ISACTIVE': ['1', '0', '1', '0'],
+                          'NAME': ['B', 'C', 'd', 'e']})
+    res = upsert(state, delta, {'ISACTIVE': is_active})
+    # '3' is deactivated and '5' is filtered out
+    assert res.ID.tolist() == ['1', '2', '4']
+    assert res.NAME.tolist() == ['a', 'B', 'd']
+    assert len(upsert(state, delta)) == 5
+
+
+def test_descendants():
+    mh = pd.DataFrame({'OBJECTID': ['2', '3', '4', '5', '6'],
+                       'PARENTOBJID': ['1', '2', '3', '1', None]})
+    moved = pd.DataFrame({'OBJECTID': ['6'], 'PARENTOBJID': ['4']})
+    assert descendants(np.array([2]), [mh]).tolist() == [2, 3, 4]
+    assert descendants(np.array([1]), [mh]).tolist() == [1, 2, 3, 4, 5]
+    assert descendants(np.array([3]), [mh, moved]).tolist() == [3, 4, 6]
+    assert descendants(np.array([7]), [mh]).tolist() == [7]
+
+
+def write_delta(base_fn: str, update_fn: str, delta_fn: str) -> None:
+    """Write the records of an updated archive that are new or differ
+    from the base one (by record ID) as a delta archive.
+    """
+    with zipfile.ZipFile(base_fn) as za, zipfile.ZipFile(update_fn) as zb, \
+            zipfile.ZipFile(delta_fn, 'w') as zd:
+        old_names = {x.split('_20')[0]: x for x in za.namelist()}
+        for name in zb.namelist():
+            if '/' not in name:
+                continue
+            old = ET.fromstring(za.read(old_names[name.split('_20')[0]]))
+            new = ET.fromstring(zb.read(name))
+            known = {x.get('ID'): x.attrib for x in old}
+            root = ET.Element(new.tag)
+            root.extend(x for x in new if known.get(x.get('ID')) != x.attrib)
+            if len(root):
+                zd.writestr(name, ET.tostring(root, encoding='utf-8'))
+
+
+def export_rows(fn: str) -> list:
+    """Read the lines of an export without the row numbers, sorted."""
+    with open(fn, encoding='utf-8') as fh:
+        return sorted(x.split('¬', 1)[1] for x in fh)
+
+
+def test_delta_round_trip(tmp_path):
+    base_fn, update_fn = str(tmp_path / 'a.zip'), str(tmp_path / 'b.zip')
+    make_archive(base_fn, 300, regions=['01', '77'])
+    make_archive(update_fn, 300, update=1, regions=['01', '77'])
+    delta_fn = str(tmp_path / f'delta_{version_date(1)}.zip')
+    write_delta(base_fn, update_fn, delta_fn)
+    state_dir = str(tmp_path / 'state')
+    config = default_config()._replace(state_dir=state_dir)
+    process_all_regions(base_fn, str(tmp_path / 'ra'), config)
+    merge_all_files(str(tmp_path / 'ra'), str(tmp_path / 'a.csv'))
+    apply_delta(delta_fn, state_dir, str(tmp_path / 'd.csv'),
+                str(tmp_path / 'chlog.csv'), config)
+    process_all_regions(update_fn, str(tmp_path / 'rb'), default_config())
+    merge_all_files(str(tmp_path / 'rb'), str(tmp_path / 'b.csv'))
+    assert export_rows(tmp_path / 'd.csv') == export_rows(tmp_path / 'b.csv')
+    assert export_rows(tmp_path / 'a.csv') != export_rows(tmp_path / 'b.csv')
+    chlog = pd.read_csv(tmp_path / 'chlog.csv', sep='¬', engine='python')
+    assert len(chlog) > 0
@@ -0,0 +1,53 @@
+"""Check splitting source XML files into record chunks and loading them
+in parallel.
+"""
+
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from GAR.file_utils import (get_archive_index, load_all_data, parse_chunk,
+                            parse_xml, split_records, table_to_df)
+from GAR.filter_data import ROW_FILTERS
+from GAR.synthetic import make_archive
+
+
+def make_xml(n: int) -> bytes:
+    """Write an XML file of `n` house records, some inactive."""
+    records = ''.join(f'<HOUSE ID="{i}" OBJECTID="{i * 7}" '
+                      f'HOUSENUM="{i}а" ISACTIVE="{i % 3 and 1}" />'
+                      for i in range(n))
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            f'<HOUSES>{records}</HOUSES>').encode('utf-8')
+
+
+@pytest.mark.parametrize('n, split_bytes', [
+    (0, 10), (1, 10), (1, 10**6), (100, 1), (100, 37), (100, 500),
+    (100, 10**6),
+])
+def test_split_records(n, split_bytes):
+    xml = make_xml(n)
+    chunks = list(split_records(io.BytesIO(xml), 'HOUSE', split_bytes))
+    assert len(chunks) >= 1
+    assert all(x.startswith(b'<HOUSE ') for x in chunks if x)
+    assert sum(x.count(b'<HOUSE ') for x in chunks) == n
+    attrs = ['ID', 'OBJECTID', 'HOUSENUM']
+    check = {'ISACTIVE': ROW_FILTERS['hs']['ISACTIVE']}
+    parsed = pa.concat_tables([parse_chunk(x, 'HOUSE', attrs, check)
+                               for x in chunks])
+    golden = parse_xml(io.BytesIO(xml), 'HOUSE', attrs, check)
+    pd.testing.assert_frame_equal(table_to_df(parsed), golden)
+
+
+def test_load_parallel(tmp_path):
+    zfn = str(tmp_path / 'a.zip')
+    make_archive(zfn, 300, regions=['77'])
+    assert get_archive_index(zfn)['77'].hs.size > 2**12
+    serial = load_all_data(zfn, '77', ROW_FILTERS)
+    parallel = load_all_data(zfn, '77', ROW_FILTERS, workers=2,
+                             split_bytes=2**12)
+    for x in serial._fields:
+        pd.testing.assert_frame_equal(getattr(parallel, x),
+                                      getattr(serial, x))
@@ -0,0 +1,82 @@
+"""Check inverted index queries against a scan of the export."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from GAR.config import default_config
+from GAR.inverted import find_rows, normalize_term, open_inverted_index
+from GAR.main import process_all_regions
+from GAR.merge_to_csv import merge_all_files
+from GAR.synthetic import make_archive
+
+
+@pytest.fixture(scope='module')
+def export(tmp_path_factory):
+    """Export a synthetic archive with inverted indexes. Return the
+    exported rows and the open index.
+    """
+    work_dir = tmp_path_factory.mktemp('inverted')
+    zfn = str(work_dir / 'a.zip')
+    make_archive(zfn, 300, regions=['01', '77'])
+    config = default_config()._replace(inverted_dir=str(work_dir / 'index'))
+    process_all_regions(zfn, str(work_dir / 'regions'), config)
+    merge_all_files(str(work_dir / 'regions'), str(work_dir / 'a.csv'),
+                    config)
+    rows = pd.read_csv(work_dir / 'a.csv', sep='¬', engine='python',
+                       dtype=str, keep_default_na=False)
+    rows['id'] = rows['id'].astype(int)
+    return rows, open_inverted_index(config.inverted_dir)
+
+
+def scan(rows: pd.DataFrame, postcode=None, street=None,
+         current=False) -> np.ndarray:
+    """Find the rows of a query by comparing every exported row."""
+    keep = np.ones(len(rows), dtype=bool)
+    if postcode is not None:
+        keep &= (rows.postalcode != '') & (
+            rows.postalcode.map(normalize_term) == normalize_term(postcode))
+    if street is not None:
+        city = rows.city_f.where(rows.city_f != '', rows.place_f)
+        terms = zip(rows.region_iso_code, city, rows.street_f)
+        keep &= (rows.street_f != '') & np.array(
+            [[normalize_term(x) for x in y] ==
+             [normalize_term(x) for x in street] for y in terms], dtype=bool)
+    if current:
+        keep &= rows.current == '1'
+    return np.sort(rows.id.to_numpy()[keep])
+
+
+def test_postcode(export):
+    rows, index = export
+    for postcode in rows.postalcode.drop_duplicates().head(30):
+        for current in [False, True]:
+            found = find_rows(index, postcode=postcode, current=current)
+            assert found.tolist() == scan(rows, postcode, None,
+                                          current).tolist()
+
+
+def test_street(export):
+    rows, index = export
+    city = rows.city_f.where(rows.city_f != '', rows.place_f)
+    streets = pd.DataFrame({'region': rows.region_iso_code, 'city': city,
+                            'street': rows.street_f})
+    streets = streets.loc[rows.street_f != ''].drop_duplicates().head(30)
+    assert len(streets)
+    for street in streets.itertuples(index=False):
+        found = find_rows(index, street=tuple(street))
+        assert len(found)
+        assert found.tolist() == scan(rows, None, street).tolist()
+        upper = tuple(f' {x.upper()} ' for x in street)
+        assert find_rows(index, street=upper).tolist() == found.tolist()
+        postcode = rows.postalcode[rows.id == found[0]].iloc[0]
+        assert find_rows(index, postcode, tuple(street), True).tolist() == \
+            scan(rows, postcode, street, True).tolist()
+
+
+def test_no_match(export):
+    _, index = export
+    assert find_rows(index, postcode='000000').tolist() == []
+    assert find_rows(index, street=('MOW', 'x' * 500, 'y')).tolist() == []
+    with pytest.raises(ValueError):
+        find_rows(index, current=True)
@@ -0,0 +1,57 @@
+"""Check GUID lookups against the rows of the export."""
+
+import pandas as pd
+import pytest
+
+from GAR.config import default_config
+from GAR.lookup import lookup_guid, lookup_guids, open_guid_index
+from GAR.main import process_all_regions
+from GAR.merge_to_csv import merge_all_files
+from GAR.synthetic import make_archive
+
+
+@pytest.fixture(scope='module')
+def export(tmp_path_factory):
+    """Export a synthetic archive with a GUID lookup index. Return the
+    exported rows and the open index.
+    """
+    work_dir = tmp_path_factory.mktemp('lookup')
+    zfn = str(work_dir / 'a.zip')
+    make_archive(zfn, 300, regions=['01', '77'])
+    config = default_config()._replace(lookup_dir=str(work_dir / 'index'))
+    process_all_regions(zfn, str(work_dir / 'regions'), config)
+    merge_all_files(str(work_dir / 'regions'), str(work_dir / 'a.csv'),
+                    config)
+    rows = pd.read_csv(work_dir / 'a.csv', sep='¬', engine='python',
+                       dtype=str, keep_default_na=False)
+    for x in ['id', 'current']:
+        rows[x] = rows[x].astype(int)
+    return rows, open_guid_index(config.lookup_dir)
+
+
+def test_lookup_guid(export):
+    rows, index = export
+    for guid in rows.guid.drop_duplicates().sample(50, random_state=0):
+        golden = rows.loc[rows.guid == guid].to_dict('records')
+        assert lookup_guid(index, guid) == golden
+        assert lookup_guid(index, guid.upper()) == golden
+
+
+def test_lookup_missing(export):
+    _, index = export
+    assert lookup_guid(index, '00000000-0000-0000-0000-000000000000') == []
+    assert lookup_guid(index, 'not a guid') == []
+    assert lookup_guid(index, '') == []
+
+
+@pytest.mark.parametrize('n', [10, 200])
+def test_lookup_guids(export, n):
+    rows, index = export
+    guids = rows.guid.drop_duplicates().sample(n, random_state=1).tolist()
+    guids[::7] = ['bad'] * len(guids[::7])
+    found = lookup_guids(index, guids).to_pandas()
+    assert (found['query'].diff().dropna() >= 0).all()
+    for i, guid in enumerate(guids):
+        golden = rows.loc[rows.guid == guid]
+        result = found.loc[found['query'] == i].drop(columns='query')
+        assert result['id'].tolist() == golden['id'].tolist()
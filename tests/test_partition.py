@@ -0,0 +1,80 @@
+"""Check partition assignment and the merge of compiled partitions."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from GAR import partition
+from GAR.partition import (assign_partitions, count_partitions,
+                           merge_partitions, save_partition)
+
+
+def test_count_partitions():
+    assert count_partitions(10**6, 0) == 1
+    assert count_partitions(10, 2**30) == 1
+    assert count_partitions(1000, 1000 * partition.ROW_BYTES // 4) == 4
+
+
+def test_assign_by_subtree():
+    rng = np.random.default_rng(0)
+    keys = rng.integers(0, 40, 5000)
+    objectids = pd.Series(np.arange(5000) * 7)
+    parts, method = assign_partitions(keys, objectids, 4)
+    assert method == 'subtree'
+    # every subtree is in a single partition
+    frame = pd.DataFrame({'key': keys, 'part': parts})
+    assert (frame.groupby('key').part.nunique() == 1).all()
+    load = np.bincount(parts, minlength=4)
+    assert load.max() - load.min() <= np.bincount(keys).max()
+
+
+def test_assign_by_hash():
+    keys = np.zeros(1000, dtype=np.int64)
+    keys[:10] = np.arange(1, 11)
+    objectids = pd.Series(np.arange(1000) + 10**6)
+    parts, method = assign_partitions(keys, objectids, 4)
+    assert method == 'hash'
+    assert set(parts) == {0, 1, 2, 3}
+    again, _ = assign_partitions(keys[::-1], objectids[::-1], 4)
+    assert (again[::-1] == parts).all()
+
+
+def compiled_rows(n_houses: int, seed: int = 0) -> pd.DataFrame:
+    """Rows of compiled houses in OBJECTID order, 1 to 3 per house."""
+    rng = np.random.default_rng(seed)
+    objectids = np.sort(rng.choice(10**6, n_houses, replace=False))
+    counts = rng.integers(1, 4, n_houses)
+    objectid = np.repeat(objectids, counts)
+    return pd.DataFrame({
+        'guid': [f'g{x}' for x in objectid],
+        'current': rng.integers(0, 2, len(objectid)),
+        'seq': np.arange(len(objectid)),
+        'objectid': objectid})
+
+
+@pytest.mark.parametrize('n_parts', [1, 3, 7])
+def test_merge_partitions(tmp_path, monkeypatch, n_parts):
+    monkeypatch.setattr(partition, 'PART_ROWS', 16)
+    monkeypatch.setattr(partition, 'MERGE_ROWS', 50)
+    rows = compiled_rows(400)
+    house_part = pd.Series(np.random.default_rng(1).integers(
+        0, n_parts, rows.objectid.nunique()), index=rows.objectid.unique())
+    part_of = house_part.loc[rows.objectid].to_numpy()
+    parts = [save_partition(rows.loc[part_of == i].reset_index(drop=True),
+                            str(tmp_path / f'{i}.fea'))
+             for i in range(n_parts)]
+    dest_fn, state_fn = str(tmp_path / 'r.fea'), str(tmp_path / 's.fea')
+    assert merge_partitions(parts, dest_fn, state_fn) == len(rows)
+    pd.testing.assert_frame_equal(pd.read_feather(state_fn), rows)
+    pd.testing.assert_frame_equal(pd.read_feather(dest_fn),
+                                  rows.drop(columns='objectid'))
+
+
+def test_merge_empty_partition(tmp_path):
+    rows = compiled_rows(0)
+    parts = [save_partition(rows, str(tmp_path / '0.fea'))]
+    assert merge_partitions(parts, str(tmp_path / 'r.fea')) == 0
+    merged = pd.read_feather(tmp_path / 'r.fea')
+    assert list(merged.columns) == ['guid', 'current', 'seq']
+    with pytest.raises(ValueError):
+        merge_partitions([], str(tmp_path / 'x.fea'))
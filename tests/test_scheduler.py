@@ -0,0 +1,30 @@
+"""Check the memory estimate and the admission of region tasks."""
+
+from GAR.config import default_config
+from GAR.scheduler import Task, estimate_rss, pick_next
+
+
+MB = 2**20
+
+
+def test_estimate_rss():
+    config = default_config()._replace(rss_factor=2.0, split_bytes=0)
+    task = Task(region='77', size=100 * MB)
+    assert estimate_rss(task, config) == 200 * MB
+    config = config._replace(load_workers=3)
+    assert estimate_rss(task, config) == 600 * MB
+    config = config._replace(split_bytes=10 * MB)
+    assert estimate_rss(task, config) == 280 * MB
+    small = Task(region='01', size=5 * MB)
+    assert estimate_rss(small, config) == 30 * MB
+
+
+def test_pick_next_counts_load_workers():
+    config = default_config()._replace(rss_factor=1.0, split_bytes=0,
+                                       max_rss=250 * MB, big_regions=())
+    running = [Task(region='77', size=100 * MB)]
+    pending = [Task(region='50', size=100 * MB)]
+    assert pick_next(pending, running, config) == pending[0]
+    config = config._replace(load_workers=2)
+    assert pick_next(pending, running, config) is None
+    assert pick_next(pending, [], config) == pending[0]
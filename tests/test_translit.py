@@ -0,0 +1,96 @@
+"""Check the vectorized transliteration against the regex based
+reference implementation.
+"""
+
+import random
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from GAR.translit import (BATCH_SIZE, translit_column, translit_series,
+                          translit_series_regex)
+
+
+CORPUS = [
+    'Ленина', 'ул. Ленина', 'Елецкая', 'Эльбрус', 'Подъездная', 'Объездная',
+    'Соловьёва', 'Ёлочная', 'ЁЛКА', 'ёж', 'Щорса', 'щи', 'ЖК "Солнечный"',
+    'СНТ Речная', 'ДНП', 'им Ленина', 'мкр 7/1', 'Аэропорт', 'Ее', 'ЕЕЕ',
+    'ееее', 'Аее', 'е', 'Е', 'ЭЭ', 'ьъ', 'ЪЬ', 'Ый', 'МаМ', 'МаМаМ', 'АбВгД',
+    '15к', '2а', '-', '', ' ', 'Main st', 'Straße', '北京', 'Ленина\tд 1',
+]
+MISSING = [None, np.nan, pd.NA]
+OTHER = [5, 1.5, b'bytes', True]
+
+
+def random_names(n: int, seed: int = 0) -> List[str]:
+    """Generate `n` address-like strings out of the corpus words, with
+    numbers and punctuation.
+    """
+    rng = random.Random(seed)
+    words = CORPUS[:21] + ['пер', 'ул', 'Заводская', 'Речная']
+    extra = ['', '', '1', '2а', '15к', '"Солнечный"', '-', '7/1', 'ЭЭ']
+    names = []
+    for _ in range(n):
+        parts = [rng.choice(words) for _ in range(rng.randint(1, 4))]
+        names.append(' '.join(parts + [rng.choice(extra)]).strip())
+    return names
+
+
+def same_values(result: pd.Series, golden: pd.Series) -> bool:
+    """Compare two object Series element by element, missing values by
+    their type (None, NaN and pd.NA are not interchangeable).
+    """
+    if len(result) != len(golden) or not result.index.equals(golden.index):
+        return False
+    for x, y in zip(result.tolist(), golden.tolist()):
+        if isinstance(y, str) or isinstance(x, str):
+            if x != y:
+                return False
+        elif type(x) is not type(y) or (x is not y and not
+                                        (pd.isna(x) and pd.isna(y))):
+            return False
+    return True
+
+
+@pytest.mark.parametrize('values', [
+    CORPUS,
+    CORPUS + MISSING + OTHER,
+    MISSING + OTHER,
+    [None, None],
+    [],
+    random_names(2000, seed=1),
+])
+def test_matches_regex(values):
+    cyr = pd.Series(values, dtype=object, index=np.arange(len(values)) * 3)
+    result = translit_series(cyr)
+    golden = translit_series_regex(cyr)
+    assert result.dtype == object
+    assert same_values(result, golden)
+
+
+def test_batches(monkeypatch):
+    monkeypatch.setattr('GAR.translit.BATCH_SIZE', 7)
+    cyr = pd.Series(CORPUS + MISSING, dtype=object)
+    assert BATCH_SIZE != 7
+    assert same_values(translit_series(cyr), translit_series_regex(cyr))
+
+
+def test_separator_falls_back_to_regex():
+    cyr = pd.Series(['Ле\x00нина', 'Ёж', None], dtype=object)
+    assert same_values(translit_series(cyr), translit_series_regex(cyr))
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_column_with_memo(categorical):
+    values = CORPUS + [None] + CORPUS[:5]
+    cyr = pd.Series(values, dtype='category' if categorical else object)
+    memo = {}
+    first = translit_column(cyr, memo)
+    second = translit_column(cyr, memo)
+    golden = translit_series_regex(pd.Series(values, dtype=object))
+    for result in [first, second]:
+        assert result.astype(object).where(result.notna(), None).tolist() \
+            == golden.where(golden.notna(), None).tolist()
+    assert set(memo) == set(CORPUS)